@@ -0,0 +1,25 @@
+from collections import namedtuple
+
+# 成就規則：counter 的值第一次達到 threshold 時頒發。
+# counter 由 app.py 的成就引擎在寫入事件發生時增量維護：
+#   poop_records      便便紀錄筆數
+#   login_streak      users.consecutive_login_days
+#   distinct_toilets  打卡過的不同公廁數（toilet_checkins / public_checkins）
+#   bristol4_streak   連續幾天都有布里斯托第 4 型的紀錄
+# 新增或調整規則後執行 `flask achievements reevaluate` 補發。
+Rule = namedtuple('Rule', 'key name description counter threshold')
+
+RULES = [
+    Rule('first_record', '第一次紀錄', '完成第一筆便便紀錄', 'poop_records', 1),
+    Rule('records_10', '紀錄達人', '累積 10 筆便便紀錄', 'poop_records', 10),
+    Rule('records_100', '百便斬', '累積 100 筆便便紀錄', 'poop_records', 100),
+    Rule('login_streak_7', '一週不間斷', '連續登入 7 天', 'login_streak', 7),
+    Rule('login_streak_30', '月月報到', '連續登入 30 天', 'login_streak', 30),
+    Rule('toilets_5', '公廁探險家', '在 5 間不同的公廁打卡', 'distinct_toilets', 5),
+    Rule('toilets_20', '公廁收藏家', '在 20 間不同的公廁打卡', 'distinct_toilets', 20),
+    Rule('bristol4_week', '完美一週', '連續 7 天都是布里斯托第 4 型', 'bristol4_streak', 7),
+]
+
+RULES_BY_COUNTER = {}
+for _rule in RULES:
+    RULES_BY_COUNTER.setdefault(_rule.counter, []).append(_rule)
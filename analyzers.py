@@ -0,0 +1,76 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+
+class AnalyzerError(Exception):
+    pass
+
+
+class StubAnalyzer:
+    """本機開發與測試用：依布里斯托分級、顏色與是否帶血套固定規則，不呼叫外部服務。"""
+
+    TYPES = {1: '硬塊', 2: '香腸狀有裂痕', 3: '香腸狀表面龜裂', 4: '香蕉狀', 5: '軟塊', 6: '糊狀', 7: '水狀'}
+
+    def analyze(self, record):
+        digits = ''.join(ch for ch in str(record.get('bristol_scale') or '') if ch.isdigit())
+        bristol = int(digits) if digits and 1 <= int(digits) <= 7 else None
+        score = 80
+        findings = []
+        recommendations = []
+        if bristol in (1, 2):
+            score -= 20
+            findings.append('偏硬，可能有便秘傾向')
+            recommendations.append('多喝水、多攝取膳食纖維')
+        elif bristol in (6, 7):
+            score -= 20
+            findings.append('偏稀，可能有腹瀉傾向')
+            recommendations.append('注意補充水分與電解質')
+        elif bristol in (3, 4, 5):
+            score += 10
+            findings.append('型態正常')
+        if record.get('has_blood'):
+            score -= 30
+            findings.append('帶血')
+            recommendations.append('若持續出現請就醫檢查')
+        if record.get('has_mucus'):
+            score -= 10
+            findings.append('帶黏液')
+        return {
+            'ai_poop_type': self.TYPES.get(bristol, '未知'),
+            'ai_poop_color': record.get('color') or '未知',
+            'ai_poop_volume': record.get('volume') or '未知',
+            'ai_diagnosis': '、'.join(findings) or '資料不足',
+            'health_score': max(0, min(100, score)),
+            'recommendations': '；'.join(recommendations) or '維持目前的飲食與作息',
+        }
+
+
+class HttpAnalyzer:
+    """把紀錄 POST 給外部模型服務，回傳格式與 StubAnalyzer.analyze 相同。"""
+
+    def __init__(self, url, timeout=60, token=None):
+        self.url = url
+        self.timeout = timeout
+        self.token = token
+
+    def analyze(self, record):
+        body = json.dumps(record, default=str).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        req = urllib.request.Request(self.url, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except (urllib.error.URLError, TimeoutError, ValueError) as e:
+            raise AnalyzerError(f'analyzer request failed: {e}') from e
+
+
+def analyzer_from_env():
+    url = os.getenv('ANALYZER_URL')
+    if url:
+        return HttpAnalyzer(url, timeout=float(os.getenv('ANALYZER_TIMEOUT', '60')),
+                            token=os.getenv('ANALYZER_TOKEN'))
+    return StubAnalyzer()
@@ -1,28 +1,130 @@
-from flask import Flask, request, jsonify
+import click
+from flask import (Blueprint, Flask, Response, abort, current_app, g, has_request_context, request, jsonify,
+                   send_from_directory)
+from flask.cli import AppGroup
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from dotenv import load_dotenv
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+import io
+import itertools
+import json
+import math
 import os
-from datetime import datetime
+import random
+import secrets
+import signal
+import socket
+import threading
+import time
+from datetime import date, datetime, timedelta
+from functools import wraps
+from uuid import uuid4
+
+from achievement_rules import RULES, RULES_BY_COUNTER
+from analyzers import analyzer_from_env
+from archive_store import ArchiveFile, ArchiveStore, scan as scan_archive
+from auth_tokens import InvalidToken, TokenManager
+from clusters import ClusterIndex
+from db_pool import engine_options_from_env, instrument, pool_status
+from db_utils import dialect_insert, keyset_index
+from live_events import EventHub, PgListener, sse_event
+from metrics import COUNT_BUCKETS, Metrics
+from media_store import (DECODE_ERRORS, EXTENSIONS, VARIANTS, UploadTooLarge, make_variants, save_stream,
+                         store_from_env, supports_variants, variant_key)
+import migrations
+import quantiles
+from password_hashing import HashingBusy, hash_password, needs_rehash, verify_password
+from pagination import (InvalidPageRequest, apply_filters, decode_cursor, encode_cursor, paginate, parse_limit,
+                        parse_time)
+import partitions
+from response_cache import cache_from_env
+from serializers import FastJSONProvider, RowSerializer, UnknownField
+from spatial import GridIndex, haversine_m, quadkey, quadkey_tile, tile_center, tile_quadkey, tile_xy
+from streaming import STREAM_BATCH_SIZE, ndjson_response, wants_stream
+from text_search import SearchIndex
+from toilet_import import ImportAborted, import_toilets, iter_rows, save_upload
 
 load_dotenv()
-app = Flask(__name__)
-CORS(app)
+db = SQLAlchemy()
+# 所有路由、錯誤處理與 CLI 指令都掛在這個 blueprint 上，由 create_app() 註冊到 app
+api = Blueprint('api', __name__, cli_group=None)
 
 # 修正 URI 前綴
-uri = os.getenv("SQLALCHEMY_DATABASE_URI")  
-if uri and uri.startswith("postgres://"):
-    uri = uri.replace("postgres://", "postgresql://", 1)
-app.config['SQLALCHEMY_DATABASE_URI'] = uri
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
+def database_uri_from_env():
+    uri = os.getenv("SQLALCHEMY_DATABASE_URI")
+    if uri and uri.startswith("postgres://"):
+        uri = uri.replace("postgres://", "postgresql://", 1)
+    return uri
+
+# 簽 token 用；每個 worker、每台機器、每次部署都必須是同一把，否則已發出的 token 會失效。
+# 沒設定時只有 debug / 測試可以啟動，改用臨時產生的 key（見 create_app）
+SECRET_KEY = os.getenv('SECRET_KEY')
+EPHEMERAL_SECRET_KEY = not SECRET_KEY
+if EPHEMERAL_SECRET_KEY:
+    SECRET_KEY = secrets.token_hex(32)
+
+# GET 回應快取（預設行程內 LRU；設定 RESPONSE_CACHE_URL 則改用共用的 Redis）。
+# 行程內快取的失效只在本 worker 生效，多個 worker 時 gunicorn.conf.py 會把有 tag 的快取縮短到幾秒
+response_cache = cache_from_env()
+
+# 登記在目前 transaction commit 之後才執行的動作（例如讓快取失效）；rollback 就丟掉
+def after_commit(fn, *args):
+    db.session.info.setdefault('after_commit', []).append((fn, args))
+
+@event.listens_for(Session, 'after_commit')
+def _run_after_commit(session):
+    for fn, args in session.info.pop('after_commit', []):
+        fn(*args)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_after_commit(session, previous_transaction):
+    session.info.pop('after_commit', None)
+
+# 每類路由各自的 statement_timeout（毫秒，0 表示不限制），只在 PostgreSQL 上生效。
+# 用 SET LOCAL 而不是連線參數，經過 PgBouncer transaction mode 也適用；CLI 指令不受限制
+STATEMENT_TIMEOUTS = {
+    'default': int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000')),
+    'stream': int(os.getenv('DB_STREAM_STATEMENT_TIMEOUT_MS', '120000')),
+}
+
+def _set_statement_timeout(connection, kind):
+    timeout = STATEMENT_TIMEOUTS.get(kind, STATEMENT_TIMEOUTS['default'])
+    connection.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout)}')
+
+@event.listens_for(Session, 'after_begin')
+def _apply_statement_timeout(session, transaction, connection):
+    if has_request_context() and connection.dialect.name == 'postgresql':
+        _set_statement_timeout(connection, g.get('statement_timeout', 'default'))
+
+def use_statement_timeout(kind):
+    g.statement_timeout = kind
+    # transaction 已經開始（例如驗證時查過資料）就立刻套用
+    if db.session().in_transaction() and db.engine.dialect.name == 'postgresql':
+        _set_statement_timeout(db.session.connection(), kind)
+
+def statement_timeout(kind):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            use_statement_timeout(kind)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # ---------------- Models ----------------
+# 索引的變更要同時寫一個 migrations.py 的版本，既有資料庫才會跟上
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('uq_users_username', 'username', unique=True),
+        keyset_index('ix_users_created_at', 'created_at', 'user_id'),
+    )
     user_id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50))
     email = db.Column(db.String(120))
@@ -34,6 +136,9 @@ class User(db.Model):
 
 class Achievement(db.Model):
     __tablename__ = 'achievements'
+    __table_args__ = (
+        keyset_index('ix_achievements_user_time', 'user_id', 'achieved_at', 'achievement_id'),
+    )
     achievement_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'))
     achievement_name = db.Column(db.String(100))
@@ -50,6 +155,10 @@ class Checkin(db.Model):
 
 class AnalysisResult(db.Model):
     __tablename__ = 'analysis_results'
+    __table_args__ = (
+        keyset_index('ix_analysis_results_user_time', 'user_id', 'analysis_time', 'analysis_id'),
+        db.Index('ix_analysis_results_record', 'record_id'),
+    )
     analysis_id = db.Column(db.Integer, primary_key=True)
     record_id = db.Column(db.Integer, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'))
@@ -60,6 +169,10 @@ class AnalysisResult(db.Model):
 
 class PoopLocation(db.Model):
     __tablename__ = 'poop_locations'
+    __table_args__ = (
+        keyset_index('ix_poop_locations_user_time', 'user_id', 'record_time', 'location_id'),
+        db.Index('ix_poop_locations_record', 'record_id'),
+    )
     location_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'))
     record_id = db.Column(db.Integer, nullable=True)
@@ -72,6 +185,10 @@ class PoopLocation(db.Model):
 
 class PoopRecord(db.Model):
     __tablename__ = 'poop_records'
+    __table_args__ = (
+        keyset_index('ix_poop_records_user_time', 'user_id', 'record_time', 'record_id'),
+        keyset_index('ix_poop_records_time', 'record_time', 'record_id'),
+    )
     record_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer)
     record_time = db.Column(db.DateTime)
@@ -83,6 +200,7 @@ class PoopRecord(db.Model):
     has_blood = db.Column(db.Boolean)
     has_mucus = db.Column(db.Boolean)
     image_url = db.Column(db.String(255))
+    image_thumbnail_url = db.Column(db.String(255))
     ai_poop_type = db.Column(db.String(20))
     ai_poop_color = db.Column(db.String(20))
     ai_poop_volume = db.Column(db.String(20))
@@ -110,6 +228,10 @@ class PublicToilet(db.Model):
 
 class ToiletCheckin(db.Model):
     __tablename__ = 'toilet_checkins'
+    __table_args__ = (
+        keyset_index('ix_toilet_checkins_user_time', 'user_id', 'checkin_time', 'toilet_checkin_id'),
+        keyset_index('ix_toilet_checkins_toilet_time', 'public_toilet_id', 'checkin_time', 'toilet_checkin_id'),
+    )
     toilet_checkin_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, nullable=False)
     checkin_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -124,6 +246,11 @@ class ToiletCheckin(db.Model):
 
 class PublicCheckin(db.Model):
     __tablename__ = 'public_checkins'
+    __table_args__ = (
+        keyset_index('ix_public_checkins_time', 'created_at', 'id'),
+        keyset_index('ix_public_checkins_user_time', 'user_id', 'created_at', 'id'),
+        keyset_index('ix_public_checkins_bathroom_time', 'bathroom_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.String, primary_key=True)
     user_id = db.Column(db.String)
@@ -142,6 +269,7 @@ class PublicCheckin(db.Model):
     custom_message = db.Column(db.String)
     quick_tag = db.Column(db.String)
     image_url = db.Column(db.String)
+    image_thumbnail_url = db.Column(db.String)
     audio_url = db.Column(db.String)
     is_anonymous = db.Column(db.Boolean)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -149,6 +277,9 @@ class PublicCheckin(db.Model):
 
 class PrivateCheckin(db.Model):
     __tablename__ = 'private_checkins'
+    __table_args__ = (
+        keyset_index('ix_private_checkins_user_time', 'user_id', 'created_at', 'id'),
+    )
     id = db.Column(db.String, primary_key=True)
     user_id = db.Column(db.String)
     bathroom_id = db.Column(db.String)
@@ -166,23 +297,464 @@ class PrivateCheckin(db.Model):
     custom_message = db.Column(db.String)
     quick_tag = db.Column(db.String)
     image_url = db.Column(db.String)
+    image_thumbnail_url = db.Column(db.String)
     audio_url = db.Column(db.String)
     personal_notes = db.Column(db.Text)
     health_notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime)
     updated_at = db.Column(db.DateTime)
+
+class UserDailyStats(db.Model):
+    __tablename__ = 'user_daily_stats'
+    user_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    record_count = db.Column(db.Integer, nullable=False, default=0)
+    bristol_1 = db.Column(db.Integer, nullable=False, default=0)
+    bristol_2 = db.Column(db.Integer, nullable=False, default=0)
+    bristol_3 = db.Column(db.Integer, nullable=False, default=0)
+    bristol_4 = db.Column(db.Integer, nullable=False, default=0)
+    bristol_5 = db.Column(db.Integer, nullable=False, default=0)
+    bristol_6 = db.Column(db.Integer, nullable=False, default=0)
+    bristol_7 = db.Column(db.Integer, nullable=False, default=0)
+    bristol_unknown = db.Column(db.Integer, nullable=False, default=0)
+    blood_count = db.Column(db.Integer, nullable=False, default=0)
+    mucus_count = db.Column(db.Integer, nullable=False, default=0)
+
+class ToiletRatingSummary(db.Model):
+    __tablename__ = 'toilet_rating_summaries'
+    toilet_id = db.Column(db.String, primary_key=True)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    cleanliness_sum = db.Column(db.Float, nullable=False, default=0)
+    cleanliness_count = db.Column(db.Integer, nullable=False, default=0)
+    privacy_sum = db.Column(db.Float, nullable=False, default=0)
+    privacy_count = db.Column(db.Integer, nullable=False, default=0)
+    amenities_sum = db.Column(db.Float, nullable=False, default=0)
+    amenities_count = db.Column(db.Integer, nullable=False, default=0)
+    overall_sum = db.Column(db.Float, nullable=False, default=0)
+    overall_count = db.Column(db.Integer, nullable=False, default=0)
+    last_review_at = db.Column(db.DateTime)
+
+class AchievementProgress(db.Model):
+    __tablename__ = 'achievement_progress'
+    user_id = db.Column(db.Integer, primary_key=True)
+    counter = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    last_day = db.Column(db.Date)
+
+class AchievementAward(db.Model):
+    __tablename__ = 'achievement_awards'
+    user_id = db.Column(db.Integer, primary_key=True)
+    rule_key = db.Column(db.String(50), primary_key=True)
+    achievement_id = db.Column(db.Integer)
+    awarded_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UserToiletVisit(db.Model):
+    __tablename__ = 'user_toilet_visits'
+    user_id = db.Column(db.Integer, primary_key=True)
+    toilet_id = db.Column(db.String, primary_key=True)
+
+class HeatmapCell(db.Model):
+    __tablename__ = 'heatmap_cells'
+    # 主鍵順序讓圖磚查詢成為 (layer, zoom) 等值 + quadkey 範圍掃描
+    layer = db.Column(db.String(20), primary_key=True)
+    zoom = db.Column(db.SmallInteger, primary_key=True)
+    quadkey = db.Column(db.String(24), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    bristol = db.Column(db.SmallInteger, primary_key=True)  # 1-7，0 表示未知
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+# 每個使用者每月的合計，百分位數 sketch 由它推算更新前後的值；更新時鎖住這一列，
+# 同一個使用者同一個月的寫入會依序進行
+class UserMonthlyTotals(db.Model):
+    __tablename__ = 'user_monthly_totals'
+    user_id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), primary_key=True)  # YYYY-MM
+    record_count = db.Column(db.Integer, nullable=False, default=0)
+    bristol_normal = db.Column(db.Integer, nullable=False, default=0)  # 第 3、4 型
+    bristol_unknown = db.Column(db.Integer, nullable=False, default=0)
+
+# 各指標、各月份的分位數 sketch（quantiles.py）：每個 bin 一列，各 worker 的寫入直接加減次數
+class MetricSketchBin(db.Model):
+    __tablename__ = 'metric_sketch_bins'
+    metric = db.Column(db.String(30), primary_key=True)
+    period = db.Column(db.String(7), primary_key=True)  # YYYY-MM
+    bin = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+class MediaObject(db.Model):
+    __tablename__ = 'media_objects'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    content_type = db.Column(db.String(50), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    storage_key = db.Column(db.String(200), nullable=False)
+    # pending：縮圖還沒產生；ready：完成（或不需要縮圖）；failed：無法解碼
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    uploaded_by = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_ready', 'status', 'run_at'),
+        db.Index('ix_jobs_ref', 'ref', 'job_id'),
+    )
+    job_id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    ref = db.Column(db.String(100))  # 例如 poop_record:123，查詢某筆資料的工作狀態用
+    payload = db.Column(db.Text)
+    # queued：等待執行；running：已被 worker 領走；done：完成；failed：重試次數用完
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    # queued 時是可以開始執行的時間（重試的 backoff）；running 時是租約到期時間
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    last_error = db.Column(db.Text)
+    result = db.Column(db.Text)  # handler 的回傳值（JSON），例如匯入的筆數
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    idempotency_key = db.Column(db.String(100), primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)
+    resource_id = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 每個使用者的變更序號；遞增時鎖住這一列直到 commit，同一個使用者的序號順序就是 commit 順序
+class SyncCounter(db.Model):
+    __tablename__ = 'sync_counters'
+    user_id = db.Column(db.String, primary_key=True)
+    seq = db.Column(db.BigInteger, nullable=False)
+
+# 每筆同步資料最後一次變更的序號；刪除後保留為 tombstone（deleted=True）
+class SyncChange(db.Model):
+    __tablename__ = 'sync_changes'
+    __table_args__ = (
+        db.Index('ix_sync_changes_user_seq', 'user_id', 'seq'),
+    )
+    kind = db.Column(db.String(30), primary_key=True)
+    resource_id = db.Column(db.String(100), primary_key=True)
+    user_id = db.Column(db.String, nullable=False)
+    seq = db.Column(db.BigInteger, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime)
+
+# 已搬到封存檔（archive_store.py）的月份；path 是 ARCHIVE_ROOT 底下的相對路徑
+class ArchivedPartition(db.Model):
+    __tablename__ = 'archived_partitions'
+    table_name = db.Column(db.String(50), primary_key=True)
+    period = db.Column(db.String(7), primary_key=True)  # YYYY-MM
+    path = db.Column(db.String(200), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    size_bytes = db.Column(db.BigInteger, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
 # ---------------- Routes ----------------
 
-@app.route('/')
+@api.route('/')
 def home():
     return "👋 Welcome to PooPalooza API!"
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def internal_error(error):
     return jsonify({'message': 'Internal server error'}), 500
 
+@api.app_errorhandler(HashingBusy)
+def hashing_busy(error):
+    response = jsonify({'message': 'Server busy, please retry'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# 資料庫斷線、連線池借不到連線或查詢逾時：回 503 讓 App 稍後重試，而不是 500
+@api.app_errorhandler(OperationalError)
+@api.app_errorhandler(PoolTimeoutError)
+def database_unavailable(error):
+    db.session.rollback()
+    if getattr(getattr(error, 'orig', None), 'pgcode', None) == '57014':
+        message = 'Query timed out'
+    else:
+        message = 'Database unavailable, please retry'
+    current_app.logger.warning('%s on %s: %s', type(error).__name__, request.path, error)
+    response = jsonify({'message': message})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@api.app_errorhandler(InvalidPageRequest)
+def invalid_page_request(error):
+    return jsonify({'error': str(error)}), 400
+
+@api.app_errorhandler(UnknownField)
+def unknown_field(error):
+    return jsonify({'error': str(error)}), 400
+
+# 列表回傳格式不變（JSON 陣列），下一頁游標放在 X-Next-Cursor header
+def paginated(result, next_cursor):
+    response = jsonify(result)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+# 只 select 需要的欄位（?fields=a,b,c），回傳 (query, row -> dict)；
+# extra 是分頁排序用、必須 select 但不一定輸出的欄位
+def select_rows(serializer, *extra):
+    columns, to_dict = serializer.select(request.args.get('fields'), extra)
+    return db.session.query(*columns), to_dict
+
+def get_row(serializer, pk_col, value, *extra):
+    query, to_dict = select_rows(serializer, *extra)
+    row = query.filter(pk_col == value).first()
+    return row, (to_dict(row) if row is not None else None)
+
+# 整表匯出：Accept: application/x-ndjson 或 ?stream=1 時用 server-side cursor 逐批串流；
+# archived 是接在後面的封存資料列
+def stream_query(query, serialize, archived=()):
+    use_statement_timeout('stream')
+    rows = (serialize(r) for r in itertools.chain(query.yield_per(STREAM_BATCH_SIZE), archived))
+    return ndjson_response(rows, current_app.json.dumps, request)
+
+# ========== METRICS ==========
+# 每個 endpoint 的延遲分布、每個請求的 SQL 次數與 DB 時間，GET /metrics 以 Prometheus 格式輸出。
+# gunicorn 多個 worker 時要設定 METRICS_DIR：每個 worker 定期寫自己的檔案，/metrics 再加總
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '10'))
+
+metrics = Metrics(directory=os.getenv('METRICS_DIR'))
+metrics.histogram('http_request_duration_seconds', 'Request latency by endpoint, method and status')
+metrics.histogram('db_statements_per_request', 'SQL statements issued per request', COUNT_BUCKETS)
+metrics.histogram('db_time_per_request_seconds', 'Time spent in SQL per request')
+metrics.counter('db_slow_queries_total', 'Statements slower than SLOW_QUERY_MS')
+metrics.counter('db_n_plus_one_total', 'Requests repeating one statement at least N_PLUS_ONE_THRESHOLD times')
+metrics.gauge('db_pool_checked_out', 'Connections currently checked out, per worker')
+metrics.gauge('db_pool_overflow', 'Overflow connections currently open, per worker')
+metrics.counter('db_pool_checkouts_total', 'Connections handed out by the pool')
+metrics.counter('db_pool_wait_seconds_total', 'Time spent waiting for a pooled connection')
+metrics.counter('db_pool_timeouts_total', 'Checkouts that gave up after DB_POOL_TIMEOUT')
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'handle_error')
+def _drop_statement_timer(context):
+    started = context.connection.info.get('statement_start') if context.connection is not None else None
+    if started:
+        started.pop()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+    endpoint = None
+    if has_request_context() and 'metrics_start' in g:
+        endpoint = request.endpoint
+        g.sql_count += 1
+        g.sql_time += elapsed
+        g.sql_statements[statement] = g.sql_statements.get(statement, 0) + 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        metrics.inc('db_slow_queries_total', [('endpoint', endpoint or 'cli')])
+        current_app.logger.warning('slow query %.0f ms on %s: %s', elapsed * 1000, endpoint or '-',
+                           ' '.join(statement.split())[:500])
+
+@api.before_app_request
+def _start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.sql_statements = {}
+
+@api.after_app_request
+def _record_request_metrics(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    labels = [('endpoint', endpoint)]
+    metrics.observe('http_request_duration_seconds',
+                    labels + [('method', request.method), ('status', str(response.status_code))],
+                    time.perf_counter() - start)
+    metrics.observe('db_statements_per_request', labels, g.sql_count)
+    metrics.observe('db_time_per_request_seconds', labels, g.sql_time)
+    statement, count = max(g.sql_statements.items(), key=lambda item: item[1], default=(None, 0))
+    if count >= N_PLUS_ONE_THRESHOLD:
+        metrics.inc('db_n_plus_one_total', labels)
+        current_app.logger.warning('possible N+1 on %s: %d x %s', endpoint, count, ' '.join(statement.split())[:300])
+    _record_pool_metrics()
+    metrics.maybe_flush()
+    return response
+
+def _record_pool_metrics():
+    status = pool_status(db.engine)
+    worker = [('pid', str(status['pid']))]
+    if 'checked_out' in status:
+        metrics.set('db_pool_checked_out', worker, status['checked_out'])
+        metrics.set('db_pool_overflow', worker, status['overflow'])
+    stats = getattr(db.engine.pool, 'stats', None)
+    if stats is not None:
+        # 每個行程自己的累計值；輸出時跨行程加總
+        metrics.set('db_pool_checkouts_total', (), stats.checkouts)
+        metrics.set('db_pool_wait_seconds_total', (), stats.wait_total)
+        metrics.set('db_pool_timeouts_total', (), stats.timeouts)
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    _record_pool_metrics()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ========== JOB QUEUE ==========
+# 耗時的工作（AI 分析、縮圖）寫進 jobs 表，跟觸發它的資料在同一個 transaction commit，
+# 由 `flask worker` 領取執行，重啟也不會遺失。worker 用 FOR UPDATE SKIP LOCKED 取工作，
+# 多個 worker 不會搶同一筆（SQLite 沒有列鎖，只適合單一 worker）。
+# 領走的工作有租約（JOB_VISIBILITY_TIMEOUT 秒），worker 中途掛掉時租約到期就會被別人接手，
+# 所以 handler 必須可以重複執行
+JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+JOB_BACKOFF_BASE = float(os.getenv('JOB_BACKOFF_BASE', '10'))
+JOB_BACKOFF_MAX = float(os.getenv('JOB_BACKOFF_MAX', '3600'))
+
+JOB_HANDLERS = {}
+
+metrics.counter('jobs_processed_total', 'Job attempts by kind and outcome')
+metrics.histogram('job_duration_seconds', 'Time spent running one job attempt')
+
+def job_handler(kind):
+    def decorator(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+def enqueue_job(kind, payload, ref=None, delay=0):
+    """加進目前的 transaction；呼叫端 commit 之後 worker 才看得到。"""
+    job = Job(kind=kind, ref=ref, payload=json.dumps(payload), status='queued', attempts=0,
+              max_attempts=JOB_MAX_ATTEMPTS, run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(job)
+    return job
+
+def job_to_dict(job):
+    return {
+        'job_id': job.job_id,
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'run_at': job.run_at,
+        'last_error': job.last_error,
+        'result': json.loads(job.result) if job.result else None,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+    }
+
+def job_backoff(attempts):
+    delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** (attempts - 1))
+    # 加一點亂數，同一批失敗的工作不會在同一秒一起重試
+    return delay * random.uniform(0.5, 1.0)
+
+def claim_jobs(worker_id, limit):
+    """領取可執行的工作（含租約到期的），回傳 [(job_id, attempts)]。"""
+    now = datetime.utcnow()
+    jobs = (Job.query
+            .filter(Job.status.in_(('queued', 'running')), Job.run_at <= now)
+            .order_by(Job.run_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all())
+    claimed = []
+    for job in jobs:
+        if job.status == 'running' and job.attempts >= job.max_attempts:
+            # 最後一次嘗試時 worker 掛掉
+            job.status = 'failed'
+            job.last_error = job.last_error or 'lease expired'
+            job.finished_at = now
+            continue
+        job.status = 'running'
+        job.attempts += 1
+        job.locked_by = worker_id
+        job.run_at = now + timedelta(seconds=JOB_VISIBILITY_TIMEOUT)
+        claimed.append((job.job_id, job.attempts))
+    db.session.commit()
+    return claimed
+
+def _locked_job(job_id, attempt):
+    # 租約過期後被別的 worker 接手（attempts 變了）就不再回寫
+    job = Job.query.filter_by(job_id=job_id, attempts=attempt).with_for_update().first()
+    return job if job is not None and job.status == 'running' else None
+
+def run_job(job_id, attempt):
+    job = db.session.get(Job, job_id)
+    kind = job.kind
+    start = time.perf_counter()
+    try:
+        handler = JOB_HANDLERS.get(kind)
+        if handler is None:
+            raise LookupError(f'no handler for job kind {kind!r}')
+        result = handler(json.loads(job.payload or '{}'))
+        job = _locked_job(job_id, attempt)
+        if job is None:
+            db.session.rollback()
+            return 'lost'
+        job.status = 'done'
+        job.last_error = None
+        job.result = json.dumps(result) if result is not None else None
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        outcome = 'done'
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning('job %s (%s) attempt %d failed: %s', job_id, kind, attempt, e)
+        job = _locked_job(job_id, attempt)
+        if job is None:
+            db.session.rollback()
+            return 'lost'
+        job.last_error = f'{type(e).__name__}: {e}'[:2000]
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+            outcome = 'failed'
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=job_backoff(job.attempts))
+            outcome = 'retry'
+        db.session.commit()
+    finally:
+        metrics.observe('job_duration_seconds', [('kind', kind)], time.perf_counter() - start)
+    metrics.inc('jobs_processed_total', [('kind', kind), ('outcome', outcome)])
+    metrics.maybe_flush()
+    return outcome
+
+def release_jobs(job_ids):
+    """worker 收到停止訊號時，把已領取但還沒開始的工作還回佇列。"""
+    for job in Job.query.filter(Job.job_id.in_(job_ids), Job.status == 'running'):
+        job.status = 'queued'
+        job.attempts -= 1
+        job.run_at = datetime.utcnow()
+    db.session.commit()
+
+@api.cli.command('worker')
+@click.option('--batch', default=5, show_default=True, help='每次領取的工作數')
+@click.option('--poll-interval', default=1.0, show_default=True, help='佇列是空的時候幾秒後再查')
+@click.option('--once', is_flag=True, help='把目前可執行的工作做完就結束')
+def worker_command(batch, poll_interval, once):
+    """執行 jobs 表裡的背景工作，收到 SIGTERM / SIGINT 會做完手上這筆再結束。"""
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopping.set())
+    click.echo(f'Worker {worker_id} started ({", ".join(sorted(JOB_HANDLERS))})')
+    while not stopping.is_set():
+        claimed = claim_jobs(worker_id, batch)
+        if not claimed:
+            if once:
+                break
+            stopping.wait(poll_interval)
+            continue
+        for i, (job_id, attempt) in enumerate(claimed):
+            if stopping.is_set():
+                release_jobs([job_id for job_id, _ in claimed[i:]])
+                break
+            run_job(job_id, attempt)
+    metrics.maybe_flush()
+    click.echo(f'Worker {worker_id} stopped')
+
 # ========== REGISTER ==========
-@app.route('/register', methods=['POST'])
+@api.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
     username = data.get('username')
@@ -195,49 +767,168 @@ def register():
     if User.query.filter_by(username=username).first():
         return jsonify({'message': 'Username already exists'}), 409
 
-    hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+    hashed_password = hash_password(password)
     new_user = User(username=username, password_hash=hashed_password, email=email)
     db.session.add(new_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 同名的註冊同時進來，由 uq_users_username 擋下
+        db.session.rollback()
+        return jsonify({'message': 'Username already exists'}), 409
 
     return jsonify({'username': new_user.username}), 201
 
 # ========== LOGIN ==========
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
 
     user = User.query.filter_by(username=username).first()
-    if user and check_password_hash(user.password_hash, password):
-        return jsonify({
-            'user_id': user.user_id,
-            'username': user.username,
-            'email': user.email
-        }), 200
+    if user and verify_password(user.password_hash, password):
+        # 舊參數的雜湊趁這次登入（手上有明文）換成目前的設定
+        if needs_rehash(user.password_hash):
+            try:
+                user.password_hash = hash_password(password)
+                db.session.commit()
+            except HashingBusy:
+                pass
+        # 連續登入天數由 App 透過 PUT /users/<id> 維護，這裡只在登入時順便檢查成就
+        if user.consecutive_login_days:
+            set_progress(user.user_id, 'login_streak', user.consecutive_login_days)
+            db.session.commit()
+        return jsonify(dict(
+            token_manager.issue_pair(user.user_id, user_scopes(user)),
+            user_id=user.user_id,
+            username=user.username,
+            email=user.email
+        )), 200
     else:
         return jsonify({'message': 'Invalid username or password'}), 401
 
+# ========== AUTH ==========
+# 無狀態簽章 token：驗證只做 HMAC，不查 users 表。
+# 預設 AUTH_MODE=required：受保護的路由一律要 token。
+# 過渡期可設 AUTH_MODE=optional，讓沒帶 token 的舊版 App 照舊可用（此時不檢查資料擁有者），帶了就一定要有效
+AUTH_MODE = os.getenv('AUTH_MODE', 'required')
+ADMIN_USERNAMES = {name.strip() for name in os.getenv('ADMIN_USERNAMES', '').split(',') if name.strip()}
+
+token_manager = TokenManager(
+    SECRET_KEY,
+    access_ttl=int(os.getenv('ACCESS_TOKEN_TTL', '900')),
+    refresh_ttl=int(os.getenv('REFRESH_TOKEN_TTL', str(30 * 24 * 3600))),
+)
+
+def user_scopes(user):
+    scopes = ['user']
+    if user.username in ADMIN_USERNAMES:
+        scopes.append('admin')
+    return scopes
+
+def require_auth(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.user_id = None
+        g.scopes = ()
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            try:
+                payload = token_manager.verify(header[len('Bearer '):].strip())
+            except InvalidToken as e:
+                return jsonify({'message': str(e)}), 401
+            g.user_id = payload['uid']
+            g.scopes = payload['scp']
+            g.token = payload
+        elif AUTH_MODE == 'required':
+            return jsonify({'message': 'Authentication required'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def is_admin():
+    return 'admin' in g.get('scopes', ())
+
+def can_access(owner_id):
+    if g.get('user_id') is None or is_admin():
+        return True
+    return str(owner_id) == str(g.user_id)
+
+# 一般使用者的列表查詢只能看自己的資料
+def scoped_args():
+    if g.get('user_id') is None or is_admin():
+        return request.args
+    args = request.args.copy()
+    args['user_id'] = str(g.user_id)
+    return args
+
+# 一般使用者新增的資料一律掛在自己名下
+def scoped_data(data, cast=int):
+    if g.get('user_id') is None or is_admin():
+        return data
+    return dict(data, user_id=cast(g.user_id))
+
+def forbidden():
+    return jsonify({'message': 'Forbidden'}), 403
+
+# 路由參數 param 是資料擁有者時檢查權限；要放在 response_cache.cached 外面，快取命中也會先檢查
+def require_access(param):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not can_access(kwargs[param]):
+                return forbidden()
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@api.route('/token/refresh', methods=['POST'])
+def refresh_token():
+    data = request.get_json(silent=True) or {}
+    try:
+        payload = token_manager.verify(data.get('refresh_token') or '', kind='refresh')
+    except InvalidToken as e:
+        return jsonify({'message': str(e)}), 401
+    # refresh 不常發生，這裡才確認一次使用者還在
+    user = db.session.get(User, payload['uid'])
+    if not user:
+        return jsonify({'message': 'User no longer exists'}), 401
+    token_manager.revoke(payload)
+    return jsonify(token_manager.issue_pair(user.user_id, user_scopes(user)))
+
+@api.route('/logout', methods=['POST'])
+@require_auth
+def logout():
+    if g.get('token'):
+        token_manager.revoke(g.token)
+    data = request.get_json(silent=True) or {}
+    if data.get('refresh_token'):
+        try:
+            token_manager.revoke(token_manager.verify(data['refresh_token'], kind='refresh'))
+        except InvalidToken:
+            pass
+    return jsonify({'message': 'Logged out'})
+
+# ========== ADMIN ==========
+# 連線池即時狀態；用來對照 worker 數調整 DB_POOL_SIZE，並在借不到連線前先發現
+@api.route('/admin/db/pool', methods=['GET'])
+@require_auth
+def get_db_pool_status():
+    if not is_admin():
+        return forbidden()
+    return jsonify(dict(pool_status(db.engine), statement_timeouts_ms=STATEMENT_TIMEOUTS))
+
 # ========== USERS ==========
-@app.route('/users', methods=['GET'])
+user_serializer = RowSerializer(User)
+
+@api.route('/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    result = []
-    for u in users:
-        result.append({
-            "user_id": u.user_id,
-            "username": u.username,
-            "email": u.email,
-            "password_hash": u.password_hash,
-            "created_at": u.created_at,
-            "last_login": u.last_login,
-            "consecutive_login_days": u.consecutive_login_days,
-            "last_login_date": u.last_login_date
-        })
-    return jsonify(result)
+    query, to_dict = select_rows(user_serializer, User.created_at, User.user_id)
+    users, next_cursor = paginate(query, User.created_at, User.user_id, request.args,
+                                  filters={'username': (User.username, str)})
+    return paginated([to_dict(u) for u in users], next_cursor)
 
-@app.route('/users', methods=['POST'])
+@api.route('/users', methods=['POST'])
 def create_user():
     data = request.get_json()
     username = data['username']
@@ -245,7 +936,7 @@ def create_user():
     password = data['password']
 
     # 加密密碼（避免使用 scrypt，避免某些系統出錯）
-    hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+    hashed_password = hash_password(password)
 
     new_user = User(
         username=username,
@@ -255,11 +946,15 @@ def create_user():
     )
 
     db.session.add(new_user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "使用者名稱已存在"}), 409
 
     return jsonify({"message": "User created successfully"}), 201
 
-@app.route('/users/<int:id>', methods=['PUT'])
+@api.route('/users/<int:id>', methods=['PUT'])
 def update_user(id):
     user = User.query.get(id)
     if not user:
@@ -273,10 +968,11 @@ def update_user(id):
     user.consecutive_login_days = data.get('consecutive_login_days', user.consecutive_login_days)
     user.last_login_date = datetime.utcnow().date()
 
+    set_progress(user.user_id, 'login_streak', user.consecutive_login_days or 0)
     db.session.commit()
     return jsonify({"success": True, "msg": "使用者更新成功"})
 
-@app.route('/users/<int:id>', methods=['DELETE'])
+@api.route('/users/<int:id>', methods=['DELETE'])
 def delete_user(id):
     user = User.query.get(id)
     if not user:
@@ -288,35 +984,26 @@ def delete_user(id):
 
 # ========== ACHIEVEMENTS ==========
 
-@app.route('/achievements', methods=['GET'])
-def get_achievements():
-    achievements = Achievement.query.all()
-    result = []
-    for a in achievements:
-        result.append({
-            "achievement_id": a.achievement_id,
-            "user_id": a.user_id,
-            "achievement_name": a.achievement_name,
-            "achievement_description": a.achievement_description,
-            "achieved_at": a.achieved_at
-        })
-    return jsonify(result)
+achievement_serializer = RowSerializer(Achievement)
 
-@app.route('/achievements/<int:user_id>', methods=['GET'])
+@api.route('/achievements', methods=['GET'])
+def get_achievements():
+    query, to_dict = select_rows(achievement_serializer, Achievement.achieved_at, Achievement.achievement_id)
+    achievements, next_cursor = paginate(
+        query, Achievement.achieved_at, Achievement.achievement_id, request.args,
+        filters={'user_id': (Achievement.user_id, int)})
+    return paginated([to_dict(a) for a in achievements], next_cursor)
+
+@api.route('/achievements/<int:user_id>', methods=['GET'])
+@require_auth
+@require_access('user_id')
+@response_cache.cached(ttl=120, tags=lambda user_id: [f'achievements:{user_id}'])
 def get_achievements_by_user(user_id):
-    achievements = Achievement.query.filter_by(user_id=user_id).all()
-    result = []
-    for a in achievements:
-        result.append({
-            "achievement_id": a.achievement_id,
-            "user_id": a.user_id,
-            "achievement_name": a.achievement_name,
-            "achievement_description": a.achievement_description,
-            "achieved_at": a.achieved_at
-        })
-    return jsonify(result)
+    query, to_dict = select_rows(achievement_serializer)
+    achievements = query.filter(Achievement.user_id == user_id).all()
+    return jsonify([to_dict(a) for a in achievements])
 
-@app.route('/achievements', methods=['POST'])
+@api.route('/achievements', methods=['POST'])
 def create_achievement():
     data = request.json
     achievement = Achievement(
@@ -327,9 +1014,10 @@ def create_achievement():
     )
     db.session.add(achievement)
     db.session.commit()
+    response_cache.invalidate(f'achievements:{achievement.user_id}')
     return jsonify({"success": True, "msg": "成就建立成功"})
 
-@app.route('/achievements/<int:id>', methods=['PUT'])
+@api.route('/achievements/<int:id>', methods=['PUT'])
 def update_achievement(id):
     achievement = Achievement.query.get(id)
     if not achievement:
@@ -341,9 +1029,10 @@ def update_achievement(id):
     achievement.achieved_at = datetime.utcnow()
 
     db.session.commit()
+    response_cache.invalidate(f'achievements:{achievement.user_id}')
     return jsonify({"success": True, "msg": "成就更新成功"})
 
-@app.route('/achievements/<int:id>', methods=['DELETE'])
+@api.route('/achievements/<int:id>', methods=['DELETE'])
 def delete_achievement(id):
     achievement = Achievement.query.get(id)
     if not achievement:
@@ -351,27 +1040,206 @@ def delete_achievement(id):
 
     db.session.delete(achievement)
     db.session.commit()
+    response_cache.invalidate(f'achievements:{achievement.user_id}')
     return jsonify({"success": True, "msg": "成就已刪除"})
 
+# ========== ACHIEVEMENT ENGINE ==========
+# 規則定義在 achievement_rules.py。寫入事件（便便紀錄、打卡、登入）只更新
+# achievement_progress 裡的計數器，計數器「跨過」門檻時才頒發，不會重掃歷史資料。
+# achievement_awards 以 (user_id, rule_key) 為主鍵，保證同一條規則只頒發一次
+def _as_user_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def evaluate_rules(user_id, counter, old_value, new_value):
+    for rule in RULES_BY_COUNTER.get(counter, ()):
+        if old_value < rule.threshold <= new_value:
+            award_achievement(user_id, rule)
+
+def award_achievement(user_id, rule):
+    table = AchievementAward.__table__
+    insert = dialect_insert(db.session)
+    result = db.session.execute(
+        insert(table).values(user_id=user_id, rule_key=rule.key, awarded_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.rule_key]))
+    if result.rowcount != 1:
+        return False
+    achievement = Achievement(
+        user_id=user_id,
+        achievement_name=rule.name,
+        achievement_description=rule.description,
+        achieved_at=datetime.utcnow()
+    )
+    db.session.add(achievement)
+    db.session.flush()
+    db.session.execute(table.update().where(table.c.user_id == user_id, table.c.rule_key == rule.key)
+                       .values(achievement_id=achievement.achievement_id))
+    after_commit(response_cache.invalidate, f'achievements:{user_id}')
+    return True
+
+def bump_progress(user_id, counter, delta=1):
+    table = AchievementProgress.__table__
+    insert = dialect_insert(db.session)
+    stmt = insert(table).values(user_id=user_id, counter=counter, value=delta)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.counter],
+        set_={'value': table.c.value + stmt.excluded.value},
+    ).returning(table.c.value)
+    new_value = db.session.execute(stmt).scalar()
+    evaluate_rules(user_id, counter, new_value - delta, new_value)
+
+def _locked_progress(user_id, counter):
+    # 還沒有這一列時 FOR UPDATE 鎖不到東西，先 insert（已存在就略過）再鎖，同時第一次寫入也不會撞主鍵
+    table = AchievementProgress.__table__
+    insert = dialect_insert(db.session)
+    db.session.execute(insert(table).values(user_id=user_id, counter=counter, value=0)
+                       .on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.counter]))
+    return AchievementProgress.query.filter_by(user_id=user_id, counter=counter).with_for_update().one()
+
+def set_progress(user_id, counter, value):
+    progress = _locked_progress(user_id, counter)
+    old_value = progress.value or 0
+    if value != old_value:
+        progress.value = value
+        evaluate_rules(user_id, counter, old_value, value)
+
+def record_toilet_visit(user_id, toilet_id):
+    user_id = _as_user_id(user_id)
+    if user_id is None or not toilet_id:
+        return
+    table = UserToiletVisit.__table__
+    insert = dialect_insert(db.session)
+    result = db.session.execute(
+        insert(table).values(user_id=user_id, toilet_id=toilet_id)
+        .on_conflict_do_nothing(index_elements=[table.c.user_id, table.c.toilet_id]))
+    if result.rowcount == 1:
+        bump_progress(user_id, 'distinct_toilets')
+
+def advance_day_streak(progress, day):
+    # 同一天不重複計；隔天接續；中斷就重新從 1 開始；比目前更早的日子（補傳的舊資料）忽略
+    if progress.last_day is not None and day <= progress.last_day:
+        return
+    if progress.last_day is not None and day == progress.last_day + timedelta(days=1):
+        progress.value = (progress.value or 0) + 1
+    else:
+        progress.value = 1
+    progress.last_day = day
+
+def on_poop_record_achievements(record):
+    if record.user_id is None:
+        return
+    bump_progress(record.user_id, 'poop_records')
+    contribution = poop_record_contribution(record)
+    if contribution is not None and bristol_bucket(record.bristol_scale) == 'bristol_4':
+        progress = _locked_progress(record.user_id, 'bristol4_streak')
+        old_value = progress.value or 0
+        advance_day_streak(progress, contribution[1])
+        if progress.value > old_value:
+            evaluate_rules(record.user_id, 'bristol4_streak', old_value, progress.value)
+
+achievements_cli = AppGroup('achievements', help='成就引擎維護指令')
+
+@achievements_cli.command('reevaluate')
+@click.option('--user-id', type=int, help='只重新檢查單一使用者')
+def reevaluate_achievements_command(user_id):
+    """規則新增或調整後，依現有計數器補發成就（不重掃歷史資料）。"""
+    query = AchievementProgress.query
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    awarded = 0
+    for progress in query.all():
+        for rule in RULES_BY_COUNTER.get(progress.counter, ()):
+            if progress.value >= rule.threshold and award_achievement(progress.user_id, rule):
+                awarded += 1
+    db.session.commit()
+    click.echo(f'Awarded {awarded} achievements')
+
+@achievements_cli.command('backfill')
+def backfill_achievements_command():
+    """第一次上線時從歷史資料建立計數器，再依規則補發。"""
+    progress = {}
+
+    def set_counter(uid, counter, value, last_day=None):
+        progress[(uid, counter)] = (value, last_day)
+
+    for uid, count in db.session.query(PoopRecord.user_id, db.func.count()) \
+            .filter(PoopRecord.user_id.isnot(None)).group_by(PoopRecord.user_id):
+        set_counter(uid, 'poop_records', count)
+
+    for uid, days in db.session.query(User.user_id, User.consecutive_login_days) \
+            .filter(User.consecutive_login_days > 0):
+        set_counter(uid, 'login_streak', days)
+
+    visits = set()
+    for uid, toilet_id in db.session.query(ToiletCheckin.user_id, ToiletCheckin.public_toilet_id).distinct():
+        if uid is not None and toilet_id:
+            visits.add((uid, toilet_id))
+    for uid, toilet_id in db.session.query(PublicCheckin.user_id, PublicCheckin.bathroom_id).distinct():
+        if _as_user_id(uid) is not None and toilet_id:
+            visits.add((_as_user_id(uid), toilet_id))
+    visit_counts = {}
+    for uid, _ in visits:
+        visit_counts[uid] = visit_counts.get(uid, 0) + 1
+    for uid, count in visit_counts.items():
+        set_counter(uid, 'distinct_toilets', count)
+
+    # 布里斯托第 4 型連續天數：記下目前的連續狀態，以及歷史上最長的一段
+    best_streak = {}
+    streaks = {}
+    rows = db.session.query(PoopRecord.user_id, PoopRecord.record_time, PoopRecord.bristol_scale,
+                            PoopRecord.has_blood, PoopRecord.has_mucus) \
+        .filter(PoopRecord.user_id.isnot(None), PoopRecord.record_time.isnot(None)) \
+        .order_by(PoopRecord.user_id, PoopRecord.record_time)
+    for row in rows.yield_per(STREAM_BATCH_SIZE):
+        if bristol_bucket(row.bristol_scale) != 'bristol_4':
+            continue
+        state = streaks.setdefault(row.user_id, AchievementProgress(value=0))
+        advance_day_streak(state, poop_record_contribution(row)[1])
+        best_streak[row.user_id] = max(best_streak.get(row.user_id, 0), state.value)
+    for uid, state in streaks.items():
+        set_counter(uid, 'bristol4_streak', state.value, state.last_day)
+
+    table = AchievementProgress.__table__
+    db.session.execute(table.delete())
+    db.session.execute(UserToiletVisit.__table__.delete())
+    rows = [
+        {'user_id': uid, 'counter': counter, 'value': value, 'last_day': last_day}
+        for (uid, counter), (value, last_day) in progress.items()
+    ]
+    for start in range(0, len(rows), 1000):
+        db.session.execute(table.insert(), rows[start:start + 1000])
+    visit_rows = [{'user_id': uid, 'toilet_id': toilet_id} for uid, toilet_id in visits]
+    for start in range(0, len(visit_rows), 1000):
+        db.session.execute(UserToiletVisit.__table__.insert(), visit_rows[start:start + 1000])
+
+    awarded = 0
+    for (uid, counter), (value, _) in progress.items():
+        if counter == 'bristol4_streak':
+            value = best_streak.get(uid, value)
+        for rule in RULES_BY_COUNTER.get(counter, ()):
+            if value >= rule.threshold and award_achievement(uid, rule):
+                awarded += 1
+    db.session.commit()
+    click.echo(f'Rebuilt {len(rows)} counters, awarded {awarded} achievements')
+
+api.cli.add_command(achievements_cli)
+
 # ========== CHECKIN ==========
 
 # ✅ GET /checkin
-@app.route('/checkin', methods=['GET'])
+checkin_serializer = RowSerializer(Checkin)
+
+@api.route('/checkin', methods=['GET'])
 def get_checkin():
-    checkin = Checkin.query.all()
-    result = []
-    for c in checkin:
-        result.append({
-            "id": c.id,
-            "user": c.user,
-            "location": c.location,
-            "emoji": c.emoji,
-            "note": c.note
-        })
-    return jsonify(result)
+    query, to_dict = select_rows(checkin_serializer, Checkin.id)
+    checkin, next_cursor = paginate(query, None, Checkin.id, request.args,
+                                    filters={'user': (Checkin.user, str)})
+    return paginated([to_dict(c) for c in checkin], next_cursor)
 
 # ✅ PUT /checkin/<id>
-@app.route('/checkin/<int:id>', methods=['PUT'])
+@api.route('/checkin/<int:id>', methods=['PUT'])
 def update_checkin(id):
     checkin = Checkin.query.get(id)
     if not checkin:
@@ -387,7 +1255,7 @@ def update_checkin(id):
     return jsonify({"success": True, "msg": "打卡已更新"})
 
 # ✅ POST /checkin
-@app.route('/checkin', methods=['POST'])
+@api.route('/checkin', methods=['POST'])
 def create_checkin():
     data = request.json
     checkin = Checkin(
@@ -401,7 +1269,7 @@ def create_checkin():
     return jsonify({"success": True, "msg": "打卡成功"})
 
 # ✅ DELETE /checkin/<id>
-@app.route('/checkin/<int:id>', methods=['DELETE'])
+@api.route('/checkin/<int:id>', methods=['DELETE'])
 def delete_checkin(id):
     checkin = Checkin.query.get(id)
     if not checkin:
@@ -413,37 +1281,26 @@ def delete_checkin(id):
 
 # ========== ANALYSIS RESULTS ==========
 
-@app.route('/analysis_results', methods=['GET'])
-def get_all_analysis_results():
-    results = AnalysisResult.query.all()
-    return jsonify([
-        {
-            "analysis_id": r.analysis_id,
-            "record_id": r.record_id,
-            "user_id": r.user_id,
-            "analysis_time": r.analysis_time,
-            "ai_diagnosis": r.ai_diagnosis,
-            "health_score": r.health_score,
-            "recommendations": r.recommendations
-        } for r in results
-    ])
+analysis_result_serializer = RowSerializer(AnalysisResult)
 
-@app.route('/analysis_results/<int:id>', methods=['GET'])
+@api.route('/analysis_results', methods=['GET'])
+def get_all_analysis_results():
+    query, to_dict = select_rows(analysis_result_serializer, AnalysisResult.analysis_time, AnalysisResult.analysis_id)
+    results, next_cursor = paginate(
+        query, AnalysisResult.analysis_time, AnalysisResult.analysis_id, request.args,
+        filters={'user_id': (AnalysisResult.user_id, int),
+                 'record_id': (AnalysisResult.record_id, int)})
+    return paginated([to_dict(r) for r in results], next_cursor)
+
+@api.route('/analysis_results/<int:id>', methods=['GET'])
+@response_cache.cached(ttl=300, tags=lambda id: [f'analysis:{id}'])
 def get_analysis_result(id):
-    r = AnalysisResult.query.get(id)
-    if not r:
+    _, result = get_row(analysis_result_serializer, AnalysisResult.analysis_id, id)
+    if result is None:
         return jsonify({"error": "分析結果不存在"}), 404
-    return jsonify({
-        "analysis_id": r.analysis_id,
-        "record_id": r.record_id,
-        "user_id": r.user_id,
-        "analysis_time": r.analysis_time,
-        "ai_diagnosis": r.ai_diagnosis,
-        "health_score": r.health_score,
-        "recommendations": r.recommendations
-    })
+    return jsonify(result)
 
-@app.route('/analysis_results', methods=['POST'])
+@api.route('/analysis_results', methods=['POST'])
 def create_analysis_result():
     data = request.json
     new_result = AnalysisResult(
@@ -455,72 +1312,147 @@ def create_analysis_result():
         recommendations=data.get('recommendations')
     )
     db.session.add(new_result)
+    apply_health_score_sketch(new_result, 1)
     db.session.commit()
     return jsonify({"success": True, "msg": "分析結果建立成功"})
 
-@app.route('/analysis_results/<int:id>', methods=['PUT'])
+@api.route('/analysis_results/<int:id>', methods=['PUT'])
 def update_analysis_result(id):
     r = AnalysisResult.query.get(id)
     if not r:
         return jsonify({"error": "分析結果不存在"}), 404
 
     data = request.json
+    apply_health_score_sketch(r, -1)
     r.record_id = data.get('record_id', r.record_id)
     r.user_id = data.get('user_id', r.user_id)
     r.analysis_time = datetime.utcnow()
     r.ai_diagnosis = data.get('ai_diagnosis', r.ai_diagnosis)
     r.health_score = data.get('health_score', r.health_score)
     r.recommendations = data.get('recommendations', r.recommendations)
+    apply_health_score_sketch(r, 1)
 
     db.session.commit()
+    response_cache.invalidate(f'analysis:{id}')
     return jsonify({"success": True, "msg": "分析結果更新成功"})
 
-@app.route('/analysis_results/<int:id>', methods=['DELETE'])
+@api.route('/analysis_results/<int:id>', methods=['DELETE'])
 def delete_analysis_result(id):
     r = AnalysisResult.query.get(id)
     if not r:
         return jsonify({"error": "分析結果不存在"}), 404
+    apply_health_score_sketch(r, -1)
     db.session.delete(r)
     db.session.commit()
+    response_cache.invalidate(f'analysis:{id}')
     return jsonify({"success": True, "msg": "分析結果已刪除"})
 
+# ---- 非同步分析：新增糞便紀錄時排一個 analyze_poop_record 工作，由 worker 呼叫 analyzer ----
+# ANALYZER_URL 設定時呼叫外部模型服務，否則用本機的規則 stub
+analyzer = analyzer_from_env()
+
+def _clip(value, length):
+    return str(value)[:length] if value is not None else None
+
+def enqueue_poop_record_analysis(record):
+    if record.record_id is None:
+        db.session.flush()
+    return enqueue_job('analyze_poop_record', {'record_id': record.record_id},
+                       ref=f'poop_record:{record.record_id}')
+
+@job_handler('analyze_poop_record')
+def analyze_poop_record_job(payload):
+    record_id = payload['record_id']
+    record = db.session.get(PoopRecord, record_id)
+    if record is None:
+        return  # 紀錄已被刪除
+    data = {c.name: getattr(record, c.name) for c in PoopRecord.__table__.columns}
+    # 呼叫模型服務可能要好幾秒，期間不佔住資料庫連線
+    db.session.rollback()
+    result = analyzer.analyze(data)
+
+    record = db.session.get(PoopRecord, record_id)
+    if record is None:
+        return
+    analysis = AnalysisResult.query.filter_by(record_id=record_id).first()
+    if analysis is None:
+        analysis = AnalysisResult(record_id=record_id, user_id=record.user_id)
+        db.session.add(analysis)
+    else:
+        after_commit(response_cache.invalidate, f'analysis:{analysis.analysis_id}')
+        apply_health_score_sketch(analysis, -1)
+    analysis.analysis_time = datetime.utcnow()
+    analysis.ai_diagnosis = result.get('ai_diagnosis')
+    analysis.health_score = result.get('health_score')
+    analysis.recommendations = result.get('recommendations')
+    apply_health_score_sketch(analysis, 1)
+    record.ai_poop_type = _clip(result.get('ai_poop_type'), 20)
+    record.ai_poop_color = _clip(result.get('ai_poop_color'), 20)
+    record.ai_poop_volume = _clip(result.get('ai_poop_volume'), 20)
+    record.ai_diagnosis_summary = result.get('ai_diagnosis')
+    record.health_recommendations = result.get('recommendations')
+    record_sync_change('poop_record', record.user_id, record.record_id)
+
+def analysis_status(record_id):
+    job = Job.query.filter_by(ref=f'poop_record:{record_id}').order_by(Job.job_id.desc()).first()
+    _, analysis = get_row(analysis_result_serializer, AnalysisResult.record_id, record_id)
+    if job is not None:
+        status = job.status
+    else:
+        status = 'done' if analysis is not None else 'none'
+    return {
+        'record_id': record_id,
+        'status': status,
+        'job': job_to_dict(job) if job is not None else None,
+        'analysis': analysis,
+    }
+
+@api.route('/poop-records/<int:record_id>/analysis', methods=['GET'])
+@require_auth
+def get_poop_record_analysis(record_id):
+    record = db.session.get(PoopRecord, record_id)
+    if not record:
+        return jsonify({"error": "紀錄不存在"}), 404
+    if not can_access(record.user_id):
+        return forbidden()
+    return jsonify(analysis_status(record_id))
+
+@api.route('/poop-records/<int:record_id>/analysis', methods=['POST'])
+@require_auth
+def reanalyze_poop_record(record_id):
+    record = db.session.get(PoopRecord, record_id)
+    if not record:
+        return jsonify({"error": "紀錄不存在"}), 404
+    if not can_access(record.user_id):
+        return forbidden()
+    pending = Job.query.filter(Job.ref == f'poop_record:{record_id}',
+                               Job.status.in_(('queued', 'running'))).first()
+    if pending is None:
+        enqueue_poop_record_analysis(record)
+        db.session.commit()
+    return jsonify(analysis_status(record_id)), 202
+
 # ========== POOP LOCATIONS ==========
 
-@app.route('/poop_locations', methods=['GET'])
-def get_poop_locations():
-    locations = PoopLocation.query.all()
-    return jsonify([
-        {
-            "location_id": l.location_id,
-            "user_id": l.user_id,
-            "record_id": l.record_id,
-            "record_time": l.record_time,
-            "latitude": l.latitude,
-            "longitude": l.longitude,
-            "location_name": l.location_name,
-            "notes": l.notes,
-            "expression_text": l.expression_text
-        } for l in locations
-    ])
+poop_location_serializer = RowSerializer(PoopLocation)
 
-@app.route('/poop_locations/<int:id>', methods=['GET'])
+@api.route('/poop_locations', methods=['GET'])
+def get_poop_locations():
+    query, to_dict = select_rows(poop_location_serializer, PoopLocation.record_time, PoopLocation.location_id)
+    locations, next_cursor = paginate(
+        query, PoopLocation.record_time, PoopLocation.location_id, request.args,
+        filters={'user_id': (PoopLocation.user_id, int),
+                 'record_id': (PoopLocation.record_id, int)})
+    return paginated([to_dict(l) for l in locations], next_cursor)
+
+@api.route('/poop_locations/<int:id>', methods=['GET'])
 def get_poop_location(id):
-    l = PoopLocation.query.get(id)
-    if not l:
+    _, result = get_row(poop_location_serializer, PoopLocation.location_id, id)
+    if result is None:
         return jsonify({"error": "紀錄不存在"}), 404
-    return jsonify({
-        "location_id": l.location_id,
-        "user_id": l.user_id,
-        "record_id": l.record_id,
-        "record_time": l.record_time,
-        "latitude": l.latitude,
-        "longitude": l.longitude,
-        "location_name": l.location_name,
-        "notes": l.notes,
-        "expression_text": l.expression_text
-    })
+    return jsonify(result)
 
-@app.route('/poop_locations', methods=['POST'])
+@api.route('/poop_locations', methods=['POST'])
 def create_poop_location():
     data = request.json
     location = PoopLocation(
@@ -534,16 +1466,18 @@ def create_poop_location():
         expression_text=data.get('expression_text')
     )
     db.session.add(location)
+    apply_heatmap(poop_location_heat(location), 1)
     db.session.commit()
     return jsonify({"success": True, "msg": "地點紀錄新增成功"})
 
-@app.route('/poop_locations/<int:id>', methods=['PUT'])
+@api.route('/poop_locations/<int:id>', methods=['PUT'])
 def update_poop_location(id):
     location = PoopLocation.query.get(id)
     if not location:
         return jsonify({"error": "地點紀錄不存在"}), 404
 
     data = request.json
+    old_heat = poop_location_heat(location)
     location.user_id = data.get('user_id', location.user_id)
     location.record_id = data.get('record_id', location.record_id)
     location.latitude = data.get('latitude', location.latitude)
@@ -552,51 +1486,158 @@ def update_poop_location(id):
     location.notes = data.get('notes', location.notes)
     location.expression_text = data.get('expression_text', location.expression_text)
     location.record_time = datetime.utcnow()
+    update_heatmap(old_heat, poop_location_heat(location))
 
     db.session.commit()
     return jsonify({"success": True, "msg": "地點紀錄更新成功"})
 
-@app.route('/poop_locations/<int:id>', methods=['DELETE'])
+@api.route('/poop_locations/<int:id>', methods=['DELETE'])
 def delete_poop_location(id):
     location = PoopLocation.query.get(id)
     if not location:
         return jsonify({"error": "地點紀錄不存在"}), 404
 
+    apply_heatmap(poop_location_heat(location), -1)
     db.session.delete(location)
     db.session.commit()
     return jsonify({"success": True, "msg": "地點紀錄已刪除"})
 
+# ========== MEDIA ==========
+# 照片、錄音直接以 request body 串流上傳（Content-Type 為檔案類型），邊讀邊寫進 blob store，
+# 以 SHA-256 當 key 去重。縮圖由 worker 的 media_variants 工作產生，網址由雜湊決定，上傳當下就能寫進紀錄
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', str(20 * 1024 * 1024)))
+media_store = store_from_env()
+
+class UnknownMedia(ValueError):
+    pass
+
+@api.app_errorhandler(UnknownMedia)
+def unknown_media(error):
+    return jsonify({'error': str(error)}), 400
+
+def media_to_dict(media):
+    variants = {}
+    if supports_variants(media.content_type):
+        variants = {name: media_store.url(variant_key(media.sha256, name)) for name in VARIANTS}
+    return {
+        'id': media.sha256,
+        'content_type': media.content_type,
+        'size': media.size,
+        'status': media.status,
+        'url': media_store.url(media.storage_key),
+        'variants': variants,
+    }
+
+# 資料帶 image_media_id 時，image_url 換成中尺寸、image_thumbnail_url 換成縮圖的網址
+def with_media_urls(data):
+    media_id = data.get('image_media_id') if data else None
+    if not media_id:
+        return data
+    media = db.session.get(MediaObject, media_id)
+    if media is None:
+        raise UnknownMedia(f'unknown image_media_id: {media_id}')
+    info = media_to_dict(media)
+    return dict(data, image_url=info['variants'].get('medium', info['url']),
+                image_thumbnail_url=info['variants'].get('thumb'))
+
+@job_handler('media_variants')
+def generate_media_variants(payload):
+    sha256 = payload['sha256']
+    media = db.session.get(MediaObject, sha256)
+    if media is None or media.status == 'ready':
+        return
+    try:
+        make_variants(media_store, sha256, media.storage_key)
+        media.status = 'ready'
+    except DECODE_ERRORS:
+        # 無法解碼的檔案重試也沒用；之後可用 flask media regenerate --failed 重做。
+        # 儲存空間或系統的暫時性錯誤則照常丟出，由 job queue 重試
+        current_app.logger.exception('failed to generate variants for %s', sha256)
+        media.status = 'failed'
+
+@api.route('/media', methods=['POST'])
+@require_auth
+def upload_media():
+    content_type = request.mimetype
+    if content_type not in EXTENSIONS:
+        return jsonify({'error': 'Unsupported media type'}), 415
+    if request.content_length is not None and request.content_length > MEDIA_MAX_BYTES:
+        return jsonify({'error': 'File too large'}), 413
+    try:
+        sha256, key, size, _ = save_stream(media_store, request.stream, content_type, MEDIA_MAX_BYTES)
+    except UploadTooLarge:
+        return jsonify({'error': 'File too large'}), 413
+
+    media = db.session.get(MediaObject, sha256)
+    status = 200
+    if media is None:
+        media = MediaObject(sha256=sha256, content_type=content_type, size=size, storage_key=key,
+                            status='pending' if supports_variants(content_type) else 'ready',
+                            uploaded_by=g.get('user_id'))
+        db.session.add(media)
+        if media.status == 'pending':
+            enqueue_job('media_variants', {'sha256': sha256}, ref=f'media:{sha256}')
+        try:
+            db.session.commit()
+            status = 201
+        except IntegrityError:
+            # 同一個檔案同時上傳兩次
+            db.session.rollback()
+            media = db.session.get(MediaObject, sha256)
+    return jsonify(media_to_dict(media)), status
+
+@api.route('/media/<string:media_id>', methods=['GET'])
+def get_media(media_id):
+    media = db.session.get(MediaObject, media_id)
+    if not media:
+        return jsonify({'error': 'Media not found'}), 404
+    return jsonify(media_to_dict(media))
+
+# 本機 backend 的檔案；正式環境建議交給 CDN / nginx。內容以雜湊定址，可以永久快取
+@api.route('/media/files/<path:key>', methods=['GET'])
+def get_media_file(key):
+    return send_from_directory(media_store.root, key, max_age=365 * 24 * 3600)
+
+media_cli = AppGroup('media', help='上傳檔案維護指令')
+
+@media_cli.command('regenerate')
+@click.option('--failed', is_flag=True, help='連同先前失敗的也重試')
+def regenerate_media_command(failed):
+    """直接補產生尚未完成的縮圖（例如 media_variants 工作已重試到放棄）。"""
+    statuses = ['pending', 'failed'] if failed else ['pending']
+    ids = [m.sha256 for m in MediaObject.query.filter(MediaObject.status.in_(statuses))]
+    for sha256 in ids:
+        db.session.get(MediaObject, sha256).status = 'pending'
+        generate_media_variants({'sha256': sha256})
+        db.session.commit()
+    click.echo(f'Processed {len(ids)} media objects')
+
+api.cli.add_command(media_cli)
+
 # ========== POOP RECORDS ==========
-@app.route('/poop-records', methods=['GET'])
-def get_poop_records():
-    records = PoopRecord.query.all()
-    result = []
-    for r in records:
-        result.append({
-            "record_id": r.record_id,
-            "user_id": r.user_id,
-            "record_time": r.record_time,
-            "bristol_scale": r.bristol_scale,
-            "color": r.color,
-            "consistency": r.consistency,
-            "volume": r.volume,
-            "odor": r.odor,
-            "has_blood": r.has_blood,
-            "has_mucus": r.has_mucus,
-            "image_url": r.image_url,
-            "ai_poop_type": r.ai_poop_type,
-            "ai_poop_color": r.ai_poop_color,
-            "ai_poop_volume": r.ai_poop_volume,
-            "ai_diagnosis_summary": r.ai_diagnosis_summary,
-            "health_recommendations": r.health_recommendations,
-            "health_indicators": r.health_indicators
-        })
-    return jsonify(result)
+POOP_RECORD_FILTERS = {
+    'user_id': (PoopRecord.user_id, int),
+    'bristol_type': (PoopRecord.bristol_scale, str),
+}
 
-@app.route('/poop-records', methods=['POST'])
-def create_poop_record():
-    data = request.json
-    record = PoopRecord(
+poop_record_serializer = RowSerializer(PoopRecord)
+
+@api.route('/poop-records', methods=['GET'])
+@require_auth
+def get_poop_records():
+    args = scoped_args()
+    query, to_dict = select_rows(poop_record_serializer, PoopRecord.record_time, PoopRecord.record_id)
+    if wants_stream(request):
+        archived = archived_rows('poop_records', poop_record_serializer, args, POOP_RECORD_FILTERS)
+        query = apply_filters(query, PoopRecord.record_time, args, POOP_RECORD_FILTERS)
+        return stream_query(query.order_by(PoopRecord.record_id), to_dict, archived)
+    records, next_cursor = paginate_archived(
+        'poop_records', poop_record_serializer, query, to_dict, args, POOP_RECORD_FILTERS)
+    return paginated(records, next_cursor)
+
+def build_poop_record(data):
+    data = with_media_urls(data)
+    return PoopRecord(
         user_id=data['user_id'],
         record_time=datetime.utcnow(),
         bristol_scale=data.get('bristol_scale'),
@@ -607,6 +1648,7 @@ def create_poop_record():
         has_blood=data.get('has_blood', False),
         has_mucus=data.get('has_mucus', False),
         image_url=data.get('image_url'),
+        image_thumbnail_url=data.get('image_thumbnail_url'),
         ai_poop_type=data.get('ai_poop_type'),
         ai_poop_color=data.get('ai_poop_color'),
         ai_poop_volume=data.get('ai_poop_volume'),
@@ -614,17 +1656,39 @@ def create_poop_record():
         health_recommendations=data.get('health_recommendations'),
         health_indicators=data.get('health_indicators')
     )
+
+@api.route('/poop-records', methods=['POST'])
+@require_auth
+def create_poop_record():
+    data = scoped_data(request.json)
+    record = build_poop_record(data)
     db.session.add(record)
+    on_poop_record_created(record)
     db.session.commit()
-    return jsonify({"success": True, "msg": "糞便紀錄建立成功"})
-
-@app.route('/poop-records/<int:record_id>', methods=['PUT'])
+    return jsonify({"success": True, "msg": "糞便紀錄建立成功", "record_id": record.record_id})
+
+def on_poop_record_created(record):
+    apply_daily_stats(poop_record_contribution(record), 1)
+    on_poop_record_achievements(record)
+    if record.record_id is None:
+        db.session.flush()
+    record_sync_change('poop_record', record.user_id, record.record_id)
+    # 舊版 app 會自己分析後把結果一起送上來，這種就不再排分析
+    if not record.ai_diagnosis_summary:
+        enqueue_poop_record_analysis(record)
+
+@api.route('/poop-records/<int:record_id>', methods=['PUT'])
+@require_auth
 def update_poop_record(record_id):
     record = PoopRecord.query.get(record_id)
     if not record:
         return jsonify({"error": "紀錄不存在"}), 404
+    if not can_access(record.user_id):
+        return forbidden()
 
-    data = request.json
+    data = with_media_urls(request.json)
+    old_contribution = poop_record_contribution(record)
+    old_bristol = record.bristol_scale
     record.bristol_scale = data.get('bristol_scale', record.bristol_scale)
     record.color = data.get('color', record.color)
     record.consistency = data.get('consistency', record.consistency)
@@ -633,6 +1697,7 @@ def update_poop_record(record_id):
     record.has_blood = data.get('has_blood', record.has_blood)
     record.has_mucus = data.get('has_mucus', record.has_mucus)
     record.image_url = data.get('image_url', record.image_url)
+    record.image_thumbnail_url = data.get('image_thumbnail_url', record.image_thumbnail_url)
     record.ai_poop_type = data.get('ai_poop_type', record.ai_poop_type)
     record.ai_poop_color = data.get('ai_poop_color', record.ai_poop_color)
     record.ai_poop_volume = data.get('ai_poop_volume', record.ai_poop_volume)
@@ -640,41 +1705,400 @@ def update_poop_record(record_id):
     record.health_recommendations = data.get('health_recommendations', record.health_recommendations)
     record.health_indicators = data.get('health_indicators', record.health_indicators)
 
+    new_contribution = poop_record_contribution(record)
+    if new_contribution != old_contribution:
+        apply_daily_stats(old_contribution, -1)
+        apply_daily_stats(new_contribution, 1)
+    move_linked_location_heat(record.record_id, old_bristol, record.bristol_scale)
+    record_sync_change('poop_record', record.user_id, record.record_id)
     db.session.commit()
     return jsonify({"success": True, "msg": "糞便紀錄更新成功"})
 
-@app.route('/poop-records/<int:record_id>', methods=['DELETE'])
+@api.route('/poop-records/<int:record_id>', methods=['DELETE'])
+@require_auth
 def delete_poop_record(record_id):
     record = PoopRecord.query.get(record_id)
     if not record:
         return jsonify({"error": "紀錄不存在"}), 404
-
+    if not can_access(record.user_id):
+        return forbidden()
+
+    apply_daily_stats(poop_record_contribution(record), -1)
+    move_linked_location_heat(record.record_id, record.bristol_scale, None)
+    if record.user_id is not None:
+        bump_progress(record.user_id, 'poop_records', -1)
+    record_sync_change('poop_record', record.user_id, record.record_id, deleted=True)
     db.session.delete(record)
     db.session.commit()
     return jsonify({"success": True, "msg": "糞便紀錄已刪除"})
 
+# ========== HEALTH STATS ==========
+# user_daily_stats 以 (user_id, day) 累計每日次數、布里斯托分布與出血/黏液次數，
+# 隨 poop_records 的新增/修改/刪除增量更新，儀表板只需讀區間內的天數
+STATS_UTC_OFFSET = timedelta(hours=float(os.getenv('STATS_UTC_OFFSET_HOURS', '8')))
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 366 * 3
+BRISTOL_KEYS = ['1', '2', '3', '4', '5', '6', '7', 'unknown']
+
+def bristol_bucket(value):
+    digits = ''.join(ch for ch in str(value or '') if ch.isdigit())
+    if digits and 1 <= int(digits) <= 7:
+        return f'bristol_{int(digits)}'
+    return 'bristol_unknown'
+
+def poop_record_contribution(record):
+    # 回傳 (user_id, day, deltas)；沒有 user_id 或 record_time 的紀錄不列入統計
+    if record.user_id is None or record.record_time is None:
+        return None
+    day = (record.record_time + STATS_UTC_OFFSET).date()
+    deltas = {
+        'record_count': 1,
+        bristol_bucket(record.bristol_scale): 1,
+        'blood_count': 1 if record.has_blood else 0,
+        'mucus_count': 1 if record.has_mucus else 0,
+    }
+    return record.user_id, day, deltas
+
+def apply_daily_stats(contribution, sign):
+    if contribution is None:
+        return
+    user_id, day, deltas = contribution
+    deltas = {key: value * sign for key, value in deltas.items() if value}
+    table = UserDailyStats.__table__
+    insert = dialect_insert(db.session)
+    stmt = insert(table).values(user_id=user_id, day=day, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.day],
+        set_={key: table.c[key] + stmt.excluded[key] for key in deltas},
+    )
+    db.session.execute(stmt)
+    if sign < 0:
+        db.session.execute(table.delete().where(
+            table.c.user_id == user_id, table.c.day == day, table.c.record_count <= 0))
+    update_user_month_sketches(user_id, day, deltas)
+
+def period_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def summarize_stats(rows, days):
+    count = sum(r.record_count for r in rows)
+    blood = sum(r.blood_count for r in rows)
+    mucus = sum(r.mucus_count for r in rows)
+    return {
+        'record_count': count,
+        'days_with_records': sum(1 for r in rows if r.record_count > 0),
+        'avg_per_day': round(count / days, 3) if days else 0,
+        'bristol': {key: sum(getattr(r, f'bristol_{key}') for r in rows) for key in BRISTOL_KEYS},
+        'blood_count': blood,
+        'mucus_count': mucus,
+        'blood_rate': round(blood / count, 4) if count else 0,
+        'mucus_rate': round(mucus / count, 4) if count else 0,
+    }
+
+@api.route('/users/<int:id>/stats', methods=['GET'])
+@require_auth
+def get_user_stats(id):
+    if not can_access(id):
+        return forbidden()
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ('day', 'week', 'month'):
+        return jsonify({'error': 'granularity must be day, week or month'}), 400
+    try:
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') \
+            else (datetime.utcnow() + STATS_UTC_OFFSET).date()
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') \
+            else end - timedelta(days=STATS_DEFAULT_DAYS - 1)
+    except ValueError:
+        return jsonify({'error': 'from/to must be YYYY-MM-DD'}), 400
+    if start > end or (end - start).days >= STATS_MAX_DAYS:
+        return jsonify({'error': 'invalid date range'}), 400
+
+    rows = UserDailyStats.query.filter(
+        UserDailyStats.user_id == id,
+        UserDailyStats.day >= start,
+        UserDailyStats.day <= end,
+    ).order_by(UserDailyStats.day).all()
+
+    periods = {}
+    for row in rows:
+        periods.setdefault(period_start(row.day, granularity), []).append(row)
+    buckets = []
+    for key, period_rows in periods.items():
+        if granularity == 'day':
+            span = 1
+        else:
+            next_start = key + timedelta(days=7) if granularity == 'week' \
+                else (key + timedelta(days=32)).replace(day=1)
+            span = (min(next_start - timedelta(days=1), end) - max(key, start)).days + 1
+        buckets.append(dict(summarize_stats(period_rows, span), period=key.isoformat()))
+
+    return jsonify({
+        'user_id': id,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'granularity': granularity,
+        'totals': summarize_stats(rows, (end - start).days + 1),
+        'buckets': buckets,
+    })
+
+stats_cli = AppGroup('stats', help='健康統計維護指令')
+
+@stats_cli.command('backfill')
+@click.option('--user-id', type=int, help='只重建單一使用者')
+def backfill_stats_command(user_id):
+    """從 poop_records 重建 user_daily_stats。"""
+    table = UserDailyStats.__table__
+    query = db.session.query(
+        PoopRecord.user_id, PoopRecord.record_time, PoopRecord.bristol_scale,
+        PoopRecord.has_blood, PoopRecord.has_mucus)
+    delete = table.delete()
+    if user_id is not None:
+        query = query.filter(PoopRecord.user_id == user_id)
+        delete = delete.where(table.c.user_id == user_id)
+
+    totals = {}
+    for row in query.yield_per(STREAM_BATCH_SIZE):
+        contribution = poop_record_contribution(row)
+        if contribution is None:
+            continue
+        uid, day, deltas = contribution
+        acc = totals.setdefault((uid, day), {})
+        for key, value in deltas.items():
+            acc[key] = acc.get(key, 0) + value
+
+    columns = [c.name for c in table.columns if c.name not in ('user_id', 'day')]
+    rows = [
+        dict({name: acc.get(name, 0) for name in columns}, user_id=uid, day=day)
+        for (uid, day), acc in totals.items()
+    ]
+    db.session.execute(delete)
+    for start in range(0, len(rows), 1000):
+        db.session.execute(table.insert(), rows[start:start + 1000])
+    db.session.commit()
+    click.echo(f'Rebuilt {len(rows)} daily rows')
+
+api.cli.add_command(stats_cli)
+
+# ========== POPULATION PERCENTILES ==========
+# 「你的分數贏過 70% 的人」：每個指標每個月維護一份可合併的分位數 sketch（metric_sketch_bins），
+# 寫入時只加減對應 bin 的次數，查詢只讀幾個月份的 bin，跟使用者數、紀錄數無關。
+# 每月次數與布里斯托比例是每個使用者每月一筆：user_daily_stats 變動時把舊值的 bin 減一、新值加一
+SKETCH_SCHEMES = {
+    'frequency': quantiles.BinScheme(),  # 有紀錄的使用者每月排便次數
+    'bristol_normal': quantiles.BinScheme(scale=100),  # 第 3、4 型佔已知型態的比例（0–1），精確到 1%
+    'health_score': quantiles.BinScheme(),  # 每次分析的 health_score
+}
+PERCENTILE_DEFAULT_MONTHS = 3
+PERCENTILE_MAX_MONTHS = 24
+SKETCH_CACHE_TTL = float(os.getenv('SKETCH_CACHE_TTL', '60'))
+PERCENTILE_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+_sketch_cache = {}  # (metric, periods) -> (載入時間, Sketch)
+
+def bump_sketch_bin(metric, period, bin, delta):
+    table = MetricSketchBin.__table__
+    insert = dialect_insert(db.session)
+    stmt = insert(table).values(metric=metric, period=period, bin=bin, count=delta)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.metric, table.c.period, table.c.bin],
+        set_={'count': table.c.count + stmt.excluded.count},
+    )
+    db.session.execute(stmt)
+    if delta < 0:
+        db.session.execute(table.delete().where(
+            table.c.metric == metric, table.c.period == period, table.c.bin == bin, table.c.count <= 0))
+
+def move_sketch_value(metric, period, old, new):
+    # 一個使用者在這個月的值從 old 變成 new；None 表示不列入
+    scheme = SKETCH_SCHEMES[metric]
+    old_bin = scheme.bin(old) if old is not None else None
+    new_bin = scheme.bin(new) if new is not None else None
+    if old_bin == new_bin:
+        return
+    if old_bin is not None:
+        bump_sketch_bin(metric, period, old_bin, -1)
+    if new_bin is not None:
+        bump_sketch_bin(metric, period, new_bin, 1)
+
+# (該月次數, 第 3、4 型次數, 未知型態次數) -> 各指標的值
+def user_month_metrics(count, normal, unknown):
+    known = count - unknown
+    return {
+        'frequency': count if count > 0 else None,
+        'bristol_normal': normal / known if known > 0 else None,
+    }
+
+def update_user_month_sketches(user_id, day, deltas):
+    # 跟 user_daily_stats 在同一個 transaction：upsert 月合計並取回更新後的值（這一列被鎖到 commit），
+    # 減去這次的 deltas 就是更新前的值
+    deltas = {
+        'record_count': deltas.get('record_count', 0),
+        'bristol_normal': deltas.get('bristol_3', 0) + deltas.get('bristol_4', 0),
+        'bristol_unknown': deltas.get('bristol_unknown', 0),
+    }
+    period = f'{day:%Y-%m}'
+    table = UserMonthlyTotals.__table__
+    insert = dialect_insert(db.session)
+    stmt = insert(table).values(user_id=user_id, period=period, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.period],
+        set_={key: table.c[key] + stmt.excluded[key] for key in deltas},
+    )
+    count, normal, unknown = db.session.execute(stmt.returning(
+        table.c.record_count, table.c.bristol_normal, table.c.bristol_unknown)).one()
+    if count <= 0:
+        db.session.execute(table.delete().where(table.c.user_id == user_id, table.c.period == period))
+    after = user_month_metrics(count, normal, unknown)
+    before = user_month_metrics(count - deltas['record_count'], normal - deltas['bristol_normal'],
+                                unknown - deltas['bristol_unknown'])
+    for metric, value in after.items():
+        move_sketch_value(metric, period, before[metric], value)
+
+def health_score_contribution(analysis_time, score):
+    # 回傳 (月份, 分數)；沒有時間或分數不是數字的不列入
+    try:
+        score = float(score)
+    except (TypeError, ValueError):
+        return None
+    if analysis_time is None or not math.isfinite(score):
+        return None
+    return f'{analysis_time + STATS_UTC_OFFSET:%Y-%m}', score
+
+def apply_health_score_sketch(analysis, sign):
+    contribution = health_score_contribution(analysis.analysis_time, analysis.health_score)
+    if contribution is not None:
+        period, score = contribution
+        bump_sketch_bin('health_score', period, SKETCH_SCHEMES['health_score'].bin(score), sign)
+
+def load_sketch(metric, periods):
+    key = (metric, periods)
+    cached = _sketch_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < SKETCH_CACHE_TTL:
+        return cached[1]
+    sketch = quantiles.Sketch(SKETCH_SCHEMES[metric])
+    rows = db.session.query(MetricSketchBin.bin, MetricSketchBin.count) \
+        .filter(MetricSketchBin.metric == metric, MetricSketchBin.period.in_(periods))
+    for bin, count in rows:
+        sketch.add_bin(bin, count)
+    if len(_sketch_cache) >= 256:
+        _sketch_cache.clear()
+    _sketch_cache[key] = (time.monotonic(), sketch)
+    return sketch
+
+# value 在母體中的百分位數（0–100）；period 是區間的最後一個月（預設本月），往前共 months 個月
+@api.route('/analytics/percentiles', methods=['GET'])
+def get_percentiles():
+    metric = request.args.get('metric')
+    if metric not in SKETCH_SCHEMES:
+        return jsonify({'error': f'metric must be one of {", ".join(SKETCH_SCHEMES)}'}), 400
+    value = request.args.get('value', type=float)
+    if value is None or not math.isfinite(value):
+        return jsonify({'error': 'value must be a number'}), 400
+    months = request.args.get('months', PERCENTILE_DEFAULT_MONTHS, type=int)
+    if months is None or not 1 <= months <= PERCENTILE_MAX_MONTHS:
+        return jsonify({'error': f'months must be between 1 and {PERCENTILE_MAX_MONTHS}'}), 400
+    try:
+        end = partitions.parse_period(request.args['period']) if request.args.get('period') \
+            else partitions.month_start(datetime.utcnow() + STATS_UTC_OFFSET)
+    except ValueError:
+        return jsonify({'error': 'period must be YYYY-MM'}), 400
+
+    periods = tuple(partitions.period_key(partitions.add_months(end, -i)) for i in range(months))
+    sketch = load_sketch(metric, periods)
+    rank = sketch.rank(value)
+    return jsonify({
+        'metric': metric,
+        'value': value,
+        'from': periods[-1],
+        'to': periods[0],
+        'population': sketch.total,
+        'percentile': round(rank * 100, 1) if rank is not None else None,
+        'quantiles': {f'p{round(q * 100)}': sketch.quantile(q) for q in PERCENTILE_QUANTILES},
+    })
+
+@stats_cli.command('rebuild-sketches')
+def rebuild_sketches_command():
+    """從 user_daily_stats 與 analysis_results 重建 user_monthly_totals 與 metric_sketch_bins（請先跑 stats backfill）。"""
+    totals = {}
+
+    def add(metric, period, value):
+        if value is not None:
+            cell = (metric, period, SKETCH_SCHEMES[metric].bin(value))
+            totals[cell] = totals.get(cell, 0) + 1
+
+    months = {}
+    for user_id, day, count, normal, unknown in db.session.query(
+            UserDailyStats.user_id, UserDailyStats.day, UserDailyStats.record_count,
+            UserDailyStats.bristol_3 + UserDailyStats.bristol_4,
+            UserDailyStats.bristol_unknown).yield_per(STREAM_BATCH_SIZE):
+        acc = months.setdefault((user_id, f'{day:%Y-%m}'), [0, 0, 0])
+        acc[0] += count
+        acc[1] += normal
+        acc[2] += unknown
+    for (_, period), acc in months.items():
+        for metric, value in user_month_metrics(*acc).items():
+            add(metric, period, value)
+    monthly_rows = [{'user_id': user_id, 'period': period, 'record_count': count,
+                     'bristol_normal': normal, 'bristol_unknown': unknown}
+                    for (user_id, period), (count, normal, unknown) in months.items() if count > 0]
+    for analysis_time, score in db.session.query(
+            AnalysisResult.analysis_time, AnalysisResult.health_score).yield_per(STREAM_BATCH_SIZE):
+        contribution = health_score_contribution(analysis_time, score)
+        if contribution is not None:
+            add('health_score', *contribution)
+
+    rows = [{'metric': metric, 'period': period, 'bin': bin, 'count': count}
+            for (metric, period, bin), count in totals.items()]
+    for table, table_rows in ((UserMonthlyTotals.__table__, monthly_rows), (MetricSketchBin.__table__, rows)):
+        db.session.execute(table.delete())
+        for start in range(0, len(table_rows), 1000):
+            db.session.execute(table.insert(), table_rows[start:start + 1000])
+    db.session.commit()
+    _sketch_cache.clear()
+    click.echo(f'Rebuilt {len(rows)} sketch bins')
+
 # ========== PUBLIC_TOILETS ==========
-@app.route('/toilets', methods=['GET'])
+toilet_serializer = RowSerializer(PublicToilet)
+
+# 公廁欄位 + 評分摘要（最後一欄）；回傳 (query, row -> dict)
+def toilets_with_ratings():
+    query, to_dict = select_rows(toilet_serializer, PublicToilet.toilet_id)
+    query = query.add_entity(ToiletRatingSummary).outerjoin(
+        ToiletRatingSummary, ToiletRatingSummary.toilet_id == PublicToilet.toilet_id)
+    return query, lambda row: dict(to_dict(row), rating=rating_summary_to_dict(row[-1]))
+
+# 列表裡的評分摘要可能落後最多一個快取 TTL；單筆與 /summary 會即時失效
+@api.route('/toilets', methods=['GET'])
+@response_cache.cached(ttl=300, tags=lambda: ['toilets'], unless=lambda: wants_stream(request))
 def get_all_toilets():
-    toilets = PublicToilet.query.all()
-    return jsonify([t.__dict__ for t in toilets if '_sa_instance_state' not in t.__dict__])
+    query, to_dict = toilets_with_ratings()
+    if wants_stream(request):
+        return stream_query(query.order_by(PublicToilet.toilet_id), to_dict)
+    return jsonify([to_dict(row) for row in query])
 
-@app.route('/toilets/<string:toilet_id>', methods=['GET'])
+@api.route('/toilets/<string:toilet_id>', methods=['GET'])
+@response_cache.cached(ttl=300, tags=lambda toilet_id: ['toilets', f'toilet_rating:{toilet_id}'])
 def get_toilet(toilet_id):
-    toilet = PublicToilet.query.get(toilet_id)
-    if not toilet:
+    query, to_dict = toilets_with_ratings()
+    row = query.filter(PublicToilet.toilet_id == toilet_id).first()
+    if row is None:
         return jsonify({'error': 'Toilet not found'}), 404
-    return jsonify(toilet.__dict__)
+    return jsonify(to_dict(row))
 
-@app.route('/toilets', methods=['POST'])
+@api.route('/toilets', methods=['POST'])
 def create_toilet():
     data = request.json
     new_toilet = PublicToilet(**data)
     db.session.add(new_toilet)
     db.session.commit()
+    on_toilets_changed([new_toilet.toilet_id])
     return jsonify({'message': 'Toilet created'}), 201
 
-@app.route('/toilets/<string:toilet_id>', methods=['PUT'])
+@api.route('/toilets/<string:toilet_id>', methods=['PUT'])
 def update_toilet(toilet_id):
     toilet = PublicToilet.query.get(toilet_id)
     if not toilet:
@@ -682,62 +2106,522 @@ def update_toilet(toilet_id):
     for key, value in request.json.items():
         setattr(toilet, key, value)
     db.session.commit()
+    on_toilets_changed({toilet_id, toilet.toilet_id})
     return jsonify({'message': 'Toilet updated'})
 
-@app.route('/toilets/<string:toilet_id>', methods=['DELETE'])
+@api.route('/toilets/<string:toilet_id>', methods=['DELETE'])
 def delete_toilet(toilet_id):
     toilet = PublicToilet.query.get(toilet_id)
     if not toilet:
         return jsonify({'error': 'Toilet not found'}), 404
     db.session.delete(toilet)
     db.session.commit()
+    on_toilets_changed([toilet_id])
     return jsonify({'message': 'Toilet deleted'})
 
+# ========== TOILET BULK IMPORT ==========
+# 開放資料整批匯入：上傳的檔案先串流寫進 TOILET_IMPORT_DIR，由 worker 的 import_toilets 工作邊讀邊分批 upsert，
+# API 只回 202 與 job_id，匯入再久也不佔住 request thread 跟連線。web 與 worker 要看得到同一個目錄
+TOILET_IMPORT_DIR = os.getenv('TOILET_IMPORT_DIR', os.path.join(os.getcwd(), 'imports'))
+TOILET_IMPORT_MAX_BYTES = int(os.getenv('TOILET_IMPORT_MAX_BYTES', str(200 * 1024 * 1024)))
+TOILET_IMPORT_FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson', 'application/jsonl': 'ndjson'}
+
+@api.route('/toilets/bulk', methods=['POST'])
+@require_auth
+def bulk_import_toilets():
+    if not is_admin():
+        return forbidden()
+    mimetype = request.mimetype
+    if request.content_length is not None and request.content_length > TOILET_IMPORT_MAX_BYTES:
+        return jsonify({'error': 'File too large'}), 413
+    if mimetype == 'application/json':
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            return jsonify({'error': 'Expected a JSON array of toilets'}), 400
+        # JSON 陣列本來就整個讀進記憶體了，轉成 NDJSON 交給 worker
+        fmt = 'ndjson'
+        stream = io.BytesIO(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf-8'))
+    elif mimetype in TOILET_IMPORT_FORMATS:
+        fmt = TOILET_IMPORT_FORMATS[mimetype]
+        stream = request.stream
+    else:
+        return jsonify({'error': 'Unsupported content type'}), 415
+
+    try:
+        name = save_upload(stream, TOILET_IMPORT_DIR, TOILET_IMPORT_MAX_BYTES)
+    except UploadTooLarge:
+        return jsonify({'error': 'File too large'}), 413
+    job = enqueue_job('import_toilets', {'file': name, 'format': fmt}, ref='toilets:import')
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        os.remove(os.path.join(TOILET_IMPORT_DIR, name))
+        raise
+    return jsonify(job_to_dict(job)), 202
+
+# 匯入進度；完成後 result 是各項筆數，資料讀不下去時是錯誤訊息、第幾筆與已寫入的筆數
+@api.route('/toilets/bulk/<int:job_id>', methods=['GET'])
+@require_auth
+def get_bulk_import(job_id):
+    if not is_admin():
+        return forbidden()
+    job = Job.query.filter_by(job_id=job_id, kind='import_toilets').first()
+    if job is None:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(job_to_dict(job))
+
+@job_handler('import_toilets')
+def run_toilet_import(payload):
+    path = os.path.join(TOILET_IMPORT_DIR, payload['file'])
+    if not os.path.exists(path):
+        # 租約過期被重跑時，先前的嘗試已經匯入完並刪掉檔案
+        return None
+    try:
+        with open(path, 'rb') as f:
+            counts = import_toilets(db.session, PublicToilet.__table__, iter_rows(f, payload['format']))
+    except ImportAborted as e:
+        # 資料本身有問題，重試也沒用；之前的批次已經寫入，修正後重送整份檔案是安全的（內容相同的列不會被改寫）
+        db.session.rollback()
+        os.remove(path)
+        return {'error': f'Invalid import data: {e}', 'row': e.row, 'committed': e.counts}
+    finally:
+        on_toilets_changed()
+    os.remove(path)
+    return counts
+
+toilets_cli = AppGroup('toilets', help='公廁資料維護指令')
+
+@toilets_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+              help='預設依副檔名判斷')
+def import_toilets_command(path, fmt):
+    """從 CSV / NDJSON 檔匯入或更新公廁資料。"""
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    with open(path, 'rb') as f:
+        try:
+            counts = import_toilets(db.session, PublicToilet.__table__, iter_rows(f, fmt))
+        except ImportAborted as e:
+            db.session.rollback()
+            committed = ', '.join(f'{key}={value}' for key, value in e.counts.items())
+            raise click.ClickException(f'{e} (already committed: {committed})')
+    click.echo(', '.join(f'{key}={value}' for key, value in counts.items()))
+
+api.cli.add_command(toilets_cli)
+
+# ========== NEARBY TOILETS ==========
+# 每個 worker 在記憶體裡維護一份公廁網格索引；本 worker 寫入時標記失效，
+# 其他 worker 的寫入則靠 TOILET_INDEX_TTL 秒後重建來追上
+TOILET_INDEX_CELL_DEG = float(os.getenv('TOILET_INDEX_CELL_DEG', '0.01'))
+TOILET_INDEX_TTL = float(os.getenv('TOILET_INDEX_TTL', '300'))
+NEARBY_MAX_K = 200
+
+_toilet_index = None
+_toilet_index_built_at = 0.0
+_toilet_index_lock = threading.Lock()
+
+def invalidate_toilet_index():
+    global _toilet_index
+    _toilet_index = None
+
+# 公廁資料有任何寫入後呼叫：重建索引並讓相關快取失效。
+# 知道是哪幾筆時（單筆新增/修改/刪除），群集與搜尋索引只更新那幾筆；整批匯入則整份重建
+def on_toilets_changed(toilet_ids=None):
+    invalidate_toilet_index()
+    if toilet_ids is None:
+        invalidate_toilet_clusters()
+        invalidate_toilet_search()
+    elif _toilet_clusters is not None or _toilet_search is not None:
+        rows = load_toilet_rows(toilet_ids)
+        refresh_toilet_clusters(rows)
+        refresh_toilet_search(rows)
+    response_cache.invalidate('toilets')
+
+# toilet_id -> 資料列；已刪除的對應 None
+def load_toilet_rows(toilet_ids):
+    table = PublicToilet.__table__
+    rows = {row['toilet_id']: dict(row) for row in db.session.execute(
+        db.select(table).where(table.c.toilet_id.in_(list(toilet_ids)))).mappings()}
+    return {toilet_id: rows.get(toilet_id) for toilet_id in toilet_ids}
+
+def get_toilet_index():
+    global _toilet_index, _toilet_index_built_at
+    index = _toilet_index
+    if index is not None and time.monotonic() - _toilet_index_built_at < TOILET_INDEX_TTL:
+        return index
+    with _toilet_index_lock:
+        if _toilet_index is not None and time.monotonic() - _toilet_index_built_at < TOILET_INDEX_TTL:
+            return _toilet_index
+        index = GridIndex(cell_deg=TOILET_INDEX_CELL_DEG)
+        for row in db.session.execute(db.select(PublicToilet.__table__)).mappings():
+            index.insert(row['latitude'], row['longitude'], dict(row))
+        _toilet_index = index
+        _toilet_index_built_at = time.monotonic()
+        return index
+
+@api.route('/toilets/nearby', methods=['GET'])
+def get_nearby_toilets():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'error': 'lat and lon are required'}), 400
+    radius = request.args.get('radius', type=float)
+    k = request.args.get('k', type=int)
+    if radius is not None and radius <= 0:
+        return jsonify({'error': 'radius must be positive'}), 400
+    if k is not None and k <= 0:
+        return jsonify({'error': 'k must be positive'}), 400
+    if k is None:
+        k = 20 if radius is None else NEARBY_MAX_K
+    k = min(k, NEARBY_MAX_K)
+
+    filters = {
+        field: request.args[field]
+        for field in ('grade', 'toilet_type', 'diaper')
+        if request.args.get(field)
+    }
+    predicate = None
+    if filters:
+        predicate = lambda t: all(t.get(f) == v for f, v in filters.items())
+
+    hits = get_toilet_index().nearest(lat, lon, k, max_radius_m=radius, predicate=predicate)
+    summaries = load_rating_summaries([t['toilet_id'] for _, t in hits])
+    return jsonify([
+        dict(t, distance_m=round(d, 1), rating=rating_summary_to_dict(summaries.get(t['toilet_id'])))
+        for d, t in hits
+    ])
+
+# ========== TOILET CLUSTERS ==========
+# 縮小的地圖不逐一畫公廁：每個 worker 在記憶體裡維護各縮放等級預先聚合好的群集（clusters.py），
+# 回應大小只跟畫面範圍有關。本 worker 的單筆寫入直接更新索引，其他 worker 的寫入靠 TTL 重建追上
+CLUSTER_MAX_ZOOM = int(os.getenv('CLUSTER_MAX_ZOOM', '16'))
+CLUSTER_CELL_SHIFT = int(os.getenv('CLUSTER_CELL_SHIFT', '2'))  # 群集格子為 1/2^n 張圖磚（256px 圖磚時 64px）
+CLUSTER_MAX_TILES = 64  # bbox 在該縮放等級最多涵蓋幾張圖磚，約是一個大螢幕
+
+_toilet_clusters = None
+_toilet_clusters_built_at = 0.0
+_toilet_clusters_lock = threading.Lock()
+
+def invalidate_toilet_clusters():
+    global _toilet_clusters
+    _toilet_clusters = None
+
+def refresh_toilet_clusters(rows):
+    index = _toilet_clusters
+    if index is None:
+        return
+    for toilet_id, row in rows.items():
+        if row is None:
+            index.remove(toilet_id)
+        else:
+            index.insert(toilet_id, row['latitude'], row['longitude'], row)
+
+def get_toilet_clusters():
+    global _toilet_clusters, _toilet_clusters_built_at
+    index = _toilet_clusters
+    if index is not None and time.monotonic() - _toilet_clusters_built_at < TOILET_INDEX_TTL:
+        return index
+    with _toilet_clusters_lock:
+        if _toilet_clusters is not None and time.monotonic() - _toilet_clusters_built_at < TOILET_INDEX_TTL:
+            return _toilet_clusters
+        index = ClusterIndex(max_zoom=CLUSTER_MAX_ZOOM, cell_shift=CLUSTER_CELL_SHIFT)
+        index.load((row['toilet_id'], row['latitude'], row['longitude'], dict(row))
+                   for row in db.session.execute(db.select(PublicToilet.__table__)).mappings())
+        _toilet_clusters = index
+        _toilet_clusters_built_at = time.monotonic()
+        return index
+
+@api.route('/toilets/clusters', methods=['GET'])
+def get_toilet_clusters_view():
+    try:
+        west, south, east, north = (float(v) for v in request.args['bbox'].split(','))
+        zoom = float(request.args['zoom'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'bbox=west,south,east,north and zoom are required'}), 400
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180) or zoom < 0:
+        return jsonify({'error': 'invalid bbox or zoom'}), 400
+    z = min(int(zoom), CLUSTER_MAX_ZOOM + 1)
+    x0, y0 = tile_xy(north, west, z)
+    x1, y1 = tile_xy(south, east, z)
+    columns = (x1 - x0 if west <= east else (1 << z) - x0 + x1) + 1
+    if columns * (y1 - y0 + 1) > CLUSTER_MAX_TILES:
+        return jsonify({'error': 'bbox is too large for this zoom'}), 400
+
+    clusters = get_toilet_clusters().clusters(west, south, east, north, zoom)
+    return jsonify({
+        'zoom': z,
+        'clusters': [{
+            'id': c['id'],
+            'count': c['count'],
+            'latitude': round(c['latitude'], 6),
+            'longitude': round(c['longitude'], 6),
+            'expansion_zoom': c['expansion_zoom'],
+            'toilet': c['item'],
+        } for c in clusters],
+    })
+
+# ========== TOILET SEARCH ==========
+# 輸入時的即時搜尋：每個 worker 在記憶體裡維護公廁名稱、地址的 n-gram 反向索引（text_search.py），
+# 不必把整份公廁資料傳給前端。更新方式與群集索引相同
+TOILET_SEARCH_FIELDS = {'name': 3, 'address': 1, 'city': 1, 'village': 1, 'administration': 1}
+SEARCH_MAX_LIMIT = 50
+
+_toilet_search = None
+_toilet_search_built_at = 0.0
+_toilet_search_lock = threading.Lock()
+
+def invalidate_toilet_search():
+    global _toilet_search
+    _toilet_search = None
+
+def refresh_toilet_search(rows):
+    index = _toilet_search
+    if index is None:
+        return
+    for toilet_id, row in rows.items():
+        if row is None:
+            index.remove(toilet_id)
+        else:
+            index.insert(toilet_id, row, (row['latitude'], row['longitude']))
+
+def get_toilet_search():
+    global _toilet_search, _toilet_search_built_at
+    index = _toilet_search
+    if index is not None and time.monotonic() - _toilet_search_built_at < TOILET_INDEX_TTL:
+        return index
+    with _toilet_search_lock:
+        if _toilet_search is not None and time.monotonic() - _toilet_search_built_at < TOILET_INDEX_TTL:
+            return _toilet_search
+        index = SearchIndex(TOILET_SEARCH_FIELDS, max_results=SEARCH_MAX_LIMIT)
+        for row in db.session.execute(db.select(PublicToilet.__table__)).mappings():
+            index.insert(row['toilet_id'], dict(row), (row['latitude'], row['longitude']))
+        _toilet_search = index
+        _toilet_search_built_at = time.monotonic()
+        return index
+
+# q 依名稱、地址、縣市、村里、管理單位比對；prefix=1 表示還在輸入，最後一個詞只有一個字時要對到開頭。
+# 帶 lat/lon 時同分的依距離排序，並回傳 distance_m
+@api.route('/toilets/search', methods=['GET'])
+def search_toilets():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'q is required'}), 400
+    prefix = request.args.get('prefix') in ('1', 'true')
+    limit = request.args.get('limit', 20, type=int)
+    if limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, SEARCH_MAX_LIMIT)
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    origin = None
+    if lat is not None and lon is not None:
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return jsonify({'error': 'invalid lat or lon'}), 400
+        origin = (lat, lon)
+
+    hits = get_toilet_search().search(q, limit=limit, prefix=prefix, origin=origin)
+    summaries = load_rating_summaries([t['toilet_id'] for _, t in hits])
+    results = []
+    for score, t in hits:
+        result = dict(t, score=score, rating=rating_summary_to_dict(summaries.get(t['toilet_id'])))
+        if origin is not None and t['latitude'] is not None and t['longitude'] is not None:
+            result['distance_m'] = round(haversine_m(lat, lon, t['latitude'], t['longitude']), 1)
+        results.append(result)
+    return jsonify(results)
+
+# ========== HEATMAP ==========
+# 地圖熱度圖：heatmap_cells 以 (圖層, quadkey, 日, 布里斯托) 累計次數，隨打卡 / 地點紀錄的
+# 新增、修改、刪除增量更新。每筆同時記在 HEATMAP_LEVELS 的每一層，任何縮放等級的圖磚
+# 都從不超過兩層以外的那一層讀，讀取量只跟圖磚大小有關，跟資料總量無關
+HEATMAP_LEVELS = (6, 9, 12, 15, 18)
+HEATMAP_TILE_DETAIL = int(os.getenv('HEATMAP_TILE_DETAIL', '5'))  # 每張圖磚切成 2^n × 2^n 格
+# 熱度圖允許一點延遲，只靠 TTL 過期，不在每次打卡時讓快取失效
+HEATMAP_CACHE_TTL = int(os.getenv('HEATMAP_CACHE_TTL', '60'))
+HEATMAP_LAYERS = ('poop', 'checkin')
+
+def bristol_number(value):
+    bucket = bristol_bucket(value)
+    return 0 if bucket == 'bristol_unknown' else int(bucket.rsplit('_', 1)[1])
+
+def heatmap_contribution(layer, lat, lon, when, bristol):
+    # 回傳 (layer, 最細一層的 quadkey, day, bristol)；沒有座標或時間的不列入
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if when is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    day = (when + STATS_UTC_OFFSET).date()
+    return layer, quadkey(lat, lon, HEATMAP_LEVELS[-1]), day, bristol_number(bristol)
+
+def poop_location_heat(location):
+    bristol = None
+    if location.record_id is not None:
+        bristol = db.session.query(PoopRecord.bristol_scale).filter_by(record_id=location.record_id).scalar()
+    return heatmap_contribution('poop', location.latitude, location.longitude, location.record_time, bristol)
+
+# 地點的格子依連結紀錄的布里斯托型態；紀錄的型態改變或被刪除（變成未知）時，連結的地點要搬格子
+def move_linked_location_heat(record_id, old_bristol, new_bristol):
+    if record_id is None or bristol_number(old_bristol) == bristol_number(new_bristol):
+        return
+    locations = db.session.query(PoopLocation.latitude, PoopLocation.longitude, PoopLocation.record_time) \
+        .filter(PoopLocation.record_id == record_id)
+    for lat, lon, when in locations:
+        update_heatmap(heatmap_contribution('poop', lat, lon, when, old_bristol),
+                       heatmap_contribution('poop', lat, lon, when, new_bristol))
+
+def toilet_checkin_heat(c):
+    return heatmap_contribution('checkin', c.latitude, c.longitude, c.checkin_time, None)
+
+def public_checkin_heat(c):
+    return heatmap_contribution('checkin', c.latitude, c.longitude, c.created_at, c.bristol_type)
+
+def apply_heatmap(contribution, sign):
+    if contribution is None:
+        return
+    layer, key, day, bristol = contribution
+    table = HeatmapCell.__table__
+    insert = dialect_insert(db.session)
+    stmt = insert(table).values([
+        {'layer': layer, 'zoom': z, 'quadkey': key[:z], 'day': day, 'bristol': bristol, 'count': sign}
+        for z in HEATMAP_LEVELS
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.layer, table.c.zoom, table.c.quadkey, table.c.day, table.c.bristol],
+        set_={'count': table.c.count + stmt.excluded.count},
+    )
+    db.session.execute(stmt)
+    if sign < 0:
+        db.session.execute(table.delete().where(
+            table.c.layer == layer, table.c.zoom.in_(HEATMAP_LEVELS),
+            table.c.quadkey.in_([key[:z] for z in HEATMAP_LEVELS]),
+            table.c.day == day, table.c.bristol == bristol, table.c.count <= 0))
+
+def update_heatmap(old_contribution, new_contribution):
+    if new_contribution != old_contribution:
+        apply_heatmap(old_contribution, -1)
+        apply_heatmap(new_contribution, 1)
+
+@api.route('/heatmap/<int:z>/<int:x>/<int:y>', methods=['GET'])
+@response_cache.cached(ttl=HEATMAP_CACHE_TTL, max_age=HEATMAP_CACHE_TTL)
+def get_heatmap_tile(z, x, y):
+    if z > HEATMAP_LEVELS[-1]:
+        return jsonify({'error': f'z must be at most {HEATMAP_LEVELS[-1]}'}), 400
+    if x >= 1 << z or y >= 1 << z:
+        return jsonify({'error': 'tile out of range'}), 404
+    layers = request.args.get('layer')
+    layers = layers.split(',') if layers else list(HEATMAP_LAYERS)
+    if any(layer not in HEATMAP_LAYERS for layer in layers):
+        return jsonify({'error': f'layer must be one of {", ".join(HEATMAP_LAYERS)}'}), 400
+    try:
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({'error': 'from/to must be YYYY-MM-DD'}), 400
+    try:
+        bristol = [int(v) for v in request.args['bristol'].split(',')] if request.args.get('bristol') else None
+    except ValueError:
+        return jsonify({'error': 'bristol must be a comma-separated list of 1-7'}), 400
+
+    prefix = tile_quadkey(x, y, z)
+    cell_zoom = min(z + HEATMAP_TILE_DETAIL, HEATMAP_LEVELS[-1])
+    level = next(level for level in HEATMAP_LEVELS if level >= cell_zoom)
+    cell = db.func.substr(HeatmapCell.quadkey, 1, cell_zoom)
+    # quadkey 只有 0-3，前綴 + '4' 就是這張圖磚範圍的上界
+    query = db.session.query(cell, db.func.sum(HeatmapCell.count)).filter(
+        HeatmapCell.layer.in_(layers),
+        HeatmapCell.zoom == level,
+        HeatmapCell.quadkey >= prefix,
+        HeatmapCell.quadkey < prefix + '4',
+    )
+    if start is not None:
+        query = query.filter(HeatmapCell.day >= start)
+    if end is not None:
+        query = query.filter(HeatmapCell.day <= end)
+    if bristol:
+        query = query.filter(HeatmapCell.bristol.in_(bristol))
+
+    cells = []
+    for key, count in query.group_by(cell):
+        if not count or count <= 0:
+            continue
+        lat, lon = tile_center(*quadkey_tile(key))
+        cells.append({'quadkey': key, 'lat': round(lat, 6), 'lon': round(lon, 6), 'count': int(count)})
+    return jsonify({
+        'z': z, 'x': x, 'y': y,
+        'cell_zoom': cell_zoom,
+        'total': sum(c['count'] for c in cells),
+        'max': max((c['count'] for c in cells), default=0),
+        'cells': cells,
+    })
+
+heatmap_cli = AppGroup('heatmap', help='熱度圖維護指令')
+
+@heatmap_cli.command('rebuild')
+def rebuild_heatmap_command():
+    """從地點紀錄與打卡重建 heatmap_cells。"""
+    totals = {}
+
+    def add(contribution):
+        if contribution is None:
+            return
+        layer, key, day, bristol = contribution
+        for z in HEATMAP_LEVELS:
+            cell = (layer, z, key[:z], day, bristol)
+            totals[cell] = totals.get(cell, 0) + 1
+
+    locations = db.session.query(
+        PoopLocation.latitude, PoopLocation.longitude, PoopLocation.record_time, PoopRecord.bristol_scale,
+    ).outerjoin(PoopRecord, PoopRecord.record_id == PoopLocation.record_id)
+    for lat, lon, when, bristol in locations.yield_per(STREAM_BATCH_SIZE):
+        add(heatmap_contribution('poop', lat, lon, when, bristol))
+    for lat, lon, when in db.session.query(
+            ToiletCheckin.latitude, ToiletCheckin.longitude, ToiletCheckin.checkin_time).yield_per(STREAM_BATCH_SIZE):
+        add(heatmap_contribution('checkin', lat, lon, when, None))
+    for lat, lon, when, bristol in db.session.query(
+            PublicCheckin.latitude, PublicCheckin.longitude, PublicCheckin.created_at,
+            PublicCheckin.bristol_type).yield_per(STREAM_BATCH_SIZE):
+        add(heatmap_contribution('checkin', lat, lon, when, bristol))
+
+    table = HeatmapCell.__table__
+    rows = [
+        {'layer': layer, 'zoom': z, 'quadkey': key, 'day': day, 'bristol': bristol, 'count': count}
+        for (layer, z, key, day, bristol), count in totals.items()
+    ]
+    db.session.execute(table.delete())
+    for start in range(0, len(rows), 1000):
+        db.session.execute(table.insert(), rows[start:start + 1000])
+    db.session.commit()
+    click.echo(f'Rebuilt {len(rows)} heatmap cells')
+
+api.cli.add_command(heatmap_cli)
+
 # ========== TOILET_CHECKINS ==========
+toilet_checkin_serializer = RowSerializer(ToiletCheckin)
+
 # 🔍 GET 全部資料
-@app.route('/toilet_checkins', methods=['GET'])
+@api.route('/toilet_checkins', methods=['GET'])
 def get_toilet_checkins():
-    all_checkins = ToiletCheckin.query.all()
-    result = []
-    for c in all_checkins:
-        result.append({
-            'toilet_checkin_id': c.toilet_checkin_id,
-            'user_id': c.user_id,
-            'checkin_time': c.checkin_time,
-            'latitude': c.latitude,
-            'longitude': c.longitude,
-            'toilet_name': c.toilet_name,
-            'toilet_rating_cleanliness': c.toilet_rating_cleanliness,
-            'toilet_rating_privacy': c.toilet_rating_privacy,
-            'toilet_rating_amenities': c.toilet_rating_amenities,
-            'toilet_review_text': c.toilet_review_text,
-            'public_toilet_id': c.public_toilet_id,
-        })
-    return jsonify(result)
+    query, to_dict = select_rows(toilet_checkin_serializer, ToiletCheckin.checkin_time, ToiletCheckin.toilet_checkin_id)
+    all_checkins, next_cursor = paginate_archived(
+        'toilet_checkins', toilet_checkin_serializer, query, to_dict, request.args,
+        {'user_id': (ToiletCheckin.user_id, int),
+         'public_toilet_id': (ToiletCheckin.public_toilet_id, str)})
+    return paginated(all_checkins, next_cursor)
 
 # 🔍 GET 單筆
-@app.route('/toilet_checkins/<int:checkin_id>', methods=['GET'])
+@api.route('/toilet_checkins/<int:checkin_id>', methods=['GET'])
 def get_toilet_checkin(checkin_id):
-    c = ToiletCheckin.query.get_or_404(checkin_id)
-    return jsonify({
-        'toilet_checkin_id': c.toilet_checkin_id,
-        'user_id': c.user_id,
-        'checkin_time': c.checkin_time,
-        'latitude': c.latitude,
-        'longitude': c.longitude,
-        'toilet_name': c.toilet_name,
-        'toilet_rating_cleanliness': c.toilet_rating_cleanliness,
-        'toilet_rating_privacy': c.toilet_rating_privacy,
-        'toilet_rating_amenities': c.toilet_rating_amenities,
-        'toilet_review_text': c.toilet_review_text,
-        'public_toilet_id': c.public_toilet_id,
-    })
+    _, result = get_row(toilet_checkin_serializer, ToiletCheckin.toilet_checkin_id, checkin_id)
+    if result is None:
+        abort(404)
+    return jsonify(result)
 
-# ➕ POST 新增
-@app.route('/toilet_checkins', methods=['POST'])
-def create_toilet_checkin():
-    data = request.get_json()
-    new_checkin = ToiletCheckin(
+
+def build_toilet_checkin(data):
+    return ToiletCheckin(
         user_id=data['user_id'],
         checkin_time=datetime.strptime(data['checkin_time'], '%Y-%m-%d %H:%M:%S'),
         latitude=data.get('latitude'),
@@ -749,15 +2633,29 @@ def create_toilet_checkin():
         toilet_review_text=data.get('toilet_review_text'),
         public_toilet_id=data.get('public_toilet_id')
     )
+
+# ➕ POST 新增
+@api.route('/toilet_checkins', methods=['POST'])
+def create_toilet_checkin():
+    data = request.get_json()
+    new_checkin = build_toilet_checkin(data)
     db.session.add(new_checkin)
+    on_toilet_checkin_created(new_checkin)
     db.session.commit()
     return jsonify({'message': 'Checkin created successfully'}), 201
 
+def on_toilet_checkin_created(checkin):
+    apply_rating_summary(toilet_checkin_contribution(checkin), 1)
+    apply_heatmap(toilet_checkin_heat(checkin), 1)
+    record_toilet_visit(checkin.user_id, checkin.public_toilet_id)
+
 # 📝 PUT 更新
-@app.route('/toilet_checkins/<int:checkin_id>', methods=['PUT'])
+@api.route('/toilet_checkins/<int:checkin_id>', methods=['PUT'])
 def update_toilet_checkin(checkin_id):
     c = ToiletCheckin.query.get_or_404(checkin_id)
     data = request.get_json()
+    old_contribution = toilet_checkin_contribution(c)
+    old_heat = toilet_checkin_heat(c)
     c.latitude = data.get('latitude', c.latitude)
     c.longitude = data.get('longitude', c.longitude)
     c.toilet_name = data.get('toilet_name', c.toilet_name)
@@ -766,55 +2664,53 @@ def update_toilet_checkin(checkin_id):
     c.toilet_rating_amenities = data.get('toilet_rating_amenities', c.toilet_rating_amenities)
     c.toilet_review_text = data.get('toilet_review_text', c.toilet_review_text)
     c.public_toilet_id = data.get('public_toilet_id', c.public_toilet_id)
+    new_contribution = toilet_checkin_contribution(c)
+    if new_contribution != old_contribution:
+        apply_rating_summary(old_contribution, -1)
+        apply_rating_summary(new_contribution, 1)
+    update_heatmap(old_heat, toilet_checkin_heat(c))
     db.session.commit()
     return jsonify({'message': 'Checkin updated successfully'})
 
 # ❌ DELETE 刪除
-@app.route('/toilet_checkins/<int:checkin_id>', methods=['DELETE'])
+@api.route('/toilet_checkins/<int:checkin_id>', methods=['DELETE'])
 def delete_toilet_checkin(checkin_id):
     c = ToiletCheckin.query.get_or_404(checkin_id)
+    contribution = toilet_checkin_contribution(c)
+    apply_heatmap(toilet_checkin_heat(c), -1)
     db.session.delete(c)
+    apply_rating_summary(contribution, -1)
     db.session.commit()
     return jsonify({'message': 'Checkin deleted successfully'})
 
 # ========== PUBLIC_CHECKINS ==========
+PUBLIC_CHECKIN_FILTERS = {
+    'user_id': (PublicCheckin.user_id, str),
+    'bathroom_id': (PublicCheckin.bathroom_id, str),
+    'bristol_type': (PublicCheckin.bristol_type, int),
+}
+
+public_checkin_serializer = RowSerializer(PublicCheckin)
+# 單筆查詢原本就只回這幾個欄位；要其他欄位用 ?fields=
+public_checkin_detail_serializer = RowSerializer(
+    PublicCheckin, default_fields=('id', 'user_id', 'bathroom_name', 'location_name', 'custom_message'))
+
 # ✅ Get all public checkins
-@app.route('/public-checkins', methods=['GET'])
+@api.route('/public-checkins', methods=['GET'])
 def get_all_public_checkins():
-    checkins = PublicCheckin.query.all()
-    result = []
-    for checkin in checkins:
-        result.append({
-            'id': checkin.id,
-            'user_id': checkin.user_id,
-            'bathroom_id': checkin.bathroom_id,
-            'bathroom_name': checkin.bathroom_name,
-            'bathroom_address': checkin.bathroom_address,
-            'bathroom_type': checkin.bathroom_type,
-            'bathroom_source': checkin.bathroom_source,
-            'latitude': checkin.latitude,
-            'longitude': checkin.longitude,
-            'location_name': checkin.location_name,
-            'mood_emoji': checkin.mood_emoji,
-            'bristol_type': checkin.bristol_type,
-            'rating': checkin.rating,
-            'note': checkin.note,
-            'custom_message': checkin.custom_message,
-            'quick_tag': checkin.quick_tag,
-            'image_url': checkin.image_url,
-            'audio_url': checkin.audio_url,
-            'is_anonymous': checkin.is_anonymous,
-            'created_at': checkin.created_at,
-            'updated_at': checkin.updated_at
-        })
-    return jsonify(result)
-
-# ✅ Create a new public checkin
-@app.route('/public-checkins', methods=['POST'])
-def create_public_checkin():
-    data = request.get_json()
-    new_checkin = PublicCheckin(
-        id=str(uuid.uuid4()),
+    query, to_dict = select_rows(public_checkin_serializer, PublicCheckin.created_at, PublicCheckin.id)
+    if wants_stream(request):
+        archived = archived_rows('public_checkins', public_checkin_serializer, request.args, PUBLIC_CHECKIN_FILTERS)
+        query = apply_filters(query, PublicCheckin.created_at, request.args, PUBLIC_CHECKIN_FILTERS)
+        return stream_query(query.order_by(PublicCheckin.id), to_dict, archived)
+    checkins, next_cursor = paginate_archived(
+        'public_checkins', public_checkin_serializer, query, to_dict, request.args, PUBLIC_CHECKIN_FILTERS)
+    return paginated(checkins, next_cursor)
+
+def build_public_checkin(data):
+    data = with_media_urls(data)
+    return PublicCheckin(
+        id=str(uuid4()),
         user_id=data.get('user_id'),
         bathroom_id=data.get('bathroom_id'),
         bathroom_name=data.get('bathroom_name'),
@@ -831,119 +2727,366 @@ def create_public_checkin():
         custom_message=data.get('custom_message'),
         quick_tag=data.get('quick_tag'),
         image_url=data.get('image_url'),
+        image_thumbnail_url=data.get('image_thumbnail_url'),
         audio_url=data.get('audio_url'),
         is_anonymous=data.get('is_anonymous', False),
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow()
     )
+
+# ✅ Create a new public checkin
+@api.route('/public-checkins', methods=['POST'])
+def create_public_checkin():
+    data = request.get_json()
+    new_checkin = build_public_checkin(data)
     db.session.add(new_checkin)
+    on_public_checkin_created(new_checkin)
     db.session.commit()
     return jsonify({'message': 'Check-in created successfully', 'id': new_checkin.id}), 201
 
 # ✅ Get a single public checkin by ID
-@app.route('/public-checkins/<string:checkin_id>', methods=['GET'])
+@api.route('/public-checkins/<string:checkin_id>', methods=['GET'])
 def get_public_checkin(checkin_id):
-    checkin = PublicCheckin.query.get(checkin_id)
-    if not checkin:
+    _, result = get_row(public_checkin_detail_serializer, PublicCheckin.id, checkin_id)
+    if result is None:
         return jsonify({'message': 'Check-in not found'}), 404
-    return jsonify({
-        'id': checkin.id,
-        'user_id': checkin.user_id,
-        'bathroom_name': checkin.bathroom_name,
-        'location_name': checkin.location_name,
-        'custom_message': checkin.custom_message
-    })
+    return jsonify(result)
 
 # ✅ Update a public checkin
-@app.route('/public-checkins/<string:checkin_id>', methods=['PUT'])
+@api.route('/public-checkins/<string:checkin_id>', methods=['PUT'])
 def update_public_checkin(checkin_id):
     checkin = PublicCheckin.query.get(checkin_id)
     if not checkin:
         return jsonify({'message': 'Check-in not found'}), 404
 
-    data = request.get_json()
+    data = with_media_urls(request.get_json())
+    old_contribution = public_checkin_contribution(checkin)
+    old_heat = public_checkin_heat(checkin)
     for field in data:
         if hasattr(checkin, field):
             setattr(checkin, field, data[field])
     checkin.updated_at = datetime.utcnow()
 
+    new_contribution = public_checkin_contribution(checkin)
+    if new_contribution != old_contribution:
+        apply_rating_summary(old_contribution, -1)
+        apply_rating_summary(new_contribution, 1)
+    update_heatmap(old_heat, public_checkin_heat(checkin))
+    publish_checkin_event('updated', checkin)
     db.session.commit()
     return jsonify({'message': 'Check-in updated successfully'})
 
 # ✅ Delete a public checkin
-@app.route('/public-checkins/<string:checkin_id>', methods=['DELETE'])
+@api.route('/public-checkins/<string:checkin_id>', methods=['DELETE'])
 def delete_public_checkin(checkin_id):
     checkin = PublicCheckin.query.get(checkin_id)
     if not checkin:
         return jsonify({'message': 'Check-in not found'}), 404
+    contribution = public_checkin_contribution(checkin)
+    apply_heatmap(public_checkin_heat(checkin), -1)
     db.session.delete(checkin)
+    apply_rating_summary(contribution, -1)
+    publish_checkin_event('deleted', checkin)
     db.session.commit()
     return jsonify({'message': 'Check-in deleted successfully'})
 
+def on_public_checkin_created(checkin):
+    apply_rating_summary(public_checkin_contribution(checkin), 1)
+    apply_heatmap(public_checkin_heat(checkin), 1)
+    record_toilet_visit(checkin.user_id, checkin.bathroom_id)
+    publish_checkin_event('created', checkin)
+
+# ========== PUBLIC CHECKIN STREAM ==========
+# 社群動態不必每幾秒重抓列表：GET /public-checkins/stream 以 SSE 推送公開打卡的新增、修改、刪除。
+# PostgreSQL 上事件在寫入的同一個 transaction 裡 pg_notify，commit 之後才送出、rollback 就不送；
+# 每個 worker 有一條 LISTEN 執行緒把事件放進自己的 EventHub（live_events.py）。
+# 其他資料庫（本機開發）沒有跨行程的通道，commit 後直接放進本行程的 hub
+CHECKIN_CHANNEL = 'public_checkins'
+SSE_BUFFER_SIZE = int(os.getenv('SSE_BUFFER_SIZE', '1000'))  # Last-Event-ID 可以接續的最近事件數
+# 每條 SSE 連線佔一條執行緒（不佔資料庫連線），每個 worker 的上限；超過回 503，App 退回輪詢
+SSE_MAX_CLIENTS = int(os.getenv('SSE_MAX_CLIENTS', '50'))
+# 連線最長時間，到了就結束，讓用戶端帶 Last-Event-ID 重連（也讓 worker 能正常回收）
+SSE_MAX_SECONDS = int(os.getenv('SSE_MAX_SECONDS', '300'))
+SSE_KEEPALIVE_SECONDS = 15
+SSE_RETRY_MS = 3000
+NOTIFY_MAX_BYTES = 7900  # pg_notify 的 payload 上限是 8000 bytes
+
+checkin_events = EventHub(SSE_BUFFER_SIZE)
+_checkin_listener = None
+_checkin_listener_lock = threading.Lock()
+
+# 在 commit 之前呼叫；data 是整筆打卡（刪除時只有 id），太大塞不進 NOTIFY 時只送 id，由用戶端再查
+def publish_checkin_event(event, checkin):
+    dumps = current_app.json.dumps
+    event_id = uuid4().hex
+    if event == 'deleted':
+        data = dumps({'id': checkin.id})
+    else:
+        data = dumps({'id': checkin.id, 'checkin': {
+            key: getattr(checkin, key) for key in public_checkin_serializer.columns}})
+    if db.engine.dialect.name != 'postgresql':
+        after_commit(checkin_events.publish, event_id, event, data)
+        return
+    payload = dumps({'id': event_id, 'event': event, 'data': data})
+    if len(payload.encode('utf-8')) > NOTIFY_MAX_BYTES:
+        payload = dumps({'id': event_id, 'event': event, 'data': dumps({'id': checkin.id, 'truncated': True})})
+    db.session.execute(db.select(db.func.pg_notify(CHECKIN_CHANNEL, payload)))
+
+def _on_checkin_notify(payload):
+    message = json.loads(payload)
+    checkin_events.publish(message['id'], message['event'], message['data'])
+
+# 第一條 SSE 連線進來時才開始 LISTEN（在 fork 之後）；經過 PgBouncer transaction mode 時
+# LISTEN 收不到通知，要用 LISTEN_DATABASE_URL 指定直連資料庫的位址
+def ensure_checkin_listener():
+    global _checkin_listener
+    if _checkin_listener is not None or db.engine.dialect.name != 'postgresql':
+        return
+    with _checkin_listener_lock:
+        if _checkin_listener is not None:
+            return
+        import psycopg2
+        url = os.getenv('LISTEN_DATABASE_URL') or \
+            db.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+        listener = PgListener(lambda: psycopg2.connect(url), CHECKIN_CHANNEL, _on_checkin_notify,
+                              on_reconnect=checkin_events.clear, logger=current_app.logger)
+        listener.start()
+        _checkin_listener = listener
+
+# 事件：created / updated / deleted，data 是 JSON；id 即 Last-Event-ID。
+# 要的事件已經不在 buffer 裡（離線太久、LISTEN 重連過）時送 reset，用戶端應重新載入列表
+@api.route('/public-checkins/stream', methods=['GET'])
+def stream_public_checkins():
+    ensure_checkin_listener()
+    if not checkin_events.add_subscriber(SSE_MAX_CLIENTS):
+        response = jsonify({'error': 'Too many live connections, please poll instead'})
+        response.headers['Retry-After'] = str(SSE_RETRY_MS // 1000)
+        return response, 503
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    cursor, resumed = checkin_events.cursor(last_event_id)
+
+    # 不用 stream_with_context：串流期間不需要 app context，資料庫連線在回應開始時就還給連線池
+    def generate(cursor):
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        if not resumed:
+            yield sse_event(None, 'reset', '{}')
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            cursor, events, lost = checkin_events.wait(cursor, min(SSE_KEEPALIVE_SECONDS, remaining))
+            if lost:
+                yield sse_event(None, 'reset', '{}')
+                continue
+            if not events:
+                yield ': keepalive\n\n'  # 讓代理伺服器不會因為閒置而斷線
+            for _, event_id, event, data in events:
+                yield sse_event(event_id, event, data)
+
+    response = Response(generate(cursor), mimetype='text/event-stream')
+    response.call_on_close(checkin_events.remove_subscriber)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx 不要緩衝
+    return response
+
+# ========== TOILET RATINGS ==========
+# toilet_rating_summaries 以公廁為單位累計評論數與各項評分總和，
+# 隨 toilet_checkins（public_toilet_id）與 public_checkins（bathroom_id）增量更新。
+# 平均分數用貝氏平均，評論很少的公廁會被拉向 RATING_PRIOR_MEAN
+RATING_PRIOR_MEAN = float(os.getenv('RATING_PRIOR_MEAN', '3.0'))
+RATING_PRIOR_WEIGHT = float(os.getenv('RATING_PRIOR_WEIGHT', '5'))
+RATING_FIELDS = ('cleanliness', 'privacy', 'amenities')
+BEST_RATED_MAX_RADIUS = 20000
+BEST_RATED_CANDIDATES = 2000
+
+def _rating_value(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def toilet_checkin_contribution(c):
+    if not c.public_toilet_id:
+        return None
+    deltas = {'review_count': 1}
+    ratings = []
+    for field in RATING_FIELDS:
+        rating = _rating_value(getattr(c, f'toilet_rating_{field}'))
+        if rating is not None:
+            deltas[f'{field}_sum'] = rating
+            deltas[f'{field}_count'] = 1
+            ratings.append(rating)
+    if ratings:
+        deltas['overall_sum'] = sum(ratings) / len(ratings)
+        deltas['overall_count'] = 1
+    return c.public_toilet_id, c.checkin_time, deltas
+
+def public_checkin_contribution(c):
+    if not c.bathroom_id:
+        return None
+    deltas = {'review_count': 1}
+    rating = _rating_value(c.rating)
+    if rating is not None:
+        deltas['overall_sum'] = rating
+        deltas['overall_count'] = 1
+    return c.bathroom_id, c.created_at, deltas
+
+def apply_rating_summary(contribution, sign):
+    if contribution is None:
+        return
+    toilet_id, reviewed_at, deltas = contribution
+    deltas = {key: value * sign for key, value in deltas.items()}
+    table = ToiletRatingSummary.__table__
+    insert = dialect_insert(db.session)
+    stmt = insert(table).values(toilet_id=toilet_id, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.toilet_id],
+        set_={key: table.c[key] + stmt.excluded[key] for key in deltas},
+    )
+    db.session.execute(stmt)
+    after_commit(response_cache.invalidate, f'toilet_rating:{toilet_id}')
+    if sign > 0:
+        if reviewed_at is not None:
+            db.session.execute(table.update().where(
+                table.c.toilet_id == toilet_id,
+                (table.c.last_review_at.is_(None)) | (table.c.last_review_at < reviewed_at),
+            ).values(last_review_at=reviewed_at))
+        return
+    db.session.execute(table.delete().where(table.c.toilet_id == toilet_id, table.c.review_count <= 0))
+    # 最新評論被刪掉時 last_review_at 要重算（刪除很少發生，直接查兩張表）
+    latest = [
+        db.session.query(db.func.max(ToiletCheckin.checkin_time))
+        .filter(ToiletCheckin.public_toilet_id == toilet_id).scalar(),
+        db.session.query(db.func.max(PublicCheckin.created_at))
+        .filter(PublicCheckin.bathroom_id == toilet_id).scalar(),
+    ]
+    latest = [ts for ts in latest if ts is not None]
+    db.session.execute(table.update().where(table.c.toilet_id == toilet_id)
+                       .values(last_review_at=max(latest) if latest else None))
+
+def _average(total, count):
+    return round(total / count, 2) if count else None
+
+def bayesian_average(summary):
+    total = summary.overall_sum if summary is not None else 0
+    count = summary.overall_count if summary is not None else 0
+    return (RATING_PRIOR_WEIGHT * RATING_PRIOR_MEAN + total) / (RATING_PRIOR_WEIGHT + count)
+
+def rating_summary_to_dict(summary):
+    if summary is None:
+        return {'review_count': 0, 'rated_count': 0, 'average': None, 'bayesian_average': None,
+                'cleanliness': None, 'privacy': None, 'amenities': None, 'last_review_at': None}
+    result = {
+        'review_count': summary.review_count,
+        'rated_count': summary.overall_count,
+        'average': _average(summary.overall_sum, summary.overall_count),
+        'bayesian_average': round(bayesian_average(summary), 2) if summary.overall_count else None,
+        'last_review_at': summary.last_review_at,
+    }
+    for field in RATING_FIELDS:
+        result[field] = _average(getattr(summary, f'{field}_sum'), getattr(summary, f'{field}_count'))
+    return result
+
+def load_rating_summaries(toilet_ids):
+    if not toilet_ids:
+        return {}
+    rows = ToiletRatingSummary.query.filter(ToiletRatingSummary.toilet_id.in_(toilet_ids)).all()
+    return {row.toilet_id: row for row in rows}
+
+@api.route('/toilets/<string:toilet_id>/summary', methods=['GET'])
+@response_cache.cached(ttl=300, tags=lambda toilet_id: [f'toilet_rating:{toilet_id}'])
+def get_toilet_summary(toilet_id):
+    summary = db.session.get(ToiletRatingSummary, toilet_id)
+    return jsonify(dict(rating_summary_to_dict(summary), toilet_id=toilet_id))
+
+# 附近評價最好的公廁：先用空間索引取半徑內候選，再依貝氏平均排序
+@api.route('/toilets/best-rated', methods=['GET'])
+def get_best_rated_toilets():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'error': 'lat and lon are required'}), 400
+    radius = min(request.args.get('radius', 2000, type=float), BEST_RATED_MAX_RADIUS)
+    n = min(max(request.args.get('n', 10, type=int), 1), NEARBY_MAX_K)
+    min_reviews = request.args.get('min_reviews', 1, type=int)
+    if radius <= 0:
+        return jsonify({'error': 'radius must be positive'}), 400
+
+    hits = get_toilet_index().nearest(lat, lon, BEST_RATED_CANDIDATES, max_radius_m=radius)
+    summaries = load_rating_summaries([t['toilet_id'] for _, t in hits])
+    ranked = [
+        (bayesian_average(summaries[t['toilet_id']]), -d, d, t)
+        for d, t in hits
+        if t['toilet_id'] in summaries and summaries[t['toilet_id']].overall_count >= min_reviews
+    ]
+    ranked.sort(key=lambda r: (r[0], r[1]), reverse=True)
+    return jsonify([
+        dict(t, distance_m=round(d, 1), rating=rating_summary_to_dict(summaries[t['toilet_id']]))
+        for _, _, d, t in ranked[:n]
+    ])
+
+@toilets_cli.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """從 toilet_checkins 與 public_checkins 重建 toilet_rating_summaries。"""
+    totals = {}
+
+    def accumulate(contribution):
+        if contribution is None:
+            return
+        toilet_id, reviewed_at, deltas = contribution
+        acc = totals.setdefault(toilet_id, {'last_review_at': None})
+        for key, value in deltas.items():
+            acc[key] = acc.get(key, 0) + value
+        if reviewed_at is not None and (acc['last_review_at'] is None or reviewed_at > acc['last_review_at']):
+            acc['last_review_at'] = reviewed_at
+
+    for c in ToiletCheckin.query.yield_per(STREAM_BATCH_SIZE):
+        accumulate(toilet_checkin_contribution(c))
+    for c in PublicCheckin.query.yield_per(STREAM_BATCH_SIZE):
+        accumulate(public_checkin_contribution(c))
+
+    table = ToiletRatingSummary.__table__
+    columns = [c.name for c in table.columns if c.name not in ('toilet_id', 'last_review_at')]
+    rows = [
+        dict({name: acc.get(name, 0) for name in columns}, toilet_id=toilet_id, last_review_at=acc['last_review_at'])
+        for toilet_id, acc in totals.items()
+    ]
+    db.session.execute(table.delete())
+    for start in range(0, len(rows), 1000):
+        db.session.execute(table.insert(), rows[start:start + 1000])
+    db.session.commit()
+    click.echo(f'Rebuilt {len(rows)} toilet summaries')
+
 # ========== PRIVATE_CHECKINS ==========
+private_checkin_serializer = RowSerializer(PrivateCheckin)
+
 # GET all private_checkins
-@app.route('/private-checkins', methods=['GET'])
+@api.route('/private-checkins', methods=['GET'])
+@require_auth
 def get_all_private_checkins():
-    checkins = PrivateCheckin.query.all()
-    return jsonify([{
-        'id': c.id,
-        'user_id': c.user_id,
-        'bathroom_id': c.bathroom_id,
-        'bathroom_name': c.bathroom_name,
-        'bathroom_address': c.bathroom_address,
-        'bathroom_type': c.bathroom_type,
-        'bathroom_source': c.bathroom_source,
-        'latitude': c.latitude,
-        'longitude': c.longitude,
-        'location_name': c.location_name,
-        'mood_emoji': c.mood_emoji,
-        'bristol_type': c.bristol_type,
-        'rating': c.rating,
-        'note': c.note,
-        'custom_message': c.custom_message,
-        'quick_tag': c.quick_tag,
-        'image_url': c.image_url,
-        'audio_url': c.audio_url,
-        'personal_notes': c.personal_notes,
-        'health_notes': c.health_notes,
-        'created_at': c.created_at,
-        'updated_at': c.updated_at
-    } for c in checkins])
+    query, to_dict = select_rows(private_checkin_serializer, PrivateCheckin.created_at, PrivateCheckin.id)
+    checkins, next_cursor = paginate_archived(
+        'private_checkins', private_checkin_serializer, query, to_dict, scoped_args(),
+        {'user_id': (PrivateCheckin.user_id, str),
+         'bathroom_id': (PrivateCheckin.bathroom_id, str),
+         'bristol_type': (PrivateCheckin.bristol_type, int)})
+    return paginated(checkins, next_cursor)
 
 # GET single private_checkin
-@app.route('/private-checkins/<string:checkin_id>', methods=['GET'])
+@api.route('/private-checkins/<string:checkin_id>', methods=['GET'])
+@require_auth
 def get_private_checkin(checkin_id):
-    checkin = PrivateCheckin.query.get_or_404(checkin_id)
-    return jsonify({
-        'id': checkin.id,
-        'user_id': checkin.user_id,
-        'bathroom_id': checkin.bathroom_id,
-        'bathroom_name': checkin.bathroom_name,
-        'bathroom_address': checkin.bathroom_address,
-        'bathroom_type': checkin.bathroom_type,
-        'bathroom_source': checkin.bathroom_source,
-        'latitude': checkin.latitude,
-        'longitude': checkin.longitude,
-        'location_name': checkin.location_name,
-        'mood_emoji': checkin.mood_emoji,
-        'bristol_type': checkin.bristol_type,
-        'rating': checkin.rating,
-        'note': checkin.note,
-        'custom_message': checkin.custom_message,
-        'quick_tag': checkin.quick_tag,
-        'image_url': checkin.image_url,
-        'audio_url': checkin.audio_url,
-        'personal_notes': checkin.personal_notes,
-        'health_notes': checkin.health_notes,
-        'created_at': checkin.created_at,
-        'updated_at': checkin.updated_at
-    })
+    row, result = get_row(private_checkin_serializer, PrivateCheckin.id, checkin_id, PrivateCheckin.user_id)
+    if result is None:
+        abort(404)
+    if not can_access(row.user_id):
+        return forbidden()
+    return jsonify(result)
 
-# POST create new private_checkin
-@app.route('/private-checkins', methods=['POST'])
-def create_private_checkin():
-    data = request.get_json()
-    new_checkin = PrivateCheckin(
+def build_private_checkin(data):
+    data = with_media_urls(data)
+    return PrivateCheckin(
         id=str(uuid4()),
         user_id=data['user_id'],
         bathroom_id=data.get('bathroom_id'),
@@ -961,40 +3104,523 @@ def create_private_checkin():
         custom_message=data.get('custom_message'),
         quick_tag=data.get('quick_tag'),
         image_url=data.get('image_url'),
+        image_thumbnail_url=data.get('image_thumbnail_url'),
         audio_url=data.get('audio_url'),
         personal_notes=data.get('personal_notes'),
         health_notes=data.get('health_notes'),
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow()
     )
+
+# POST create new private_checkin
+@api.route('/private-checkins', methods=['POST'])
+@require_auth
+def create_private_checkin():
+    data = scoped_data(request.get_json(), str)
+    new_checkin = build_private_checkin(data)
     db.session.add(new_checkin)
+    on_private_checkin_created(new_checkin)
     db.session.commit()
     return jsonify({'message': 'Private checkin created', 'id': new_checkin.id}), 201
 
+def on_private_checkin_created(checkin):
+    record_sync_change('private_checkin', checkin.user_id, checkin.id)
+
 # PUT update private_checkin
-@app.route('/private-checkins/<string:checkin_id>', methods=['PUT'])
+@api.route('/private-checkins/<string:checkin_id>', methods=['PUT'])
+@require_auth
 def update_private_checkin(checkin_id):
-    data = request.get_json()
+    data = with_media_urls(scoped_data(request.get_json(), str))
     checkin = PrivateCheckin.query.get_or_404(checkin_id)
+    if not can_access(checkin.user_id):
+        return forbidden()
 
     for key in data:
         if hasattr(checkin, key):
             setattr(checkin, key, data[key])
     checkin.updated_at = datetime.utcnow()
 
+    record_sync_change('private_checkin', checkin.user_id, checkin.id)
     db.session.commit()
     return jsonify({'message': 'Private checkin updated'})
 
 # DELETE private_checkin
-@app.route('/private-checkins/<string:checkin_id>', methods=['DELETE'])
+@api.route('/private-checkins/<string:checkin_id>', methods=['DELETE'])
+@require_auth
 def delete_private_checkin(checkin_id):
     checkin = PrivateCheckin.query.get_or_404(checkin_id)
+    if not can_access(checkin.user_id):
+        return forbidden()
+    record_sync_change('private_checkin', checkin.user_id, checkin.id, deleted=True)
     db.session.delete(checkin)
     db.session.commit()
     return jsonify({'message': 'Private checkin deleted'})
 
 
+# ========== OFFLINE SYNC ==========
+# 手機離線時排隊的紀錄一次送上來：同一個 transaction 批次寫入，
+# 每筆帶 idempotency_key，重送時直接回傳第一次建立的結果
+SYNC_BATCH_MAX_ITEMS = int(os.getenv('SYNC_BATCH_MAX_ITEMS', '500'))
+
+# type -> (builder, 主鍵欄位, 建立後的掛勾)
+SYNC_KINDS = {
+    'poop_record': (build_poop_record, 'record_id', on_poop_record_created),
+    'toilet_checkin': (build_toilet_checkin, 'toilet_checkin_id', on_toilet_checkin_created),
+    'public_checkin': (build_public_checkin, 'id', on_public_checkin_created),
+    'private_checkin': (build_private_checkin, 'id', on_private_checkin_created),
+}
+
+def apply_sync_batch(items):
+    results = [None] * len(items)
+    keys = [item.get('idempotency_key') for item in items if isinstance(item, dict)]
+    keys = [k for k in keys if k and isinstance(k, str)]
+    existing = {}
+    if keys:
+        existing = {
+            k.idempotency_key: k
+            for k in IdempotencyKey.query.filter(IdempotencyKey.idempotency_key.in_(keys))
+        }
+
+    created = []  # (index, key, kind, obj)
+    seen = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {'index': i, 'status': 'error', 'error': 'item must be an object'}
+            continue
+        key = item.get('idempotency_key')
+        kind = item.get('type')
+        if not key or not isinstance(key, str) or len(key) > 100:
+            results[i] = {'index': i, 'status': 'error', 'error': 'idempotency_key is required'}
+            continue
+        if key in existing:
+            prev = existing[key]
+            results[i] = {'index': i, 'idempotency_key': key, 'type': prev.kind,
+                          'status': 'duplicate', 'id': prev.resource_id}
+            continue
+        if key in seen:
+            seen[key].append(i)
+            continue
+        if kind not in SYNC_KINDS:
+            results[i] = {'index': i, 'idempotency_key': key, 'status': 'error', 'error': 'unknown type'}
+            continue
+        data = item.get('data') or {}
+        if not isinstance(data, dict):
+            results[i] = {'index': i, 'idempotency_key': key, 'type': kind,
+                          'status': 'error', 'error': 'invalid data: must be an object'}
+            continue
+        builder = SYNC_KINDS[kind][0]
+        try:
+            obj = builder(data)
+        except (KeyError, ValueError, TypeError) as e:
+            results[i] = {'index': i, 'idempotency_key': key, 'type': kind,
+                          'status': 'error', 'error': f'invalid data: {e}'}
+            continue
+        seen[key] = []
+        created.append((i, key, kind, obj))
+
+    # 一次 flush，SQLAlchemy 會以多列 INSERT 寫入並取回主鍵
+    db.session.add_all([obj for _, _, _, obj in created])
+    db.session.flush()
+    keys_to_add = []
+    for i, key, kind, obj in created:
+        after_create = SYNC_KINDS[kind][2]
+        if after_create is not None:
+            after_create(obj)
+        resource_id = getattr(obj, SYNC_KINDS[kind][1])
+        keys_to_add.append(IdempotencyKey(idempotency_key=key, kind=kind, resource_id=str(resource_id)))
+        results[i] = {'index': i, 'idempotency_key': key, 'type': kind,
+                      'status': 'created', 'id': str(resource_id)}
+        for j in seen[key]:
+            results[j] = dict(results[i], index=j, status='duplicate')
+    db.session.add_all(keys_to_add)
+    db.session.commit()
+    return results
+
+@api.route('/sync/batch', methods=['POST'])
+@require_auth
+def sync_batch():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'body must be a JSON object'}), 400
+    items = data.get('items')
+    if not isinstance(items, list):
+        return jsonify({'error': 'items must be a list'}), 400
+    if len(items) > SYNC_BATCH_MAX_ITEMS:
+        return jsonify({'error': f'at most {SYNC_BATCH_MAX_ITEMS} items per batch'}), 413
+    for item in items:
+        if isinstance(item, dict) and isinstance(item.get('data'), dict):
+            cast = str if item.get('type') in ('public_checkin', 'private_checkin') else int
+            item['data'] = scoped_data(item['data'], cast)
+
+    try:
+        results = apply_sync_batch(items)
+    except IntegrityError:
+        # 同一批 key 被另一個請求同時寫入，重來一次就會被當成 duplicate
+        db.session.rollback()
+        results = apply_sync_batch(items)
+    return jsonify({'results': results})
+
+# ========== DELTA SYNC ==========
+# App 啟動時只拿上次之後變更的私人打卡與排便紀錄：每次新增、修改、刪除都把該筆在
+# sync_changes 的序號更新成該使用者的下一個序號，GET /sync?since= 只讀序號更大的那幾列，
+# 成本跟變更數成正比，跟歷史資料量無關。刪除的留下 tombstone，裝置才知道要刪掉本機那筆
+SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', '500'))
+SYNC_MAX_PAGE_SIZE = 2000
+
+# kind -> (回應裡的 key, model, 主鍵欄位, serializer, 主鍵型別)
+DELTA_SYNC_KINDS = {
+    'poop_record': ('poop_records', PoopRecord, PoopRecord.record_id, poop_record_serializer, int),
+    'private_checkin': ('private_checkins', PrivateCheckin, PrivateCheckin.id, private_checkin_serializer, str),
+}
+
+# 在寫入的同一個 transaction 裡呼叫（刪除要在 delete 之前）
+def record_sync_change(kind, user_id, resource_id, deleted=False):
+    if user_id is None or resource_id is None:
+        return
+    user_id = str(user_id)
+    insert = dialect_insert(db.session)
+    counters = SyncCounter.__table__
+    stmt = insert(counters).values(user_id=user_id, seq=1)
+    stmt = stmt.on_conflict_do_update(index_elements=[counters.c.user_id], set_={'seq': counters.c.seq + 1})
+    seq = db.session.execute(stmt.returning(counters.c.seq)).scalar_one()
+
+    changes = SyncChange.__table__
+    stmt = insert(changes).values(kind=kind, resource_id=str(resource_id), user_id=user_id, seq=seq,
+                                  deleted=deleted, changed_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[changes.c.kind, changes.c.resource_id],
+        set_={key: stmt.excluded[key] for key in ('user_id', 'seq', 'deleted', 'changed_at')},
+    )
+    db.session.execute(stmt)
+
+# since 是上一次回應的 next（第一次同步不帶）；has_more 為 true 時用新的 next 繼續拿下一頁
+@api.route('/sync', methods=['GET'])
+@require_auth
+def delta_sync():
+    user_id = scoped_args().get('user_id')
+    if not user_id:
+        return jsonify({'error': 'user_id is required'}), 400
+    since = request.args.get('since', '0')
+    limit = request.args.get('limit', SYNC_PAGE_SIZE, type=int)
+    if not since.isdigit():
+        return jsonify({'error': 'invalid since token'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, SYNC_MAX_PAGE_SIZE)
+
+    rows = db.session.query(SyncChange.kind, SyncChange.resource_id, SyncChange.seq, SyncChange.deleted) \
+        .filter(SyncChange.user_id == str(user_id), SyncChange.seq > int(since)) \
+        .order_by(SyncChange.seq).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    changed = {key: [] for key, *_ in DELTA_SYNC_KINDS.values()}
+    deleted = {key: [] for key, *_ in DELTA_SYNC_KINDS.values()}
+    for kind, (key, model, pk_col, serializer, cast) in DELTA_SYNC_KINDS.items():
+        ids = [cast(r.resource_id) for r in rows if r.kind == kind and not r.deleted]
+        if ids:
+            columns, to_dict = serializer.select(None, (pk_col,))
+            changed[key] = [to_dict(row) for row in db.session.query(*columns).filter(pk_col.in_(ids))]
+        deleted[key] = [cast(r.resource_id) for r in rows if r.kind == kind and r.deleted]
+
+    return jsonify({
+        'changed': changed,
+        'deleted': deleted,
+        'next': str(rows[-1].seq) if rows else since,
+        'has_more': has_more,
+    })
+
+# ========== PARTITIONS & ARCHIVE ==========
+# 排便紀錄與打卡依時間按月分割：PostgreSQL 用原生 range partition（`flask partitions setup`），
+# 超過 ARCHIVE_RETENTION_MONTHS 個月的月份由 archive_partition 工作寫成壓縮的欄式封存檔，
+# 再整個 partition 丟掉。列表查詢的範圍（from 或翻頁到的位置）早於封存邊界時，
+# 才會另外讀封存檔，依相同的 (時間 DESC, 主鍵 DESC) 順序與資料庫的結果合併。
+# 封存的資料只能讀：不能修改、刪除，也不在 GET /sync 的增量裡
+ARCHIVE_RETENTION_MONTHS = int(os.getenv('ARCHIVE_RETENTION_MONTHS', '12'))
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+# 其他 worker 封存後，最多這麼多秒才會改讀封存檔
+ARCHIVE_MANIFEST_TTL = float(os.getenv('ARCHIVE_MANIFEST_TTL', '60'))
+
+# 封存檔的位置必須明確設定，而且要是 web 與 worker 都讀得到、不會隨容器消失的磁碟；
+# 沒設定時不會封存（資料庫裡的資料不會被刪掉）
+ARCHIVE_ROOT = os.getenv('ARCHIVE_ROOT')
+archive_store = ArchiveStore(ARCHIVE_ROOT or os.path.join(os.getcwd(), 'archive'),
+                             cache_files=int(os.getenv('ARCHIVE_CACHE_FILES', '16')))
+
+# 資料表 -> (model, 時間欄位, 主鍵欄位, sync_changes 的 kind)
+ARCHIVED_TABLES = {
+    'poop_records': (PoopRecord, PoopRecord.record_time, PoopRecord.record_id, 'poop_record'),
+    'toilet_checkins': (ToiletCheckin, ToiletCheckin.checkin_time, ToiletCheckin.toilet_checkin_id, None),
+    'public_checkins': (PublicCheckin, PublicCheckin.created_at, PublicCheckin.id, None),
+    'private_checkins': (PrivateCheckin, PrivateCheckin.created_at, PrivateCheckin.id, 'private_checkin'),
+}
+
+_archive_manifest = None  # 資料表 -> [period]，由新到舊
+_archive_manifest_loaded_at = 0.0
+
+def invalidate_archive_manifest():
+    global _archive_manifest
+    _archive_manifest = None
+
+def archived_periods(table):
+    global _archive_manifest, _archive_manifest_loaded_at
+    manifest = _archive_manifest
+    if manifest is None or time.monotonic() - _archive_manifest_loaded_at >= ARCHIVE_MANIFEST_TTL:
+        manifest = {}
+        rows = db.session.query(ArchivedPartition.table_name, ArchivedPartition.period) \
+            .order_by(ArchivedPartition.period.desc())
+        for table_name, period in rows:
+            manifest.setdefault(table_name, []).append(period)
+        _archive_manifest = manifest
+        _archive_manifest_loaded_at = time.monotonic()
+    return manifest.get(table, [])
+
+# 依查詢參數讀封存檔，回傳依分頁順序產生 names 欄位 tuple 的 iterator（讀檔延後到取值時）
+def scan_archived(table, names, args, filters, after=None):
+    model, time_col, pk_col, _ = ARCHIVED_TABLES[table]
+    since = parse_time(args.get('from'), 'from')
+    until = parse_time(args.get('to'), 'to')
+    if after is not None and after[0] is None:
+        return iter(())
+    keys = []
+    for period in archived_periods(table):
+        month = partitions.parse_period(period)
+        if (until is not None and month >= until) or (since is not None and partitions.add_months(month, 1) <= since):
+            continue
+        if after is not None and month > after[0]:
+            continue  # 游標之後只會是游標那個月與更舊的月份
+        keys.append(archive_store.key(table, period))
+    if not keys:
+        return iter(())
+    where = {}
+    for name, (column, cast) in filters.items():
+        value = args.get(name)
+        if value is None or value == '':
+            continue
+        try:
+            where[column.key] = cast(value)
+        except ValueError:
+            raise InvalidPageRequest(f'{name} has an invalid value')
+    return scan_archive(archive_store, keys, names, time_col.key, pk_col.key, where, since, until, after)
+
+# 串流匯出時接在資料庫結果後面的封存資料列，欄位順序與 select_rows 相同
+def archived_rows(table, serializer, args, filters):
+    model, time_col, pk_col, _ = ARCHIVED_TABLES[table]
+    columns, _ = serializer.select(args.get('fields'), (time_col, pk_col))
+    return scan_archived(table, [c.key for c in columns], args, filters)
+
+def paginate_archived(table, serializer, query, to_dict, args, filters):
+    """跟 paginate 一樣回傳 (dict 列表, next_cursor)，範圍早於封存邊界時合併封存檔的資料。"""
+    model, time_col, pk_col, _ = ARCHIVED_TABLES[table]
+    rows, next_cursor = paginate(query, time_col, pk_col, args, filters)
+    periods = archived_periods(table)
+    if not periods:
+        return [to_dict(r) for r in rows], next_cursor
+    # 邊界：最新一個封存月份的下個月，資料庫裡這之前的月份大多已經搬走
+    horizon = partitions.add_months(partitions.parse_period(periods[0]), 1)
+    since = parse_time(args.get('from'), 'from')
+    if since is not None and since >= horizon:
+        return [to_dict(r) for r in rows], next_cursor
+    names = [d['name'] for d in query.column_descriptions]
+    t, pk = names.index(time_col.key), names.index(pk_col.key)
+    if next_cursor and rows[-1][t] is not None and rows[-1][t] >= horizon:
+        return [to_dict(r) for r in rows], next_cursor
+
+    limit = parse_limit(args)
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    archived = list(itertools.islice(scan_archived(table, names, args, filters, after), limit + 1))
+    merged = sorted(itertools.chain(rows, archived), reverse=True,
+                    key=lambda r: (r[t] is not None, r[t] or datetime.min, r[pk]))
+    more = next_cursor is not None or len(merged) > limit
+    merged = merged[:limit]
+    next_cursor = encode_cursor(merged[-1][t], merged[-1][pk]) if more else None
+    return [to_dict(r) for r in merged], next_cursor
+
+def archive_month(table, month):
+    """把一個月的資料寫成封存檔並從資料庫移除，回傳封存的列數；已封存或沒有資料時回傳 None。
+
+    可以重複執行（寫檔前會檢查 manifest），由呼叫端 commit。
+    """
+    if not ARCHIVE_ROOT:
+        raise RuntimeError('ARCHIVE_ROOT must be set to shared, persistent storage before archiving')
+    model, time_col, pk_col, sync_kind = ARCHIVED_TABLES[table]
+    period = partitions.period_key(month)
+    if db.session.get(ArchivedPartition, (table, period)) is not None:
+        return None
+    in_range = db.and_(time_col >= month, time_col < partitions.add_months(month, 1))
+    if db.session.query(pk_col).filter(in_range).first() is None:
+        return None
+
+    columns = list(model.__table__.columns)
+    query = db.session.query(*(getattr(model, c.key) for c in columns)).filter(in_range)
+    key, count, size = archive_store.write(
+        table, period, [c.key for c in columns], (tuple(r) for r in query.yield_per(STREAM_BATCH_SIZE)),
+        datetime_columns={c.key for c in columns if isinstance(c.type, db.DateTime)})
+    # 刪資料前確認檔案讀得回來、列數跟資料庫裡這個月一致（寫檔期間有新寫入就等下次重試）
+    written = ArchiveFile(os.path.join(archive_store.root, key))
+    if written.rows != count or len(written.column(pk_col.key)) != count:
+        raise RuntimeError(f'archive {key} has {written.rows} rows, expected {count}')
+    current = db.session.query(db.func.count()).select_from(model).filter(in_range).scalar()
+    if current != count:
+        raise RuntimeError(f'{table} {period} changed while archiving ({current} rows, archived {count})')
+
+    if sync_kind is not None:
+        archived_ids = db.session.query(db.cast(pk_col, db.String)).filter(in_range)
+        db.session.query(SyncChange).filter(SyncChange.kind == sync_kind,
+                                            SyncChange.resource_id.in_(archived_ids.scalar_subquery())) \
+            .delete(synchronize_session=False)
+    conn = db.session.connection()
+    if db.engine.dialect.name == 'postgresql' and partitions.is_partitioned(conn, table) \
+            and partitions.partition_exists(conn, table, month):
+        partitions.drop_partition(conn, table, month)
+    # 沒有分割的表，或 partition 建立前就落在 default partition 的資料
+    db.session.query(model).filter(in_range).delete(synchronize_session=False)
+    db.session.add(ArchivedPartition(table_name=table, period=period, path=key, row_count=count,
+                                     size_bytes=size, archived_at=datetime.utcnow()))
+    after_commit(invalidate_archive_manifest)
+    return count
+
+# 超過保留期限、還留在資料庫裡的 (資料表, 月份)
+def archive_due_months():
+    cutoff = partitions.add_months(partitions.month_start(datetime.utcnow()), -ARCHIVE_RETENTION_MONTHS)
+    due = []
+    for table, (model, time_col, pk_col, _) in ARCHIVED_TABLES.items():
+        oldest = db.session.query(db.func.min(time_col)).filter(time_col < cutoff).scalar()
+        month = partitions.month_start(oldest) if oldest is not None else cutoff
+        while month < cutoff:
+            due.append((table, month))
+            month = partitions.add_months(month, 1)
+    return due
+
+@job_handler('archive_partition')
+def archive_partition_job(payload):
+    archive_month(payload['table'], partitions.parse_period(payload['period']))
+
+partitions_cli = AppGroup('partitions', help='按月分割與冷資料封存')
+
+@partitions_cli.command('setup')
+def partitions_setup_command():
+    """把紀錄與打卡表轉成按月分割的表（PostgreSQL；會鎖表，請在維護時段執行）。"""
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException('native partitioning requires PostgreSQL')
+    until = partitions.add_months(partitions.month_start(datetime.utcnow()), PARTITION_MONTHS_AHEAD + 1)
+    for table, (model, time_col, pk_col, _) in ARCHIVED_TABLES.items():
+        with db.engine.begin() as conn:
+            if partitions.is_partitioned(conn, table):
+                click.echo(f'{table}: already partitioned')
+                continue
+            partitions.convert_to_partitioned(conn, table, time_col.key, pk_col.key,
+                                              model.__table__.indexes, until)
+        click.echo(f'{table}: partitioned by {time_col.key}')
+
+@partitions_cli.command('ensure')
+def partitions_ensure_command():
+    """建立接下來 PARTITION_MONTHS_AHEAD 個月的 partition；請每月排程執行。"""
+    if db.engine.dialect.name != 'postgresql':
+        click.echo('Not PostgreSQL, nothing to do')
+        return
+    start = partitions.month_start(datetime.utcnow())
+    until = partitions.add_months(start, PARTITION_MONTHS_AHEAD + 1)
+    with db.engine.begin() as conn:
+        for table in ARCHIVED_TABLES:
+            if partitions.is_partitioned(conn, table):
+                partitions.ensure_partitions(conn, table, start, until)
+    click.echo(f'Partitions ready until {partitions.period_key(until)}')
+
+@partitions_cli.command('archive')
+@click.option('--enqueue', is_flag=True, help='交給 worker 執行，而不是在這裡執行')
+def partitions_archive_command(enqueue):
+    """封存超過保留期限的月份。"""
+    if not ARCHIVE_ROOT:
+        raise click.ClickException('ARCHIVE_ROOT must be set to shared, persistent storage')
+    due = archive_due_months()
+    for table, month in due:
+        period = partitions.period_key(month)
+        if enqueue:
+            enqueue_job('archive_partition', {'table': table, 'period': period},
+                        ref=f'archive:{table}:{period}')
+            continue
+        count = archive_month(table, month)
+        db.session.commit()
+        if count is not None:
+            click.echo(f'{table} {period}: archived {count} rows')
+    if enqueue:
+        db.session.commit()
+        click.echo(f'Enqueued {len(due)} archive jobs')
+
+@partitions_cli.command('list')
+def partitions_list_command():
+    """列出已封存的月份。"""
+    for row in ArchivedPartition.query.order_by(ArchivedPartition.table_name, ArchivedPartition.period):
+        click.echo(f'{row.table_name:17} {row.period} {row.row_count:>9} rows {row.size_bytes:>12} bytes  {row.path}')
+
+api.cli.add_command(partitions_cli)
+
+# ---------------- CLI ----------------
+
+@api.cli.command('init-db')
+def init_db_command():
+    """建立尚未存在的資料表。"""
+    db.create_all()
+    click.echo('Database tables created')
+
+db_cli = AppGroup('db', help='資料庫結構版本（migrations.py）')
+
+@db_cli.command('upgrade')
+def db_upgrade_command():
+    """建立新的資料表並套用尚未執行的 migration。"""
+    try:
+        applied = migrations.upgrade(db.engine, db.metadata, echo=click.echo)
+    except migrations.MigrationError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Applied {len(applied)} migrations' if applied else 'Already up to date')
+
+@db_cli.command('current')
+def db_current_command():
+    """列出已套用與尚未套用的 migration。"""
+    done = migrations.applied_versions(db.engine)
+    for migration in migrations.MIGRATIONS:
+        status = 'applied' if migration.version in done else 'pending'
+        click.echo(f'{migration.version:04d} {status:8} {migration.description}')
+
+api.cli.add_command(db_cli)
+
+# ---------------- App factory ----------------
+
+def create_app(config=None):
+    """建立 app；gunicorn 以 'app:create_app()' 載入，`flask --app app` 也會自動找到這裡。
+
+    model 與路由在 import 時就定義好，preload 時由 master 載入一次，fork 出的 worker 共用那些記憶體。
+    """
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    CORS(app, expose_headers=['X-Next-Cursor'])
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri_from_env()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = SECRET_KEY
+    app.config.update(config or {})
+    if EPHEMERAL_SECRET_KEY and not (app.debug or app.testing):
+        raise RuntimeError('SECRET_KEY is not set; every restart and every worker would sign tokens with a different key')
+    # 連線池設定（DB_POOL_SIZE、DB_MAX_OVERFLOW、DB_POOL_TIMEOUT、DB_POOL_RECYCLE、DB_PGBOUNCER...）
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options_from_env(app.config['SQLALCHEMY_DATABASE_URI']))
+    db.init_app(app)
+    app.register_blueprint(api)
+    with app.app_context():
+        instrument(db.engine)
+    return app
+
+def dispose_engines_after_fork(app):
+    """fork 出的行程不能沿用父行程連線池裡的連線（兩邊共用同一個 socket 會讓協定錯亂）。
+
+    close=False：只丟掉繼承來的連線池，不去關父行程還在用的連線。
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
 # ---------------- 啟動 ----------------
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    create_app({'DEBUG': True}).run(host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,172 @@
+import json
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+MAGIC = b'PPARC1\n'
+
+
+class ArchiveStore:
+    """封存檔：每張表每個月一個欄式（columnar）壓縮檔，放在本機的 root 底下。
+
+    檔案格式是 MAGIC、4 bytes 的 header 長度、JSON header，接著每一欄各自一個
+    zlib 壓縮的 JSON 陣列。同一欄的值很相似，壓縮率比逐列好；查詢時先只解開
+    時間、主鍵與篩選用的欄位，找到要的列之後才解開其他欄位。
+    """
+
+    def __init__(self, root, cache_files=16):
+        self.root = root
+        self.cache_files = cache_files
+        self._cache = OrderedDict()  # key -> (mtime, ArchiveFile)
+        self._lock = threading.Lock()
+
+    def key(self, table, period):
+        return os.path.join(table, f'{period}.parc')
+
+    def write(self, table, period, columns, rows, datetime_columns=()):
+        """把 rows（依 columns 順序的 tuple）寫成封存檔，回傳 (key, 列數, 檔案大小)。"""
+        values = [[] for _ in columns]
+        for row in rows:
+            for column_values, value in zip(values, row):
+                column_values.append(value)
+        blocks = []
+        header_columns = []
+        offset = 0
+        for name, column_values in zip(columns, values):
+            if name in datetime_columns:
+                column_values = [v.isoformat() if v is not None else None for v in column_values]
+            block = zlib.compress(json.dumps(column_values, ensure_ascii=False, separators=(',', ':'),
+                                             default=str).encode('utf-8'), 9)
+            header_columns.append({'name': name, 'datetime': name in datetime_columns,
+                                   'offset': offset, 'length': len(block)})
+            blocks.append(block)
+            offset += len(block)
+        count = len(values[0]) if values else 0
+        header = json.dumps({'table': table, 'period': period, 'rows': count,
+                             'columns': header_columns}).encode('utf-8')
+
+        key = self.key(table, period)
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先寫暫存檔再換名，讀的人不會看到寫到一半的檔案
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            f.write(MAGIC + struct.pack('>I', len(header)) + header)
+            for block in blocks:
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, path)
+        return key, count, os.path.getsize(path)
+
+    def open(self, key):
+        """讀過的檔案連同解開的欄位與排序快取起來；檔案被重寫（mtime 改變）時重新讀。"""
+        path = os.path.join(self.root, key)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == mtime:
+                self._cache.move_to_end(key)
+                return cached[1]
+        archive = ArchiveFile(path)
+        with self._lock:
+            self._cache[key] = (mtime, archive)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_files:
+                self._cache.popitem(last=False)
+        return archive
+
+
+class ArchiveFile:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f'not an archive file: {path}')
+        start = len(MAGIC) + 4
+        (length,) = struct.unpack('>I', data[len(MAGIC):start])
+        header = json.loads(data[start:start + length])
+        self.rows = header['rows']
+        self._columns = {c['name']: c for c in header['columns']}
+        self._data = memoryview(data)[start + length:]
+        self._decoded = {}
+        self._orders = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def column(self, name):
+        values = self._decoded.get(name)
+        if values is None:
+            info = self._columns.get(name)
+            if info is None:
+                # 封存之後才加的欄位
+                values = [None] * self.rows
+            else:
+                values = json.loads(zlib.decompress(self._data[info['offset']:info['offset'] + info['length']]))
+                if info['datetime']:
+                    values = [datetime.fromisoformat(v) if v is not None else None for v in values]
+            with self._lock:
+                values = self._decoded.setdefault(name, values)
+        return values
+
+    def order(self, time_name, pk_name):
+        """時間不是 NULL 的列，依 (時間 DESC, 主鍵 DESC) 排好的列號。"""
+        key = (time_name, pk_name)
+        order = self._orders.get(key)
+        if order is None:
+            times, pks = self.column(time_name), self.column(pk_name)
+            order = sorted((i for i in range(self.rows) if times[i] is not None),
+                           key=lambda i: (times[i], pks[i]), reverse=True)
+            with self._lock:
+                order = self._orders.setdefault(key, order)
+        return order
+
+    def lookup(self, name, value, time_name, pk_name):
+        """欄位等於 value 的列號，順序同 order()。"""
+        key = (name, time_name, pk_name)
+        index = self._indexes.get(key)
+        if index is None:
+            values = self.column(name)
+            index = {}
+            for i in self.order(time_name, pk_name):
+                index.setdefault(values[i], []).append(i)
+            with self._lock:
+                index = self._indexes.setdefault(key, index)
+        return index.get(value, ())
+
+
+def scan(store, keys, names, time_name, pk_name, where=None, since=None, until=None, after=None):
+    """依 (時間 DESC, 主鍵 DESC) 逐列產生 names 順序的 tuple。
+
+    keys 是由新到舊的封存檔，各檔的時間範圍不重疊；where 是 {欄位: 值} 的等值條件，
+    since / until 是時間的 [since, until)，after 是分頁游標 (時間, 主鍵)，只回傳排在它之後的列。
+    """
+    if after is not None and after[0] is None:
+        return  # 游標已經在時間是 NULL 的列，封存檔裡沒有這種列
+    where = where or {}
+    for key in keys:
+        archive = store.open(key)
+        times = archive.column(time_name)
+        pks = archive.column(pk_name)
+        # 從符合條件最少的那一欄的索引開始，其他條件逐列檢查
+        candidates = archive.order(time_name, pk_name)
+        conditions = []
+        for name, value in where.items():
+            matches = archive.lookup(name, value, time_name, pk_name)
+            if len(matches) < len(candidates):
+                candidates = matches
+            conditions.append((archive.column(name), value))
+        columns = None
+        for i in candidates:
+            t = times[i]
+            if since is not None and t < since:
+                break
+            if (until is not None and t >= until) or (after is not None and (t, pks[i]) >= after):
+                continue
+            if all(values[i] == value for values, value in conditions):
+                if columns is None:
+                    columns = [archive.column(name) for name in names]
+                yield tuple(values[i] for values in columns)
@@ -0,0 +1,81 @@
+import hashlib
+import threading
+import time
+from uuid import uuid4
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class RevocationSet:
+    """已撤銷 token 的 jti，只保留到原本的過期時間；超過上限時先丟最早過期的。"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = {}  # jti -> expires_at
+        self._lock = threading.Lock()
+
+    def add(self, jti, expires_at):
+        with self._lock:
+            self._entries[jti] = expires_at
+            if len(self._entries) > self.max_size:
+                now = time.time()
+                for key in [k for k, exp in self._entries.items() if exp < now]:
+                    del self._entries[key]
+                while len(self._entries) > self.max_size:
+                    del self._entries[min(self._entries, key=self._entries.get)]
+
+    def __contains__(self, jti):
+        expires_at = self._entries.get(jti)
+        return expires_at is not None and expires_at >= time.time()
+
+
+class TokenManager:
+    """以 itsdangerous 簽章的無狀態 token，內容是 user_id、scopes 與 jti。
+
+    驗證只做 HMAC 與時間檢查，不查資料庫。
+    """
+
+    def __init__(self, secret_key, access_ttl=900, refresh_ttl=30 * 24 * 3600, revoked=None):
+        signer_kwargs = {'digest_method': hashlib.sha256}
+        self._access = URLSafeTimedSerializer(secret_key, salt='access-token', signer_kwargs=signer_kwargs)
+        self._refresh = URLSafeTimedSerializer(secret_key, salt='refresh-token', signer_kwargs=signer_kwargs)
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+        self.revoked = revoked if revoked is not None else RevocationSet()
+
+    def _serializer(self, kind):
+        return self._access if kind == 'access' else self._refresh
+
+    def issue(self, user_id, scopes, kind='access'):
+        payload = {'uid': user_id, 'scp': list(scopes), 'jti': uuid4().hex}
+        return self._serializer(kind).dumps(payload)
+
+    def issue_pair(self, user_id, scopes):
+        return {
+            'access_token': self.issue(user_id, scopes, 'access'),
+            'refresh_token': self.issue(user_id, scopes, 'refresh'),
+            'token_type': 'Bearer',
+            'expires_in': self.access_ttl,
+        }
+
+    def verify(self, token, kind='access'):
+        ttl = self.access_ttl if kind == 'access' else self.refresh_ttl
+        try:
+            payload, issued_at = self._serializer(kind).loads(token, max_age=ttl, return_timestamp=True)
+        except SignatureExpired:
+            raise InvalidToken('token expired')
+        except BadSignature:
+            raise InvalidToken('invalid token')
+        if not isinstance(payload, dict) or 'uid' not in payload:
+            raise InvalidToken('invalid token')
+        if payload.get('jti') in self.revoked:
+            raise InvalidToken('token revoked')
+        payload['exp'] = issued_at.timestamp() + ttl
+        return payload
+
+    def revoke(self, payload):
+        self.revoked.add(payload['jti'], payload['exp'])
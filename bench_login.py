@@ -0,0 +1,102 @@
+"""登入吞吐量 benchmark：比較不同雜湊子行程數下每秒可完成的登入數。
+
+    python bench_login.py --workers 0 1 2 4 --concurrency 8 --logins 64
+
+使用暫存的 SQLite 資料庫，不會碰到正式資料。
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--queue-depth', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--iterations', type=int, help='PBKDF2 迭代次數（預設同正式環境）')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    if args.iterations:
+        os.environ['PASSWORD_HASH_METHOD'] = f'pbkdf2:sha256:{args.iterations}'
+
+    import password_hashing
+    from app import create_app, db
+
+    app = create_app({'TESTING': True})
+    with app.app_context():
+        db.create_all()
+    app.test_client().post('/register', json={'username': 'bench', 'password': 'secret'})
+
+    print(f'{"workers":>7} {"logins/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"503":>5} {"GET / ms":>9}')
+    for workers in args.workers:
+        password_hashing.configure(workers, args.queue_depth)
+        # 先暖身，讓子行程啟動的成本不算進去
+        app.test_client().post('/login', json={'username': 'bench', 'password': 'secret'})
+        print(_run(app, workers, args.concurrency, args.logins))
+    password_hashing.pool.shutdown()
+
+
+def _run(app, workers, concurrency, logins):
+    latencies = []
+    rejected = [0]
+    lock = threading.Lock()
+    remaining = [logins]
+
+    def login_loop():
+        client = app.test_client()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            response = client.post('/login', json={'username': 'bench', 'password': 'secret'})
+            elapsed = time.perf_counter() - start
+            with lock:
+                if response.status_code == 503:
+                    rejected[0] += 1
+                else:
+                    latencies.append(elapsed)
+
+    # 登入壓力下，同時量測一個不需雜湊的 GET 的延遲
+    get_latencies = []
+    stop = threading.Event()
+
+    def probe_loop():
+        client = app.test_client()
+        while not stop.is_set():
+            start = time.perf_counter()
+            client.get('/')
+            get_latencies.append(time.perf_counter() - start)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=login_loop) for _ in range(concurrency)]
+    probe = threading.Thread(target=probe_loop)
+    started = time.perf_counter()
+    probe.start()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - started
+    stop.set()
+    probe.join()
+
+    latencies.sort()
+    get_latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000 if latencies else 0
+    get_p50 = get_latencies[len(get_latencies) // 2] * 1000 if get_latencies else 0
+    return f'{workers:>7} {len(latencies) / total:>9.1f} {p50:>8.1f} {p95:>8.1f} {rejected[0]:>5} {get_p50:>9.2f}'
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,196 @@
+"""查詢計畫回歸檢查：灌入大量合成資料，打一輪常用的 API，
+對每個實際執行的 SELECT 做 EXPLAIN，熱門資料表出現全表掃描就以非 0 結束。
+
+    python check_query_plans.py --users 2000 --records-per-user 50
+    python check_query_plans.py --database-url postgresql://localhost/poopalooza_plans
+
+預設用暫存的 SQLite；--database-url 必須指向可以清空的空資料庫。
+pytest 會以較小的資料量跑同一套檢查（test_query_plans.py）。
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# 這些表會長到很大，在熱門查詢裡不可以整表掃描
+WATCHED_TABLES = {
+    'users', 'achievements', 'poop_records', 'toilet_checkins',
+    'public_checkins', 'private_checkins', 'analysis_results', 'poop_locations', 'heatmap_cells',
+    'sync_changes', 'metric_sketch_bins',
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--records-per-user', type=int, default=50)
+    parser.add_argument('--toilets', type=int, default=2000)
+    parser.add_argument('-v', '--verbose', action='store_true', help='印出每個查詢的完整計畫')
+    failures = run(parser.parse_args())
+    if failures:
+        print(f'\n{len(failures)} queries scan a whole table:')
+        for probe, table, line in failures:
+            print(f'  {probe}: {table}: {line}')
+        sys.exit(1)
+    print('\nAll hot queries use indexes')
+
+
+def run(args):
+    """灌資料、打一輪 probe，回傳 [(probe, 資料表, 計畫)]；資料庫用完會清空。"""
+    url = args.database_url or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "plans.db")}'
+    os.environ['SQLALCHEMY_DATABASE_URI'] = url
+    os.environ['RESPONSE_CACHE_ENABLED'] = '0'
+    os.environ['PASSWORD_HASH_WORKERS'] = '0'
+    os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    os.environ['AUTH_MODE'] = 'optional'
+
+    import migrations
+    from app import create_app, db
+
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': url})
+    with app.app_context():
+        db.drop_all()
+        migrations.upgrade(db.engine, db.metadata, echo=lambda msg: None)
+        seed(db, args)
+        failures = check(app, db, args)
+        db.drop_all()
+    return failures
+
+
+def seed(db, args):
+    from app import (Achievement, PoopRecord, PrivateCheckin, PublicCheckin,
+                     PublicToilet, ToiletCheckin, User)
+    from password_hashing import hash_password
+
+    rnd = random.Random(42)
+    start = datetime(2024, 1, 1)
+    password_hash = hash_password('secret')
+
+    def insert(model, rows):
+        for i in range(0, len(rows), 5000):
+            db.session.execute(model.__table__.insert(), rows[i:i + 5000])
+
+    insert(User, [{'user_id': u, 'username': f'user{u}', 'password_hash': password_hash,
+                   'created_at': start + timedelta(minutes=u)} for u in range(1, args.users + 1)])
+    insert(PublicToilet, [{'toilet_id': f't{t}', 'name': f'toilet {t}',
+                           'latitude': 25 + rnd.random() / 10, 'longitude': 121.5 + rnd.random() / 10}
+                          for t in range(args.toilets)])
+    total = args.users * args.records_per_user
+    times = [start + timedelta(minutes=i * 7) for i in range(total)]
+    insert(PoopRecord, [{'record_id': i + 1, 'user_id': rnd.randint(1, args.users), 'record_time': times[i],
+                         'bristol_scale': str(rnd.randint(1, 7))} for i in range(total)])
+    insert(ToiletCheckin, [{'toilet_checkin_id': i + 1, 'user_id': rnd.randint(1, args.users),
+                            'checkin_time': times[i], 'public_toilet_id': f't{rnd.randrange(args.toilets)}',
+                            'toilet_rating_cleanliness': rnd.randint(1, 5)} for i in range(total // 2)])
+    insert(PublicCheckin, [{'id': f'p{i}', 'user_id': str(rnd.randint(1, args.users)),
+                            'bathroom_id': f't{rnd.randrange(args.toilets)}', 'rating': rnd.randint(1, 5),
+                            'created_at': times[i]} for i in range(total // 2)])
+    insert(PrivateCheckin, [{'id': f'v{i}', 'user_id': str(rnd.randint(1, args.users)),
+                             'bathroom_id': f't{rnd.randrange(args.toilets)}', 'created_at': times[i]}
+                            for i in range(total // 2)])
+    insert(Achievement, [{'achievement_id': i + 1, 'user_id': rnd.randint(1, args.users),
+                          'achievement_name': 'a', 'achieved_at': times[i]} for i in range(args.users * 3)])
+    db.session.commit()
+    # 直接 insert 的資料沒有經過 API，跟既有資料庫升級時一樣補上 sync_changes
+    import migrations
+    with db.engine.begin() as conn:
+        migrations._0004_sync_changes_backfill(conn, False)
+    # 讓 planner 拿到真實的統計資料
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+
+
+def probes(client, args):
+    # (名稱, 是否帶篩選條件, 請求)；有篩選的查詢連「沿著整個索引掃」也不行
+    user = f'{args.users // 2}'
+    yield 'POST /login', True, lambda: client.post(
+        '/login', json={'username': f'user{user}', 'password': 'secret'})
+    yield 'POST /register (taken)', True, lambda: client.post(
+        '/register', json={'username': f'user{user}', 'password': 'x'})
+    yield 'GET /poop-records?user_id', True, lambda: client.get(f'/poop-records?user_id={user}&limit=50')
+    yield 'GET /poop-records?user_id&from', True, lambda: client.get(
+        f'/poop-records?user_id={user}&from=2024-03-01T00:00:00&limit=50')
+    yield 'GET /poop-records?cursor', True, lambda: client.get(
+        '/poop-records?user_id=' + user + '&limit=5&cursor=' +
+        client.get(f'/poop-records?user_id={user}&limit=5').headers['X-Next-Cursor'])
+    yield 'GET /poop-records', False, lambda: client.get('/poop-records?limit=50')
+    yield 'GET /achievements/<user_id>', True, lambda: client.get(f'/achievements/{user}')
+    yield 'GET /achievements?user_id', True, lambda: client.get(f'/achievements?user_id={user}')
+    yield 'GET /toilet_checkins?public_toilet_id', True, lambda: client.get('/toilet_checkins?public_toilet_id=t7')
+    yield 'GET /toilet_checkins?user_id', True, lambda: client.get(f'/toilet_checkins?user_id={user}')
+    yield 'GET /public-checkins', False, lambda: client.get('/public-checkins?limit=50')
+    yield 'GET /public-checkins?bathroom_id', True, lambda: client.get('/public-checkins?bathroom_id=t7')
+    yield 'GET /public-checkins?user_id', True, lambda: client.get(f'/public-checkins?user_id={user}')
+    yield 'GET /private-checkins?user_id', True, lambda: client.get(f'/private-checkins?user_id={user}')
+    yield 'GET /users', False, lambda: client.get('/users?limit=50')
+    yield 'GET /sync?user_id', True, lambda: client.get(f'/sync?user_id={user}&since=10')
+    yield 'GET /heatmap/<z>/<x>/<y>', True, lambda: client.get('/heatmap/10/857/438?from=2024-01-01&bristol=4')
+    yield 'GET /analytics/percentiles', True, lambda: client.get(
+        '/analytics/percentiles?metric=health_score&value=70&period=2024-03&months=6')
+
+
+def check(app, db, args):
+    from sqlalchemy import event
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    client = app.test_client()
+    failures = []
+    postgres = db.engine.dialect.name == 'postgresql'
+    try:
+        for name, filtered, probe in probes(client, args):
+            statements.clear()
+            response = probe()
+            if response.status_code >= 500:
+                failures.append((name, '-', f'HTTP {response.status_code}'))
+                continue
+            captured = list(statements)
+            print(f'{name}: {len(captured)} queries')
+            for statement, parameters in captured:
+                plan = explain(db, statement, parameters, postgres)
+                if args.verbose:
+                    print('    ' + '\n    '.join(plan))
+                for line in plan:
+                    table = full_scan(line, postgres, filtered)
+                    if table in WATCHED_TABLES:
+                        failures.append((name, table, line.strip()))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+    return failures
+
+
+def explain(db, statement, parameters, postgres):
+    raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute(('EXPLAIN ' if postgres else 'EXPLAIN QUERY PLAN ') + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        raw.close()
+    return [row[0] for row in rows] if postgres else [row[-1] for row in rows]
+
+
+def full_scan(line, postgres, filtered):
+    # PostgreSQL: "Seq Scan on poop_records"；SQLite: "SCAN poop_records"，
+    # 沒有篩選條件的分頁沿著索引掃（"SCAN t USING INDEX"，讀到 LIMIT 就停）不算
+    if postgres:
+        match = re.search(r'Seq Scan on (\w+)', line)
+    elif filtered:
+        match = re.match(r'\s*SCAN (\w+)', line)
+    else:
+        match = re.match(r'\s*SCAN (\w+)(?!.*USING (COVERING )?INDEX)', line)
+    return match.group(1) if match else None
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,176 @@
+import threading
+
+from spatial import tile_xy
+
+CHILDREN = ((0, 0), (1, 0), (0, 1), (1, 1))
+
+
+class ClusterIndex:
+    """supercluster 風格的地圖標記聚合，各縮放等級預先算好。
+
+    zoom z 的群集是邊長 1/2^cell_shift 張圖磚的格子，也就是 zoom z + cell_shift 的圖磚 (x, y)；
+    上一層的格子正好由下一層的四個格子組成，所以各層是一棵四分樹。
+    新增、刪除一個點只要沿著它的祖先路徑重算，不必整份重建。
+    每格存 [數量, 緯度和, 經度和, 代表點 id]；最細一層另外存成員 id。
+    """
+
+    def __init__(self, max_zoom=16, cell_shift=2):
+        self.max_zoom = max_zoom
+        self.cell_shift = cell_shift
+        self.levels = [{} for _ in range(max_zoom + 1)]
+        self.points = {}  # id -> (lat, lon, item, 最細一層的格子)
+        self._lock = threading.Lock()
+
+    def _leaf_cell(self, lat, lon):
+        return tile_xy(lat, lon, self.max_zoom + self.cell_shift)
+
+    def _add_leaf(self, point_id, lat, lon, item):
+        key = self._leaf_cell(lat, lon)
+        self.points[point_id] = (lat, lon, item, key)
+        cell = self.levels[self.max_zoom].get(key)
+        if cell is None:
+            cell = self.levels[self.max_zoom][key] = [0, 0.0, 0.0, None, set()]
+        cell[0] += 1
+        cell[1] += lat
+        cell[2] += lon
+        cell[4].add(point_id)
+        return key, cell
+
+    def load(self, points):
+        """由 (id, lat, lon, item) 一次建好所有層級，由下往上逐層合併。"""
+        with self._lock:
+            for point_id, lat, lon, item in points:
+                if lat is not None and lon is not None:
+                    self._add_leaf(point_id, lat, lon, item)
+            for cell in self.levels[self.max_zoom].values():
+                cell[3] = min(cell[4])
+            for z in range(self.max_zoom - 1, -1, -1):
+                parents = self.levels[z]
+                biggest = {}
+                for (x, y), child in self.levels[z + 1].items():
+                    key = (x >> 1, y >> 1)
+                    cell = parents.get(key)
+                    if cell is None:
+                        cell = parents[key] = [0, 0.0, 0.0, None]
+                    cell[0] += child[0]
+                    cell[1] += child[1]
+                    cell[2] += child[2]
+                    best = biggest.get(key, 0)
+                    if child[0] > best or (child[0] == best and child[3] < cell[3]):
+                        biggest[key] = child[0]
+                        cell[3] = child[3]
+
+    def _merge(self, z, key):
+        x, y = key
+        children = self.levels[z + 1]
+        merged = None
+        biggest = 0
+        for dx, dy in CHILDREN:
+            child = children.get((2 * x + dx, 2 * y + dy))
+            if child is None:
+                continue
+            if merged is None:
+                merged = [0, 0.0, 0.0, None]
+            merged[0] += child[0]
+            merged[1] += child[1]
+            merged[2] += child[2]
+            # 代表點取自數量最多的子格（同數量取 id 小的），縮放時標記位置比較穩定
+            if child[0] > biggest or (child[0] == biggest and child[3] < merged[3]):
+                biggest = child[0]
+                merged[3] = child[3]
+        return merged
+
+    def _update_path(self, leaf_key):
+        x, y = leaf_key
+        for z in range(self.max_zoom - 1, -1, -1):
+            x, y = x >> 1, y >> 1
+            cell = self._merge(z, (x, y))
+            if cell is None:
+                self.levels[z].pop((x, y), None)
+            else:
+                self.levels[z][(x, y)] = cell
+
+    def insert(self, point_id, lat, lon, item):
+        self.remove(point_id)
+        if lat is None or lon is None:
+            return
+        with self._lock:
+            key, cell = self._add_leaf(point_id, lat, lon, item)
+            cell[3] = min(cell[4])
+            self._update_path(key)
+
+    def remove(self, point_id):
+        with self._lock:
+            point = self.points.pop(point_id, None)
+            if point is None:
+                return
+            lat, lon, _, key = point
+            leaves = self.levels[self.max_zoom]
+            cell = leaves[key]
+            cell[4].discard(point_id)
+            if not cell[4]:
+                del leaves[key]
+            else:
+                cell[0] -= 1
+                cell[1] -= lat
+                cell[2] -= lon
+                cell[3] = min(cell[4])
+            self._update_path(key)
+
+    def _cells_in_bbox(self, level, z, west, south, east, north):
+        x0, y0 = tile_xy(north, west, z)
+        x1, y1 = tile_xy(south, east, z)
+        # 範圍內的格子比這一層有資料的格子還多時，直接掃有資料的
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(level):
+            for (x, y), cell in level.items():
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    yield (x, y), cell
+            return
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                cell = level.get((x, y))
+                if cell is not None:
+                    yield (x, y), cell
+
+    def _expansion_zoom(self, z, key):
+        # 往下找到開始分成兩群以上的縮放等級
+        x, y = key
+        while z < self.max_zoom:
+            children = [(2 * x + dx, 2 * y + dy) for dx, dy in CHILDREN
+                        if (2 * x + dx, 2 * y + dy) in self.levels[z + 1]]
+            if len(children) != 1:
+                break
+            x, y = children[0]
+            z += 1
+        return z + 1
+
+    def clusters(self, west, south, east, north, zoom):
+        """bbox 內的群集；zoom 超過 max_zoom 時回傳個別的點。跨越換日線時 west > east。"""
+        if west > east:
+            return (self.clusters(west, south, 180.0, north, zoom)
+                    + self.clusters(-180.0, south, east, north, zoom))
+        z = max(0, min(int(zoom), self.max_zoom + 1))
+        results = []
+        with self._lock:
+            if z > self.max_zoom:
+                leaves = self.levels[self.max_zoom]
+                for _, cell in self._cells_in_bbox(leaves, self.max_zoom + self.cell_shift,
+                                                   west, south, east, north):
+                    for point_id in sorted(cell[4]):
+                        lat, lon, item, _ = self.points[point_id]
+                        if south <= lat <= north and west <= lon <= east:
+                            results.append({'id': f'p/{point_id}', 'count': 1, 'latitude': lat,
+                                            'longitude': lon, 'expansion_zoom': None, 'item': item})
+                return results
+            for (x, y), cell in self._cells_in_bbox(self.levels[z], z + self.cell_shift,
+                                                    west, south, east, north):
+                count = cell[0]
+                results.append({
+                    'id': f'{z}/{x}/{y}',
+                    'count': count,
+                    'latitude': cell[1] / count,
+                    'longitude': cell[2] / count,
+                    'expansion_zoom': self._expansion_zoom(z, (x, y)) if count > 1 else None,
+                    'item': self.points[cell[3]][2],
+                })
+        return results
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+class PoolStats:
+    """連線池的累計統計：借出次數、等待時間、等不到連線的次數、失效的連線數。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.invalidated = 0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_timeout(self, seconds):
+        with self._lock:
+            self.timeouts += 1
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_invalidated(self):
+        with self._lock:
+            self.invalidated += 1
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool 加上等待時間與逾時的統計；pool 被 recreate 時沿用同一份統計。"""
+
+    def __init__(self, *args, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats or PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout(time.perf_counter() - start)
+            raise
+        self.stats.record_wait(time.perf_counter() - start)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def engine_options_from_env(uri):
+    """SQLALCHEMY_ENGINE_OPTIONS：連線池大小、pre-ping、recycle 都可由環境變數調整。
+
+    每個 gunicorn worker 各有一個 pool，資料庫端最多會有
+    workers × (DB_POOL_SIZE + DB_MAX_OVERFLOW) 條連線。
+    DB_PGBOUNCER=1 時連線池交給 PgBouncer（transaction mode），這裡不再保留連線。
+    """
+    if not uri or uri in ('sqlite://', 'sqlite:///:memory:'):
+        return {}
+    postgres = uri.startswith('postgresql')
+    if postgres and os.getenv('DB_PGBOUNCER') == '1':
+        return {'poolclass': NullPool}
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+        # 低流量時閒置的連線會自然被 recycle 掉，而不是每條輪流保持著
+        'pool_use_lifo': True,
+    }
+    if postgres:
+        options['connect_args'] = {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+            'application_name': os.getenv('DB_APPLICATION_NAME', 'poopalooza'),
+        }
+    return options
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool_class': type(pool).__name__, 'pid': os.getpid()}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'timeout_s': pool.timeout(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'utilization': round(pool.checkedout() / capacity, 3) if capacity else None,
+        })
+    stats = getattr(pool, 'stats', None)
+    if stats is not None:
+        status.update({
+            'checkouts': stats.checkouts,
+            'wait_ms_avg': round(stats.wait_total / stats.checkouts * 1000, 3) if stats.checkouts else 0,
+            'wait_ms_max': round(stats.wait_max * 1000, 3),
+            'timeouts': stats.timeouts,
+            'invalidated': stats.invalidated,
+        })
+    return status
+
+
+def instrument(engine):
+    stats = getattr(engine.pool, 'stats', None)
+    if stats is None:
+        return
+
+    @event.listens_for(engine, 'invalidate')
+    def _count_invalidated(dbapi_connection, connection_record, exception):
+        stats.record_invalidated()
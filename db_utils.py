@@ -0,0 +1,20 @@
+from sqlalchemy import Index
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def dialect_insert(session):
+    """回傳支援 on_conflict_do_update 的 insert()（PostgreSQL / SQLite）。"""
+    if session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+def keyset_index(name, *columns, **kwargs):
+    """最後兩欄是 (排序時間, 主鍵)，順序與 pagination.paginate 的
+    ORDER BY 時間 DESC NULLS LAST, 主鍵 DESC 一致，分頁可以直接沿著索引讀。
+
+    SQLite 的 NULL 本來就排在 DESC 的最後，反向掃描一般索引即可。
+    """
+    *_, order_col, pk_col = [getattr(col, 'name', col) for col in columns]
+    return Index(name, *columns,
+                 postgresql_ops={order_col: 'DESC NULLS LAST', pk_col: 'DESC'}, **kwargs)
@@ -0,0 +1,59 @@
+"""gunicorn 設定；在專案根目錄執行 gunicorn 'app:create_app()' 時會自動讀取。
+
+預設 gthread：worker 數跟著 CPU 數，每個 worker 多條執行緒，等資料庫的時間由執行緒分擔，
+行程少記憶體就少。preload_app 讓 model、路由在 master 載入一次，worker 以 copy-on-write 共用。
+"""
+import os
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))  # 容器限制的 CPU
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', str(max(2, _cpu_count()))))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# SSE 連線（/public-checkins/stream）會一直佔著一條執行緒，所以在 GUNICORN_THREADS 之外多開 SSE_MAX_CLIENTS 條。
+# gthread 的執行緒池不分用途：這些執行緒沒被 SSE 用掉時一樣會處理一般請求
+request_threads = int(os.getenv('GUNICORN_THREADS', '4'))
+os.environ.setdefault('SSE_MAX_CLIENTS', '32')
+threads = request_threads + int(os.environ['SSE_MAX_CLIENTS'])
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+# 處理一定數量的請求後換新的 worker，回收慢慢漲上去的記憶體；jitter 讓 worker 不會同時重啟
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '100'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+# heartbeat 檔放在記憶體裡，容器的磁碟慢時 worker 不會被誤判為沒有回應
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# 回應快取沒有設定 RESPONSE_CACHE_URL（共用的 Redis）時在每個 worker 的記憶體裡，寫入只讓
+# 處理它的 worker 的快取失效；多個 worker 時有 tag 的快取最多存 5 秒，其他 worker 頂多晚 5 秒看到更新
+if workers > 1 and not os.getenv('RESPONSE_CACHE_URL'):
+    os.environ.setdefault('RESPONSE_CACHE_LOCAL_MAX_TTL', '5')
+
+# 每條執行緒都可能正在處理一般請求並拿著一條連線，連線池大小跟總執行緒數一致，不靠 overflow，
+# 執行緒不會卡在 DB_POOL_TIMEOUT 後回 503。連線用到才建立，資料庫端最多 workers × threads 條；
+# 超過資料庫上限時調低 SSE_MAX_CLIENTS / GUNICORN_THREADS，或改走 PgBouncer（DB_PGBOUNCER=1）
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+os.environ.setdefault('DB_MAX_OVERFLOW', '0')
+
+
+def post_fork(server, worker):
+    # preload 時 engine 在 master 建立；每個 worker 要有自己的連線池
+    if server.cfg.preload_app:
+        from app import dispose_engines_after_fork
+        dispose_engines_after_fork(server.app.wsgi())
+
+
+def child_exit(server, worker):
+    directory = os.getenv('METRICS_DIR')
+    if directory:
+        from metrics import mark_process_dead
+        mark_process_dead(directory, worker.pid)
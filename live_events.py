@@ -0,0 +1,130 @@
+import itertools
+import select
+import threading
+from collections import deque
+
+
+class EventHub:
+    """行程內最近事件的 ring buffer，有新事件時喚醒等待中的 SSE 連線。
+
+    事件是 (seq, id, event, data)；seq 是本行程的流水號，只用來記每條連線讀到哪裡。
+    Last-Event-ID 以 id 在 buffer 裡的位置接續、不比較大小：各 worker 從同一個
+    NOTIFY channel 依相同順序收到事件，所以重連到別的 worker 也接得上。
+    """
+
+    def __init__(self, size=1000):
+        self._events = deque(maxlen=size)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.subscribers = 0
+
+    def add_subscriber(self, limit=0):
+        with self._cond:
+            if limit and self.subscribers >= limit:
+                return False
+            self.subscribers += 1
+            return True
+
+    def remove_subscriber(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def publish(self, event_id, event, data):
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, event_id, event, data))
+            self._cond.notify_all()
+
+    def clear(self):
+        # 可能漏了事件（例如 LISTEN 斷線重連）：清掉 buffer，舊的 Last-Event-ID 就接不上
+        with self._cond:
+            self._events.clear()
+            self._seq += 1
+            self._cond.notify_all()
+
+    def cursor(self, last_event_id=None):
+        """回傳 (seq, 接不接得上)；last_event_id 已經不在 buffer 裡時接不上，用戶端要重新載入。"""
+        with self._cond:
+            if last_event_id is None:
+                return self._seq, True
+            for seq, event_id, _, _ in reversed(self._events):
+                if event_id == last_event_id:
+                    return seq, True
+            return self._seq, False
+
+    def wait(self, after, timeout):
+        """等到有 seq > after 的事件或逾時；回傳 (新的 seq, 事件, 中間有沒有漏掉)。"""
+        with self._cond:
+            if self._seq <= after:
+                self._cond.wait(timeout)
+            seq = self._seq
+            if seq <= after:
+                return seq, [], False
+            first = self._events[0][0] if self._events else seq + 1
+            if first > after + 1:
+                # 連線讀得太慢，要的事件已經被擠出 buffer
+                return seq, list(self._events), True
+            return seq, list(itertools.islice(self._events, after - first + 1, None)), False
+
+
+class PgListener:
+    """背景執行緒 LISTEN 一個 PostgreSQL channel，把收到的 NOTIFY payload 交給 on_message。
+
+    斷線時依指數退避重連；重連前後可能漏掉事件，所以重連成功時呼叫 on_reconnect。
+    """
+
+    def __init__(self, connect, channel, on_message, on_reconnect=None, logger=None, poll_interval=5):
+        self.connect = connect  # 回傳新的 psycopg2 連線
+        self.channel = channel
+        self.on_message = on_message
+        self.on_reconnect = on_reconnect
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'listen-{self.channel}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        backoff = 1
+        connected_before = False
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}"')
+                if connected_before and self.on_reconnect is not None:
+                    self.on_reconnect()
+                connected_before = True
+                backoff = 1
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.on_message(conn.notifies.pop(0).payload)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.warning('LISTEN %s failed, retrying in %ds: %s', self.channel, backoff, e)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+def sse_event(event_id, event, data):
+    """組一則 text/event-stream 訊息；data 是單行 JSON。event_id 為 None 時不更新用戶端的 Last-Event-ID。"""
+    if event_id is None:
+        return f'event: {event}\ndata: {data}\n\n'
+    return f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
@@ -0,0 +1,143 @@
+import hashlib
+import io
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    # 檔案本身無法解碼的錯誤；重試也不會成功
+    DECODE_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError)
+except ImportError:  # Pillow 沒裝時只存原檔，不產生縮圖
+    Image = None
+    DECODE_ERRORS = ()
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# 名稱 -> 長邊最大像素；動態牆用 thumb，詳細頁用 medium
+VARIANTS = {'thumb': 256, 'medium': 1024}
+EXTENSIONS = {
+    'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp', 'image/heic': 'heic',
+    'audio/mpeg': 'mp3', 'audio/mp4': 'm4a', 'audio/aac': 'aac', 'audio/wav': 'wav',
+}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class LocalBlobStore:
+    """本機檔案系統的 blob store；key 是相對路徑，base_url + key 就是公開網址。
+
+    其他 backend（S3、GCS）只要提供同樣的 writer / open / exists / url 即可替換。
+    """
+
+    def __init__(self, root, base_url):
+        self.root = root
+        self.base_url = base_url.rstrip('/') + '/'
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError('invalid key')
+        return path
+
+    def writer(self):
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+
+    def commit(self, tmp_path, key):
+        """把暫存檔移到 key；key 已存在（內容相同）就丟掉暫存檔，回傳是否為新檔。"""
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return True
+
+    def discard(self, tmp_path):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, data):
+        with self.writer() as f:
+            f.write(data)
+        return self.commit(f.name, key)
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def url(self, key):
+        return self.base_url + key
+
+
+def store_from_env():
+    root = os.getenv('MEDIA_ROOT', os.path.join(os.getcwd(), 'media'))
+    return LocalBlobStore(root, os.getenv('MEDIA_BASE_URL', '/media/files/'))
+
+
+def content_key(sha256, ext):
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}.{ext}'
+
+
+def variant_key(sha256, name):
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}_{name}.jpg'
+
+
+def supports_variants(content_type):
+    return Image is not None and content_type.startswith('image/') and content_type != 'image/heic'
+
+
+def save_stream(store, stream, content_type, max_bytes):
+    """邊讀邊寫進暫存檔並計算 SHA-256，記憶體只留一個 chunk。
+
+    以內容雜湊當 key，同一個檔案上傳兩次只會存一份。回傳 (sha256, key, size, created)。
+    """
+    ext = EXTENSIONS[content_type]
+    digest = hashlib.sha256()
+    size = 0
+    with store.writer() as f:
+        tmp_path = f.name
+        try:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge()
+                digest.update(chunk)
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            store.discard(tmp_path)
+            raise
+    sha256 = digest.hexdigest()
+    key = content_key(sha256, ext)
+    created = store.commit(tmp_path, key)
+    return sha256, key, size, created
+
+
+def make_variants(store, sha256, key):
+    """產生各尺寸的 JPEG（去掉 EXIF、依方向轉正），已存在的就跳過；回傳 {名稱: key}。"""
+    keys = {name: variant_key(sha256, name) for name in VARIANTS}
+    missing = {name: px for name, px in VARIANTS.items() if not store.exists(keys[name])}
+    if not missing:
+        return keys
+    with store.open(key) as f:
+        image = Image.open(f)
+        # draft 讓 JPEG 直接以較小的解析度解碼，大照片不必整張載入
+        image.draft('RGB', (max(missing.values()),) * 2)
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    for name, px in sorted(missing.items(), key=lambda item: -item[1]):
+        image.thumbnail((px, px))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=80, optimize=True, progressive=True)
+        store.put(keys[name], buffer.getvalue())
+    return keys
+
@@ -0,0 +1,185 @@
+import glob
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Prometheus 格式的 counter / histogram / gauge。
+
+    gunicorn 的每個 worker 各自累計；設定 directory 時，每個行程定期把自己的數字
+    寫成 <pid>.json，/metrics 輸出時把所有行程的 counter 與 histogram 加總。
+    已結束的行程的 counter 會保留（counter 不能倒退），gauge 只算還活著的行程。
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._meta = {}  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> float 或 [各 bucket 次數..., sum, count]
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def gauge(self, name, help):
+        self._meta[name] = ('gauge', help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help, tuple(buckets))
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self._lock:
+            self._values[(name, tuple(labels))] = value
+
+    def observe(self, name, labels=(), value=0):
+        buckets = self._meta[name][2]
+        key = (name, tuple(labels))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            return [[name, [list(pair) for pair in labels], value if not isinstance(value, list) else list(value)]
+                    for (name, labels), value in self._values.items()]
+
+    def maybe_flush(self):
+        if not self.directory or time.monotonic() - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = time.monotonic()
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._snapshot(), f)
+        os.replace(tmp, path)
+
+    def _collect(self):
+        merged = {}
+
+        def add(entries, with_gauges):
+            for name, labels, value in entries:
+                meta = self._meta.get(name)
+                if meta is None or (meta[0] == 'gauge' and not with_gauges):
+                    continue
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if meta[0] == 'gauge':
+                    merged[key] = value
+                elif isinstance(value, list):
+                    current = merged.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        current[i] += v
+                else:
+                    merged[key] = merged.get(key, 0) + value
+
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                pid = os.path.basename(path)[:-len('.json')]
+                if pid == str(os.getpid()):
+                    continue
+                try:
+                    with open(path) as f:
+                        entries = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                add(entries, pid.isdigit() and _alive(int(pid)))
+        add(self._snapshot(), True)
+        return merged
+
+    def render(self):
+        merged = self._collect()
+        by_name = {}
+        for (name, labels), value in merged.items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(by_name):
+            kind, help, buckets = self._meta[name]
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name[name]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                for bound, count in zip(buckets + (float('inf'),), value[:-2] + [value[-1]]):
+                    le = ('le', _format_value(float(bound)))
+                    lines.append(f'{name}_bucket{_format_labels(labels, le)} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(float(value[-2]))}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def mark_process_dead(directory, pid):
+    """gunicorn 的 child_exit 可呼叫：把結束的 worker 的 counter 併進 archive.json，避免檔案越積越多。"""
+    path = os.path.join(directory, f'{pid}.json')
+    archive = os.path.join(directory, 'archive.json')
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return
+    try:
+        with open(archive) as f:
+            archived = json.load(f)
+    except (OSError, ValueError):
+        archived = []
+    totals = {}
+    for name, labels, value in archived + entries:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        if isinstance(value, list):
+            current = totals.setdefault(key, [0] * len(value))
+            for i, v in enumerate(value):
+                current[i] += v
+        else:
+            totals[key] = totals.get(key, 0) + value
+    tmp = f'{archive}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump([[name, [list(p) for p in labels], value] for (name, labels), value in totals.items()], f)
+    os.replace(tmp, archive)
+    os.remove(path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,160 @@
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, String, Table, Text, cast, false, func,
+                        inspect, literal, select, union_all)
+
+from db_utils import keyset_index
+
+Migration = namedtuple('Migration', 'version description upgrade')
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200)),
+    Column('applied_at', DateTime),
+)
+
+
+class MigrationError(Exception):
+    pass
+
+
+def _ensure_index(conn, concurrent, table_name, name, columns, unique=False, keyset=False):
+    """索引已存在就跳過；定義寫死在 migration 裡，不跟著 model 變動。"""
+    if name in {ix['name'] for ix in inspect(conn).get_indexes(table_name)}:
+        return False
+    table = Table(table_name, MetaData(), autoload_with=conn)
+    cols = [table.c[c] for c in columns]
+    options = {'unique': unique, 'postgresql_concurrently': concurrent}
+    index = keyset_index(name, *cols, **options) if keyset else Index(name, *cols, **options)
+    index.create(conn)
+    return True
+
+
+def _ensure_column(conn, table_name, column):
+    if column.name in {c['name'] for c in inspect(conn).get_columns(table_name)}:
+        return False
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}')
+    return True
+
+
+def _0001_indexes(conn, concurrent):
+    users = Table('users', MetaData(), autoload_with=conn)
+    duplicates = conn.execute(
+        select(users.c.username, func.count())
+        .where(users.c.username.isnot(None))
+        .group_by(users.c.username).having(func.count() > 1).limit(10)
+    ).all()
+    if duplicates:
+        names = ', '.join(f'{name!r} x{count}' for name, count in duplicates)
+        raise MigrationError(f'duplicate usernames must be resolved first: {names}')
+
+    _ensure_index(conn, concurrent, 'users', 'uq_users_username', ['username'], unique=True)
+    for table_name, name, columns in [
+        ('users', 'ix_users_created_at', ['created_at', 'user_id']),
+        ('achievements', 'ix_achievements_user_time', ['user_id', 'achieved_at', 'achievement_id']),
+        ('analysis_results', 'ix_analysis_results_user_time', ['user_id', 'analysis_time', 'analysis_id']),
+        ('poop_locations', 'ix_poop_locations_user_time', ['user_id', 'record_time', 'location_id']),
+        ('poop_records', 'ix_poop_records_user_time', ['user_id', 'record_time', 'record_id']),
+        ('poop_records', 'ix_poop_records_time', ['record_time', 'record_id']),
+        ('toilet_checkins', 'ix_toilet_checkins_user_time', ['user_id', 'checkin_time', 'toilet_checkin_id']),
+        ('toilet_checkins', 'ix_toilet_checkins_toilet_time',
+         ['public_toilet_id', 'checkin_time', 'toilet_checkin_id']),
+        ('public_checkins', 'ix_public_checkins_time', ['created_at', 'id']),
+        ('public_checkins', 'ix_public_checkins_user_time', ['user_id', 'created_at', 'id']),
+        ('public_checkins', 'ix_public_checkins_bathroom_time', ['bathroom_id', 'created_at', 'id']),
+        ('private_checkins', 'ix_private_checkins_user_time', ['user_id', 'created_at', 'id']),
+    ]:
+        _ensure_index(conn, concurrent, table_name, name, columns, keyset=True)
+
+
+def _0002_thumbnail_urls(conn, concurrent):
+    _ensure_column(conn, 'poop_records', Column('image_thumbnail_url', String(255)))
+    _ensure_column(conn, 'public_checkins', Column('image_thumbnail_url', String))
+    _ensure_column(conn, 'private_checkins', Column('image_thumbnail_url', String))
+
+
+def _0003_analysis_record_index(conn, concurrent):
+    # jobs 表是新表，由 create_all 建立；這裡只補既有表的索引
+    _ensure_index(conn, concurrent, 'analysis_results', 'ix_analysis_results_record', ['record_id'])
+
+
+def _0004_sync_changes_backfill(conn, concurrent):
+    # sync_changes / sync_counters 是新表，由 create_all 建立；既有的紀錄各補一列，
+    # 第一次 GET /sync（since=0）才拿得到完整資料。每個使用者的序號從 1 開始依序編
+    changes = Table('sync_changes', MetaData(), autoload_with=conn)
+    counters = Table('sync_counters', MetaData(), autoload_with=conn)
+    if conn.execute(select(func.count()).select_from(counters)).scalar():
+        return
+    poop = Table('poop_records', MetaData(), autoload_with=conn)
+    private = Table('private_checkins', MetaData(), autoload_with=conn)
+    sources = union_all(
+        select(literal('poop_record').label('kind'), cast(poop.c.record_id, String).label('resource_id'),
+               cast(poop.c.user_id, String).label('user_id')).where(poop.c.user_id.isnot(None)),
+        select(literal('private_checkin'), private.c.id, private.c.user_id).where(private.c.user_id.isnot(None)),
+    ).subquery()
+    seq = func.row_number().over(partition_by=sources.c.user_id, order_by=(sources.c.kind, sources.c.resource_id))
+    conn.execute(changes.insert().from_select(
+        ['kind', 'resource_id', 'user_id', 'seq', 'deleted', 'changed_at'],
+        select(sources.c.kind, sources.c.resource_id, sources.c.user_id, seq, false(), func.now())))
+    conn.execute(counters.insert().from_select(
+        ['user_id', 'seq'],
+        select(changes.c.user_id, func.max(changes.c.seq)).group_by(changes.c.user_id)))
+
+
+def _0005_poop_location_record_index(conn, concurrent):
+    _ensure_index(conn, concurrent, 'poop_locations', 'ix_poop_locations_record', ['record_id'])
+
+
+
+def _0006_job_result(conn, concurrent):
+    _ensure_column(conn, 'jobs', Column('result', Text))
+
+
+# 只能往後加，已發佈的版本不要改
+MIGRATIONS = [
+    Migration(1, 'indexes for filtered/paginated queries, unique usernames', _0001_indexes),
+    Migration(2, 'image_thumbnail_url on records and check-ins', _0002_thumbnail_urls),
+    Migration(3, 'analysis_results.record_id index for analysis status lookups', _0003_analysis_record_index),
+    Migration(4, 'backfill sync_changes for delta sync', _0004_sync_changes_backfill),
+    Migration(5, 'poop_locations.record_id index for heatmap moves on record changes',
+              _0005_poop_location_record_index),
+    Migration(6, 'jobs.result for handler return values (bulk import counts)', _0006_job_result),
+]
+
+
+def applied_versions(engine):
+    if not inspect(engine).has_table(schema_migrations.name):
+        return set()
+    with engine.connect() as conn:
+        return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def upgrade(engine, metadata, echo=print):
+    """建立新的資料表，再依序執行尚未套用的 migration，回傳這次套用的版本。
+
+    PostgreSQL 上用 CREATE INDEX CONCURRENTLY，建索引時不會擋住寫入；
+    因此不能包在 transaction 裡，每個 migration 完成後才記錄版本。
+    """
+    metadata.create_all(engine)
+    schema_migrations.create(engine, checkfirst=True)
+    done = applied_versions(engine)
+    concurrent = engine.dialect.name == 'postgresql'
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version in done:
+            continue
+        echo(f'Applying {migration.version:04d}: {migration.description}')
+        if concurrent:
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                migration.upgrade(conn, True)
+        else:
+            with engine.begin() as conn:
+                migration.upgrade(conn, False)
+        with engine.begin() as conn:
+            conn.execute(schema_migrations.insert().values(
+                version=migration.version, description=migration.description, applied_at=datetime.utcnow()))
+        applied.append(migration.version)
+    return applied
@@ -0,0 +1,102 @@
+import base64
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = int(os.getenv('PAGE_DEFAULT_LIMIT', '100'))
+MAX_LIMIT = int(os.getenv('PAGE_MAX_LIMIT', '500'))
+
+
+class InvalidPageRequest(ValueError):
+    pass
+
+
+def encode_cursor(ts, pk):
+    payload = json.dumps([ts.isoformat() if ts is not None else None, pk], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        ts, pk = json.loads(raw)
+        return (datetime.fromisoformat(ts) if ts is not None else None), pk
+    except (ValueError, TypeError):
+        raise InvalidPageRequest('invalid cursor')
+
+
+def parse_time(value, name):
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise InvalidPageRequest(f'{name} must be an ISO 8601 datetime')
+
+
+def parse_limit(args):
+    limit = args.get('limit', DEFAULT_LIMIT, type=int)
+    if limit is None or limit <= 0:
+        raise InvalidPageRequest('limit must be a positive integer')
+    return min(limit, MAX_LIMIT)
+
+
+def apply_filters(query, order_col, args, filters=None):
+    """filters 是 {參數名稱: (欄位, 型別)}，有帶的參數會變成等值條件；
+    from / to 會套用在 order_col 上。"""
+    for name, (column, cast) in (filters or {}).items():
+        value = args.get(name)
+        if value is None or value == '':
+            continue
+        try:
+            query = query.filter(column == cast(value))
+        except ValueError:
+            raise InvalidPageRequest(f'{name} has an invalid value')
+
+    if order_col is not None:
+        since = parse_time(args.get('from'), 'from')
+        until = parse_time(args.get('to'), 'to')
+        if since is not None:
+            query = query.filter(order_col >= since)
+        if until is not None:
+            query = query.filter(order_col < until)
+    return query
+
+
+def paginate(query, order_col, pk_col, args, filters=None):
+    """依 (order_col, pk_col) 由新到舊做 keyset 分頁，回傳 (rows, next_cursor)。"""
+    query = apply_filters(query, order_col, args, filters)
+    cursor = args.get('cursor')
+    if cursor:
+        ts, pk = decode_cursor(cursor)
+        query = query.filter(_after(order_col, pk_col, ts, pk))
+
+    if order_col is not None:
+        query = query.order_by(order_col.desc().nulls_last(), pk_col.desc())
+    else:
+        query = query.order_by(pk_col.desc())
+
+    limit = parse_limit(args)
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        ts = getattr(last, order_col.key) if order_col is not None else None
+        next_cursor = encode_cursor(ts, getattr(last, pk_col.key))
+    return rows, next_cursor
+
+
+def _after(order_col, pk_col, ts, pk):
+    # 排序為 order_col DESC NULLS LAST, pk DESC，游標之後的列
+    if order_col is None:
+        return pk_col < pk
+    if ts is None:
+        return and_(order_col.is_(None), pk_col < pk)
+    return or_(
+        order_col < ts,
+        and_(order_col == ts, pk_col < pk),
+        order_col.is_(None),
+    )
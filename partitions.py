@@ -0,0 +1,94 @@
+"""PostgreSQL 原生的按月 range partition。
+
+每個月一個 partition，命名為 <table>_pYYYYMM，另有 <table>_pdefault 收時間是 NULL 或超出範圍的列。
+partition 的 key 必須是主鍵的一部分，而時間欄位可以是 NULL，所以轉換後父表不設主鍵，
+改成主鍵欄位的一般索引；id 仍由原本的 sequence 產生，不會重複。
+"""
+from datetime import datetime
+
+from sqlalchemy import text
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(month, n):
+    years, index = divmod(month.month - 1 + n, 12)
+    return datetime(month.year + years, index + 1, 1)
+
+
+def period_key(month):
+    return f'{month:%Y-%m}'
+
+
+def parse_period(period):
+    return datetime.strptime(period, '%Y-%m')
+
+
+def partition_name(table, month):
+    return f'{table}_p{month:%Y%m}'
+
+
+def is_partitioned(conn, table):
+    return conn.execute(text(
+        'SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid '
+        'WHERE c.relname = :table AND c.relnamespace = current_schema()::regnamespace'
+    ), {'table': table}).first() is not None
+
+
+def partition_exists(conn, table, month):
+    return conn.execute(text('SELECT to_regclass(:name)'),
+                        {'name': partition_name(table, month)}).scalar() is not None
+
+
+def create_partition(conn, table, month):
+    conn.exec_driver_sql(
+        f'CREATE TABLE IF NOT EXISTS "{partition_name(table, month)}" PARTITION OF "{table}" '
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')")
+
+
+def ensure_partitions(conn, table, start, end):
+    """建立 [start, end) 每個月的 partition 與 default partition，已存在的跳過。
+
+    default partition 裡已經有某個月的資料時，那個月的 partition 建不起來，
+    所以要提前建好未來幾個月的。
+    """
+    month = month_start(start)
+    while month < end:
+        create_partition(conn, table, month)
+        month = add_months(month, 1)
+    conn.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS "{table}_pdefault" PARTITION OF "{table}" DEFAULT')
+
+
+def drop_partition(conn, table, month):
+    name = partition_name(table, month)
+    conn.exec_driver_sql(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"')
+    conn.exec_driver_sql(f'DROP TABLE "{name}"')
+
+
+def convert_to_partitioned(conn, table, time_column, pk_column, indexes, until):
+    """把既有的表換成按 time_column 分割的表，資料搬進各月的 partition。
+
+    整個過程在呼叫端的 transaction 裡，期間表被鎖住，要在維護時段執行。
+    indexes 是 model 上定義的 sqlalchemy Index，會在父表重建（自動套到每個 partition）。
+    """
+    legacy = f'{table}_unpartitioned'
+    conn.exec_driver_sql(f'LOCK TABLE "{table}" IN ACCESS EXCLUSIVE MODE')
+    oldest = conn.exec_driver_sql(f'SELECT min("{time_column}") FROM "{table}"').scalar()
+    conn.exec_driver_sql(f'ALTER TABLE "{table}" RENAME TO "{legacy}"')
+    conn.exec_driver_sql(
+        f'CREATE TABLE "{table}" (LIKE "{legacy}" INCLUDING DEFAULTS INCLUDING STORAGE) '
+        f'PARTITION BY RANGE ("{time_column}")')
+    # serial 欄位的 sequence 屬於舊表，刪舊表前要先改掛到新表，不然會一起被刪掉
+    sequence = conn.execute(text('SELECT pg_get_serial_sequence(:table, :column)'),
+                            {'table': f'"{legacy}"', 'column': pk_column}).scalar()
+    if sequence:
+        conn.exec_driver_sql(f'ALTER SEQUENCE {sequence} OWNED BY "{table}"."{pk_column}"')
+    ensure_partitions(conn, table, oldest or until, until)
+    conn.exec_driver_sql(f'INSERT INTO "{table}" SELECT * FROM "{legacy}"')
+    conn.exec_driver_sql(f'DROP TABLE "{legacy}"')
+    # 舊表的索引跟著刪掉了，名稱可以沿用
+    conn.exec_driver_sql(f'CREATE INDEX "ix_{table}_{pk_column}" ON "{table}" ("{pk_column}")')
+    for index in indexes:
+        index.create(conn)
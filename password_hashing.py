@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+# 目前要求的雜湊參數；登入時發現舊參數（例如較少的迭代次數）會自動重算
+HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}')
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class HashingPool:
+    """把 PBKDF2 丟到子行程計算，並限制同時排隊的數量。
+
+    同時進行的工作超過 workers + queue_depth 就直接丟 HashingBusy，
+    讓 API 回 503，而不是讓請求在 worker 裡一路排隊。workers=0 時在原行程計算。
+    """
+
+    def __init__(self, workers, queue_depth, timeout):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure(self):
+        # gunicorn fork 之後每個 worker 要有自己的子行程池
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            self._slots = threading.BoundedSemaphore(self.workers + self.queue_depth)
+            self._pid = os.getpid()
+
+    def run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        self._ensure()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        # 逾時後子行程仍在算，cancel() 停不了它；等工作真的結束才還名額
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HashingBusy()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._pid = None
+
+
+pool = HashingPool(
+    workers=int(os.getenv('PASSWORD_HASH_WORKERS', '2')),
+    queue_depth=int(os.getenv('PASSWORD_HASH_QUEUE_DEPTH', '8')),
+    timeout=float(os.getenv('PASSWORD_HASH_TIMEOUT', '10')),
+)
+
+
+def configure(workers, queue_depth, timeout=None):
+    global pool
+    pool.shutdown()
+    pool = HashingPool(workers, queue_depth, timeout if timeout is not None else pool.timeout)
+
+
+def hash_password(password):
+    return pool.run(generate_password_hash, password, HASH_METHOD)
+
+
+def verify_password(pwhash, password):
+    if not pwhash or password is None:
+        return False
+    return pool.run(check_password_hash, pwhash, password)
+
+
+def _normalize_method(method):
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        hash_name = parts[1] if len(parts) > 1 else 'sha256'
+        iterations = parts[2] if len(parts) > 2 else str(DEFAULT_PBKDF2_ITERATIONS)
+        return f'pbkdf2:{hash_name}:{iterations}'
+    return method
+
+
+def needs_rehash(pwhash):
+    if not pwhash or '$' not in pwhash:
+        return False
+    return _normalize_method(pwhash.split('$', 1)[0]) != _normalize_method(HASH_METHOD)
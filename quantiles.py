@@ -0,0 +1,94 @@
+import bisect
+import math
+
+
+class BinScheme:
+    """數值與整數 bin 的對應。
+
+    乘上 scale 之後小於 exact 的值每個整數一個 bin，次數、0–100 的分數、百分比都是精確的；
+    更大的值用 DDSketch 的對數 bin，相對誤差不超過 alpha。負數當成 0。
+    """
+
+    def __init__(self, scale=1, exact=128, alpha=0.01):
+        self.scale = scale
+        self.exact = exact
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+
+    def bin(self, value):
+        v = max(0.0, float(value) * self.scale)
+        rounded = int(round(v))
+        if rounded < self.exact:
+            return rounded
+        return self.exact + max(0, math.ceil(math.log(v / self.exact) / self._log_gamma))
+
+    def value(self, bin):
+        """bin 的代表值：精確區是那個整數，對數區是 (下界, 上界] 裡相對誤差最小的點。"""
+        if bin <= self.exact:
+            return bin / self.scale
+        upper = self.exact * self.gamma ** (bin - self.exact)
+        return 2 * upper / (self.gamma + 1) / self.scale
+
+
+class Sketch:
+    """可合併的分位數 sketch：bin -> 次數。
+
+    合併就是次數相加，所以各 worker 的寫入、各月份的 sketch 可以分開累計再合在一起；
+    大小只跟 bin 數有關，查分位數不受資料筆數影響。
+    """
+
+    def __init__(self, scheme, counts=None):
+        self.scheme = scheme
+        self.counts = {}
+        self._cumulative = None
+        for bin, n in (counts or {}).items():
+            self.add_bin(bin, n)
+
+    def add(self, value, n=1):
+        self.add_bin(self.scheme.bin(value), n)
+
+    def add_bin(self, bin, n):
+        count = self.counts.get(bin, 0) + n
+        if count > 0:
+            self.counts[bin] = count
+        else:
+            self.counts.pop(bin, None)
+        self._cumulative = None
+
+    def merge(self, other):
+        for bin, n in other.counts.items():
+            self.add_bin(bin, n)
+        return self
+
+    def _prepare(self):
+        if self._cumulative is None:
+            bins = sorted(self.counts)
+            cumulative = []
+            total = 0
+            for bin in bins:
+                total += self.counts[bin]
+                cumulative.append(total)
+            self._cumulative = (bins, cumulative)
+        return self._cumulative
+
+    @property
+    def total(self):
+        cumulative = self._prepare()[1]
+        return cumulative[-1] if cumulative else 0
+
+    def rank(self, value):
+        """比 value 小的比例，加上跟 value 同一個 bin 的一半（mid-rank）；沒有資料時回傳 None。"""
+        bins, cumulative = self._prepare()
+        if not cumulative:
+            return None
+        bin = self.scheme.bin(value)
+        i = bisect.bisect_left(bins, bin)
+        below = cumulative[i - 1] if i else 0
+        return (below + self.counts.get(bin, 0) / 2) / cumulative[-1]
+
+    def quantile(self, q):
+        bins, cumulative = self._prepare()
+        if not cumulative:
+            return None
+        i = bisect.bisect_left(cumulative, q * cumulative[-1])
+        return self.scheme.value(bins[min(i, len(bins) - 1)])
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request
+
+
+class MemoryBackend:
+    """行程內的 LRU 快取：每筆有 TTL，並以筆數與總位元組數限制大小。
+
+    tag 的版本號也在行程內，invalidate() 只影響處理寫入的那個行程；
+    多個 worker 時其他 worker 會讀到舊資料直到 TTL 過期（見 ResponseCache 的 tagged_max_ttl）。
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._counters = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, value, ttl, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+class RedisBackend:
+    """多個 worker 共用的快取；redis 是選用套件，有設定 RESPONSE_CACHE_URL 才會載入。"""
+
+    def __init__(self, url, prefix='poopalooza:cache:'):
+        import redis
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get(self._prefix + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl, size):
+        self._client.set(self._prefix + key, pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def counter(self, key):
+        return int(self._client.get(self._prefix + 'ctr:' + key) or 0)
+
+    def incr(self, key):
+        self._client.incr(self._prefix + 'ctr:' + key)
+
+    def clear(self):
+        for key in self._client.scan_iter(self._prefix + '*'):
+            self._client.delete(key)
+
+
+class ResponseCache:
+    """GET 回應快取，以 tag 失效、附 ETag 並支援 If-None-Match -> 304。
+
+    失效不逐筆刪除：每個 tag 有一個版本號，key 裡帶著版本號，
+    寫入時把版本號加一，舊的快取自然不會再被讀到，之後由 LRU/TTL 淘汰。
+    """
+
+    def __init__(self, backend=None, enabled=True, tagged_max_ttl=None):
+        self.backend = backend or MemoryBackend()
+        self.enabled = enabled
+        # 有 tag 的快取最多存幾秒；行程內快取又有多個 worker 時用來限制讀到舊資料的時間
+        self.tagged_max_ttl = tagged_max_ttl
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.incr('tag:' + tag)
+
+    def clear(self):
+        self.backend.clear()
+
+    def cached(self, ttl, tags=None, max_age=0, unless=None):
+        """tags 是 view 參數 -> tag 列表的函式；unless() 為真時不走快取。"""
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.method != 'GET' or (unless is not None and unless()):
+                    return view(*args, **kwargs)
+
+                view_tags = tags(**kwargs) if tags is not None else []
+                versions = ','.join(f'{tag}={self.backend.counter("tag:" + tag)}' for tag in view_tags)
+                key = f'{request.full_path}|{versions}'
+
+                hit = self.backend.get(key)
+                if hit is not None:
+                    body, status, mimetype, etag = hit
+                    response = Response(body, status=status, mimetype=mimetype)
+                    response.headers['X-Cache'] = 'HIT'
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    body = response.get_data()
+                    etag = hashlib.sha1(body).hexdigest()
+                    entry_ttl = ttl
+                    if view_tags and self.tagged_max_ttl is not None:
+                        entry_ttl = min(ttl, self.tagged_max_ttl)
+                    self.backend.set(key, (body, 200, response.mimetype, etag), entry_ttl, len(body))
+                    response.headers['X-Cache'] = 'MISS'
+
+                response.set_etag(etag)
+                response.cache_control.max_age = max_age
+                if not max_age:
+                    response.cache_control.no_cache = True
+                return response.make_conditional(request)
+
+            return wrapper
+
+        return decorator
+
+
+def cache_from_env():
+    enabled = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+    url = os.getenv('RESPONSE_CACHE_URL')
+    tagged_max_ttl = None
+    if url:
+        backend = RedisBackend(url)
+    else:
+        backend = MemoryBackend(
+            max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1024')),
+            max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(32 * 1024 * 1024))),
+        )
+        # gunicorn.conf.py 在多個 worker 時預設設定這個值
+        if os.getenv('RESPONSE_CACHE_LOCAL_MAX_TTL'):
+            tagged_max_ttl = float(os.environ['RESPONSE_CACHE_LOCAL_MAX_TTL'])
+    return ResponseCache(backend, enabled=enabled, tagged_max_ttl=tagged_max_ttl)
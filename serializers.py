@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import UUID
+
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # orjson 是選用套件，沒裝就用標準函式庫
+    orjson = None
+
+# http：沿用 Flask 預設的 RFC 822 格式（App 目前解析的格式）；iso：ISO 8601
+JSON_DATETIME_FORMAT = os.getenv('JSON_DATETIME_FORMAT', 'http')
+MAX_COMPILED_PER_MODEL = 64
+
+
+class UnknownField(ValueError):
+    pass
+
+
+def format_datetime(value):
+    if value is None:
+        return None
+    if JSON_DATETIME_FORMAT == 'iso':
+        return value.isoformat()
+    return http_date(value)
+
+
+def _default(o):
+    if isinstance(o, (date, datetime)):
+        return format_datetime(o)
+    if isinstance(o, (Decimal, UUID)):
+        return str(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def parse_fields(value):
+    if not value:
+        return None
+    fields = tuple(dict.fromkeys(f.strip() for f in value.split(',') if f.strip()))
+    return fields or None
+
+
+class RowSerializer:
+    """每個 model 建一次：直接 select 欄位 tuple（不建立 ORM 物件），
+    再用事先產生好的函式把 row 轉成 dict。
+
+    日期時間欄位在這裡就轉成字串，JSON encoder 不必再走 default 的慢路徑。
+    """
+
+    def __init__(self, model, exclude=(), default_fields=None):
+        self.model = model
+        self.columns = {
+            c.key: getattr(model, c.key)
+            for c in model.__table__.columns if c.key not in exclude
+        }
+        self._datetime_fields = {name for name, col in self.columns.items() if _is_datetime(col)}
+        self.default_fields = tuple(default_fields or self.columns)
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def select(self, fields=None, extra=()):
+        """回傳 (要 select 的欄位, row -> dict)。
+
+        fields 是 ?fields= 的值；extra 是分頁需要、但不一定要輸出的欄位（排序欄位與主鍵）。
+        """
+        names = parse_fields(fields) if isinstance(fields, str) or fields is None else tuple(fields)
+        names = names or self.default_fields
+        unknown = [name for name in names if name not in self.columns]
+        if unknown:
+            raise UnknownField(f'unknown field: {", ".join(unknown)}')
+        extra_names = tuple(col.key for col in extra if col.key not in names)
+        key = (names, extra_names)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compile(names, extra_names)
+            with self._lock:
+                if len(self._compiled) >= MAX_COMPILED_PER_MODEL:
+                    self._compiled.clear()
+                self._compiled[key] = compiled
+        return compiled
+
+    def _compile(self, names, extra_names):
+        items = []
+        for i, name in enumerate(names):
+            expr = f'row[{i}]'
+            if name in self._datetime_fields:
+                expr = f'_fmt({expr})'
+            items.append(f'{name!r}: {expr}')
+        source = 'def to_dict(row):\n    return {' + ', '.join(items) + '}\n'
+        namespace = {'_fmt': format_datetime}
+        exec(compile(source, f'<serializer {self.model.__name__}>', 'exec'), namespace)
+        columns = [self.columns[name] for name in names + extra_names]
+        return columns, namespace['to_dict']
+
+
+def _is_datetime(col):
+    try:
+        return col.type.python_type in (date, datetime)
+    except NotImplementedError:
+        return False
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """有安裝 orjson 就用 orjson；不排序 key、不轉義非 ASCII 字元。
+
+    日期時間的輸出格式與 JSON_DATETIME_FORMAT 一致，和 RowSerializer 相同。
+    """
+
+    sort_keys = False
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return self.dump_bytes(obj).decode('utf-8')
+        kwargs.setdefault('default', _default)
+        kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return json.dumps(obj, **kwargs)
+
+    def dump_bytes(self, obj):
+        if orjson is None:
+            return self.dumps(obj, separators=(',', ':')).encode('utf-8')
+        option = orjson.OPT_NON_STR_KEYS
+        if JSON_DATETIME_FORMAT != 'iso':
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        return orjson.dumps(obj, default=_default, option=option)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self._app.debug:
+            return super().response(obj)
+        return self._app.response_class(self.dump_bytes(obj) + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,182 @@
+import math
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    # 兩點間大圓距離（公尺）
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """經緯度網格分桶的空間索引，每格 cell_deg 度。
+
+    items 以 (lat, lon, item) 存在各自的格子裡；半徑查詢只看被包圍的格子，
+    k 近鄰查詢則由中心格一圈一圈往外擴，直到下一圈不可能更近為止。
+    """
+
+    def __init__(self, cell_deg=0.01):
+        self.cell_deg = cell_deg
+        self.buckets = {}
+        self.size = 0
+        self._bounds = None  # (min_row, max_row, min_col, max_col)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg)))
+
+    def insert(self, lat, lon, item):
+        if lat is None or lon is None:
+            return
+        row, col = self._cell(lat, lon)
+        self.buckets.setdefault((row, col), []).append((lat, lon, item))
+        self.size += 1
+        if self._bounds is None:
+            self._bounds = (row, row, col, col)
+        else:
+            r0, r1, c0, c1 = self._bounds
+            self._bounds = (min(r0, row), max(r1, row), min(c0, col), max(c1, col))
+
+    def remove(self, lat, lon, item):
+        if lat is None or lon is None:
+            return
+        cell = self._cell(lat, lon)
+        bucket = self.buckets.get(cell, [])
+        for i, entry in enumerate(bucket):
+            if entry[2] == item:
+                del bucket[i]
+                self.size -= 1
+                if not bucket:
+                    del self.buckets[cell]
+                return
+
+    def within(self, lat, lon, radius_m, predicate=None):
+        """回傳半徑內的 [(distance_m, item)]，依距離排序。"""
+        if not self.size:
+            return []
+        dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+        coslat = math.cos(math.radians(min(89.9, abs(lat) + dlat)))
+        dlon = min(180.0, dlat / max(coslat, 1e-6))
+        r0, c0 = self._cell(lat - dlat, lon - dlon)
+        r1, c1 = self._cell(lat + dlat, lon + dlon)
+
+        # 半徑很大時直接掃有資料的格子，比逐格枚舉便宜
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > len(self.buckets):
+            cells = [
+                bucket for (row, col), bucket in self.buckets.items()
+                if r0 <= row <= r1 and c0 <= col <= c1
+            ]
+        else:
+            cells = [
+                self.buckets[(row, col)]
+                for row in range(r0, r1 + 1)
+                for col in range(c0, c1 + 1)
+                if (row, col) in self.buckets
+            ]
+
+        hits = []
+        for bucket in cells:
+            for plat, plon, item in bucket:
+                if predicate is not None and not predicate(item):
+                    continue
+                d = haversine_m(lat, lon, plat, plon)
+                if d <= radius_m:
+                    hits.append((d, item))
+        hits.sort(key=lambda h: h[0])
+        return hits
+
+    def nearest(self, lat, lon, k, max_radius_m=None, predicate=None):
+        """回傳最近的 k 筆 [(distance_m, item)]，可選擇限制最大半徑。"""
+        if not self.size or k <= 0:
+            return []
+        row0, col0 = self._cell(lat, lon)
+        min_row, max_row, min_col, max_col = self._bounds
+        max_ring = max(row0 - min_row, max_row - row0, col0 - min_col, max_col - col0, 0)
+        m_per_deg = math.radians(1) * EARTH_RADIUS_M
+
+        hits = []
+        ring = 0
+        while ring <= max_ring:
+            for row, col in _ring_cells(row0, col0, ring):
+                for plat, plon, item in self.buckets.get((row, col), ()):
+                    if predicate is not None and not predicate(item):
+                        continue
+                    d = haversine_m(lat, lon, plat, plon)
+                    if max_radius_m is None or d <= max_radius_m:
+                        hits.append((d, item))
+
+            # 下一圈以外的點，離中心至少 ring 格（經度方向要乘上 cos 緯度）
+            span = ring * self.cell_deg
+            coslat = math.cos(math.radians(min(89.9, abs(lat) + span + self.cell_deg)))
+            lower_bound = span * m_per_deg * max(coslat, 0.0)
+            if max_radius_m is not None and lower_bound > max_radius_m:
+                break
+            if len(hits) >= k:
+                hits.sort(key=lambda h: h[0])
+                del hits[k:]
+                if hits[-1][0] <= lower_bound:
+                    break
+            ring += 1
+
+        hits.sort(key=lambda h: h[0])
+        return hits[:k]
+
+
+def _ring_cells(row0, col0, ring):
+    if ring == 0:
+        yield row0, col0
+        return
+    for col in range(col0 - ring, col0 + ring + 1):
+        yield row0 - ring, col
+        yield row0 + ring, col
+    for row in range(row0 - ring + 1, row0 + ring):
+        yield row, col0 - ring
+        yield row, col0 + ring
+
+
+# ---- Web Mercator 圖磚 / quadkey（與 Bing Maps 相同的編碼）----
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def tile_xy(lat, lon, zoom):
+    """經緯度所在的 z/x/y 圖磚。"""
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    n = 1 << zoom
+    s = math.sin(math.radians(lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_quadkey(x, y, zoom):
+    # 每一層一個 0-3 的數字，前綴相同就是同一塊上層圖磚裡的格子
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return ''.join(digits)
+
+
+def quadkey(lat, lon, zoom):
+    return tile_quadkey(*tile_xy(lat, lon, zoom), zoom)
+
+
+def quadkey_tile(key):
+    """quadkey -> (x, y, zoom)。"""
+    x = y = 0
+    for digit in key:
+        d = int(digit)
+        x = (x << 1) | (d & 1)
+        y = (y << 1) | (d >> 1)
+    return x, y, len(key)
+
+
+def tile_center(x, y, zoom):
+    n = 1 << zoom
+    lon = (x + 0.5) / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / n))))
+    return lat, lon
@@ -0,0 +1,52 @@
+import os
+import zlib
+
+from flask import Response, stream_with_context
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '500'))
+
+
+def wants_stream(request):
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def ndjson_response(rows, dumps, request, batch_size=STREAM_BATCH_SIZE):
+    """把 rows 逐行序列化成 NDJSON 串流回傳，每 batch_size 行送出一次。
+
+    用戶端接受 gzip 時一邊壓縮一邊送，記憶體只會留住一個 batch。
+    """
+    use_gzip = 'gzip' in request.accept_encodings
+
+    def generate():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if use_gzip else None
+        lines = []
+        for row in rows:
+            lines.append(dumps(row))
+            if len(lines) >= batch_size:
+                chunk = _encode(lines)
+                lines = []
+                if compressor is None:
+                    yield chunk
+                else:
+                    yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        chunk = _encode(lines)
+        if compressor is None:
+            if chunk:
+                yield chunk
+        else:
+            yield compressor.compress(chunk) + compressor.flush()
+
+    response = Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _encode(lines):
+    if not lines:
+        return b''
+    return ('\n'.join(lines) + '\n').encode('utf-8')
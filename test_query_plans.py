@@ -0,0 +1,16 @@
+"""查詢計畫回歸測試：以小量資料跑 check_query_plans 的檢查，熱門查詢出現全表掃描就失敗。
+
+    python -m pytest test_query_plans.py
+    QUERY_PLANS_DATABASE_URL=postgresql://localhost/poopalooza_plans python -m pytest test_query_plans.py
+"""
+import argparse
+import os
+
+import check_query_plans
+
+
+def test_hot_queries_use_indexes():
+    args = argparse.Namespace(database_url=os.getenv('QUERY_PLANS_DATABASE_URL'),
+                              users=200, records_per_user=10, toilets=200, verbose=False)
+    failures = check_query_plans.run(args)
+    assert not failures, '\n'.join(f'{probe}: {table}: {line}' for probe, table, line in failures)
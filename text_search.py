@@ -0,0 +1,208 @@
+import heapq
+import math
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from spatial import GridIndex
+
+# 異體字統一成同一個字，查「台北」也找得到「臺北」
+VARIANTS = str.maketrans({'臺': '台', '厠': '廁', '峯': '峰'})
+
+GRID_THRESHOLD = 256  # 同分的筆數超過這個數量，依距離排序時改由網格索引從近到遠找
+GRID_CELL_DEG = 0.02
+
+
+def normalize(text):
+    """全形轉半形、大小寫不分、異體字統一；標點當成空白。"""
+    text = unicodedata.normalize('NFKC', str(text or '')).casefold().translate(VARIANTS)
+    return ' '.join(''.join(ch if ch.isalnum() else ' ' for ch in text).split())
+
+
+def _term_grams(term):
+    # 查詢只需要最少的 gram：兩個字以上用 bigram，一個字用單字
+    if len(term) == 1:
+        return {term}
+    return {term[i:i + 2] for i in range(len(term) - 1)}
+
+
+def match_quality(text, term):
+    """完全相同 4、開頭相同 3、某個詞的開頭 2、包含 1、沒有 0。"""
+    if term not in text:
+        return 0
+    if text == term:
+        return 4
+    if text.startswith(term):
+        return 3
+    if f' {term}' in text:
+        return 2
+    return 1
+
+
+class SearchIndex:
+    """記憶體內的 n-gram 反向索引，適合中文這類沒有空白分詞的文字。
+
+    索引每個欄位的單字與相鄰兩字（bigram）。postings 存 gram -> {doc_id: (分數, 開頭分數)}，
+    是「只查這個 gram」時的成績（開頭分數只算對到欄位或詞開頭的），打字中最常見的
+    一、兩個字的查詢可以直接排序，不用逐筆比對；
+    更長的查詢取各 gram 的交集當候選，再逐筆確認真的含有查詢字串並計分。
+    排好的結果依查詢快取起來，打字時常見的字首大多不必重算；資料有異動就整個清掉。
+    """
+
+    def __init__(self, fields, max_results=50, cache_size=256):
+        self.fields = fields  # 欄位名稱 -> 權重
+        self.max_results = max_results
+        self.cache_size = cache_size
+        self.postings = {}  # gram -> {doc_id: (分數, 開頭分數)}
+        self.docs = {}  # doc_id -> ([(權重, 正規化文字)], item, (lat, lon), 文字長度)
+        self.grid = GridIndex(GRID_CELL_DEG)  # 所有有座標的 doc_id
+        self._cache = OrderedDict()  # (terms, prefix) -> ([(分數, [doc_id])], {分數: set(doc_id)})
+        self._lock = threading.Lock()
+
+    def _doc_grams(self, texts):
+        scores = {}
+        for weight, text in texts:
+            for word in text.split():
+                for gram in set(word) | {word[i:i + 2] for i in range(len(word) - 1)}:
+                    quality = match_quality(text, gram)
+                    score, prefix_score = scores.get(gram, (0, 0))
+                    scores[gram] = (max(score, quality * weight),
+                                    max(prefix_score, quality * weight if quality >= 2 else 0))
+        return scores
+
+    def insert(self, doc_id, item, location=None):
+        self.remove(doc_id)
+        texts = [(weight, normalize(item.get(name))) for name, weight in self.fields.items()]
+        texts = [(weight, text) for weight, text in texts if text]
+        length = sum(len(text) for _, text in texts)
+        with self._lock:
+            self._cache.clear()
+            self.docs[doc_id] = (texts, item, location, length)
+            if location is not None:
+                self.grid.insert(location[0], location[1], doc_id)
+            for gram, score in self._doc_grams(texts).items():
+                self.postings.setdefault(gram, {})[doc_id] = score
+
+    def remove(self, doc_id):
+        with self._lock:
+            doc = self.docs.pop(doc_id, None)
+            if doc is None:
+                return
+            self._cache.clear()
+            if doc[2] is not None:
+                self.grid.remove(doc[2][0], doc[2][1], doc_id)
+            for gram in self._doc_grams(doc[0]):
+                posting = self.postings.get(gram)
+                if posting is not None:
+                    posting.pop(doc_id, None)
+                    if not posting:
+                        del self.postings[gram]
+
+    def _score(self, texts, terms, prefix):
+        total = 0
+        last = len(terms) - 1
+        for i, term in enumerate(terms):
+            best = 0
+            for weight, text in texts:
+                if term not in text:
+                    continue
+                quality = match_quality(text, term)
+                if quality == 1 and prefix and i == last and len(term) == 1:
+                    continue  # 輸入中只打了一個字，要對到開頭，不然幾乎每筆都符合
+                if quality * weight > best:
+                    best = quality * weight
+            if not best:
+                return 0
+            total += best
+        return total
+
+    def _rank(self, terms, prefix):
+        # 呼叫端持有 lock；回傳分數排進前 max_results 名的所有結果，依分數、文字長度排好
+        if len(terms) == 1 and len(terms[0]) <= 2:
+            posting = self.postings.get(terms[0], {})
+            pick = 1 if prefix and len(terms[0]) == 1 else 0
+            scored = [(scores[pick], doc_id) for doc_id, scores in posting.items() if scores[pick]]
+        else:
+            postings = []
+            for term in terms:
+                for gram in _term_grams(term):
+                    posting = self.postings.get(gram)
+                    if not posting:
+                        return []
+                    postings.append(posting)
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+                if not candidates:
+                    return []
+            scored = []
+            for doc_id in candidates:
+                score = self._score(self.docs[doc_id][0], terms, prefix)
+                if score:
+                    scored.append((score, doc_id))
+        # 只留排得進前 max_results 名的分數；同分的都留著，之後可能依距離重排
+        if len(scored) > self.max_results:
+            cutoff = heapq.nlargest(self.max_results, scored)[-1][0]
+            scored = [hit for hit in scored if hit[0] >= cutoff]
+        docs = self.docs
+        ranked = sorted((-score, docs[doc_id][3], doc_id) for score, doc_id in scored)
+        levels = []
+        for score, _, doc_id in ranked:
+            if not levels or levels[-1][0] != -score:
+                levels.append((-score, []))
+            levels[-1][1].append(doc_id)
+        return levels
+
+    def _nearest(self, doc_ids, grids, score, origin, k):
+        # 呼叫端持有 lock；同分的結果裡離 origin 最近的 k 筆
+        docs = self.docs
+        lat0, lon0 = origin
+        if len(doc_ids) <= GRID_THRESHOLD:
+            coslat = math.cos(math.radians(lat0))
+
+            def distance(doc_id):
+                location = docs[doc_id][2]
+                if location is None or None in location:
+                    return float('inf')
+                # 等距長方投影的距離平方，只用來排序
+                return (location[0] - lat0) ** 2 + ((location[1] - lon0) * coslat) ** 2
+            return heapq.nsmallest(k, doc_ids, key=distance)
+        # 同分的太多（很常見的字）時，改從全部資料的網格由近到遠一圈圈找屬於這一組的；
+        # 符合的筆數多，通常幾圈內就找滿了
+        members = grids.get(score)
+        if members is None:
+            members = grids[score] = set(doc_ids)
+        picked = [doc_id for _, doc_id in self.grid.nearest(lat0, lon0, k, predicate=members.__contains__)]
+        if len(picked) < k:
+            picked += [doc_id for doc_id in doc_ids
+                       if docs[doc_id][2] is None or None in docs[doc_id][2]][:k - len(picked)]
+        return picked
+
+    def search(self, query, limit=20, prefix=False, origin=None):
+        """回傳 [(score, item)]，依分數高到低排序，同分時近的（有 origin）或短的在前。"""
+        terms = normalize(query).split()
+        if not terms:
+            return []
+        limit = min(limit, self.max_results)
+        key = (tuple(terms), bool(prefix))
+        hits = []
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                entry = self._cache[key] = (self._rank(terms, prefix), {})
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+            levels, grids = entry
+            for score, doc_ids in levels:
+                need = limit - len(hits)
+                if need <= 0:
+                    break
+                if origin is None or len(doc_ids) == 1:
+                    picked = doc_ids[:need]
+                else:
+                    picked = self._nearest(doc_ids, grids, score, origin, need)
+                hits.extend((score, self.docs[doc_id][1]) for doc_id in picked)
+        return hits
@@ -0,0 +1,208 @@
+import csv
+import io
+import json
+import os
+import tempfile
+
+from sqlalchemy import or_, select, text
+
+from db_utils import dialect_insert
+from media_store import UPLOAD_CHUNK_SIZE, UploadTooLarge
+
+IMPORT_BATCH_SIZE = int(os.getenv('TOILET_IMPORT_BATCH_SIZE', '5000'))
+# 經過 PgBouncer 或非 psycopg2 driver 時可關掉 COPY，改用多列 INSERT
+USE_COPY = os.getenv('TOILET_IMPORT_COPY', '1') == '1'
+# 單一 INSERT 的 bind 參數上限（SQLite 預設 32766）
+MAX_BIND_PARAMS = 30000
+FLOAT_COLUMNS = ('latitude', 'longitude')
+
+
+class ImportAborted(ValueError):
+    """資料讀到一半無法解析；row 是第幾筆資料（從 1 起算），counts 是已經 commit 的批次的計數。"""
+
+    def __init__(self, message, row, counts):
+        super().__init__(message)
+        self.row = row
+        self.counts = counts
+
+
+def iter_csv_rows(stream):
+    # utf-8-sig：政府開放資料的 CSV 常常帶 BOM
+    if isinstance(stream, io.TextIOBase):
+        text_stream = stream
+    else:
+        text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    yield from csv.DictReader(text_stream)
+
+
+def iter_ndjson_rows(stream):
+    for line in stream:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_rows(stream, fmt):
+    if fmt == 'csv':
+        return iter_csv_rows(stream)
+    if fmt == 'ndjson':
+        return iter_ndjson_rows(stream)
+    raise ValueError(f'unsupported format: {fmt}')
+
+
+def save_upload(stream, directory, max_bytes):
+    """把上傳的檔案邊讀邊寫進 directory，回傳檔名；超過 max_bytes 時刪掉檔案並丟 UploadTooLarge。"""
+    os.makedirs(directory, exist_ok=True)
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='toilets-', delete=False) as f:
+        try:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge()
+                f.write(chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return os.path.basename(f.name)
+
+
+def normalize_row(raw, columns):
+    """只保留資料表欄位，空字串視為 NULL，經緯度轉成 float。
+
+    檔案裡沒有的欄位不放進結果：只帶部分欄位的檔案只更新那些欄位，不會把其他欄位清成 NULL。
+    """
+    row = {}
+    for name in columns:
+        if name not in raw:
+            continue
+        value = raw[name]
+        if isinstance(value, str):
+            value = value.strip() or None
+        if value is not None and name in FLOAT_COLUMNS:
+            value = float(value)
+        elif value is not None and not isinstance(value, str):
+            value = str(value)
+        row[name] = value
+    if not row.get('toilet_id'):
+        raise ValueError('toilet_id is required')
+    return row
+
+
+def import_toilets(session, table, rows, batch_size=IMPORT_BATCH_SIZE):
+    """以 toilet_id 為鍵分批 upsert，每批各自 commit，回傳計數。
+
+    PostgreSQL 走 COPY 到暫存表再 INSERT ... SELECT ... ON CONFLICT；
+    其他資料庫用多列 INSERT ... ON CONFLICT。只寫入各列實際帶有的欄位，內容完全相同的列不會被改寫。
+    欄位不對的列只計入 errors；整份資料讀不下去時丟 ImportAborted，之前的批次已經 commit。
+    """
+    columns = [c.name for c in table.columns]
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
+    batch = {}
+    rows = iter(rows)
+    number = 0
+    while True:
+        try:
+            raw = next(rows)
+        except StopIteration:
+            break
+        except (ValueError, csv.Error) as e:
+            raise ImportAborted(f'row {number + 1}: {e}', number + 1, dict(counts)) from e
+        number += 1
+        try:
+            row = normalize_row(raw, columns)
+        except (ValueError, TypeError, AttributeError):
+            counts['errors'] += 1
+            continue
+        # 同一批內重複的 toilet_id 合併成一列，同欄位以最後一筆為準（ON CONFLICT 不允許同列改兩次）
+        batch.setdefault(row['toilet_id'], {}).update(row)
+        if len(batch) >= batch_size:
+            _flush(session, table, columns, list(batch.values()), counts)
+            batch = {}
+    if batch:
+        _flush(session, table, columns, list(batch.values()), counts)
+    return counts
+
+
+def _flush(session, table, columns, batch, counts):
+    ids = [row['toilet_id'] for row in batch]
+    existing = session.execute(
+        select(table.c.toilet_id).where(table.c.toilet_id.in_(ids))
+    ).scalars().all()
+    # 多列 INSERT / COPY 的欄位要一致，依各列帶的欄位分組
+    groups = {}
+    for row in batch:
+        groups.setdefault(tuple(name for name in columns if name in row), []).append(row)
+    upsert = _copy_upsert if USE_COPY and session.get_bind().dialect.name == 'postgresql' else _insert_upsert
+    changed = sum(upsert(session, table, list(group_columns), rows)
+                  for group_columns, rows in groups.items())
+    session.commit()
+
+    inserted = len(batch) - len(existing)
+    updated = changed - inserted
+    counts['inserted'] += inserted
+    counts['updated'] += updated
+    counts['unchanged'] += len(existing) - updated
+
+
+def _insert_upsert(session, table, columns, batch):
+    insert = dialect_insert(session)
+    data_columns = [name for name in columns if name != 'toilet_id']
+    chunk_size = max(1, MAX_BIND_PARAMS // len(columns))
+    changed = 0
+    for start in range(0, len(batch), chunk_size):
+        stmt = insert(table).values(batch[start:start + chunk_size])
+        if data_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.toilet_id],
+                set_={name: stmt.excluded[name] for name in data_columns},
+                where=or_(*[table.c[name].is_distinct_from(stmt.excluded[name]) for name in data_columns]),
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[table.c.toilet_id])
+        stmt = stmt.returning(table.c.toilet_id)
+        changed += len(session.execute(stmt).all())
+    return changed
+
+
+def _copy_upsert(session, table, columns, batch):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in batch:
+        # COPY csv 格式中，未加引號的空欄位才是 NULL
+        writer.writerow(['' if row[name] is None else row[name] for name in columns])
+    buf.seek(0)
+
+    column_list = ', '.join(f'"{name}"' for name in columns)
+    data_columns = [name for name in columns if name != 'toilet_id']
+    if data_columns:
+        assignments = ', '.join(f'"{name}" = EXCLUDED."{name}"' for name in data_columns)
+        distinct = ' OR '.join(f't."{name}" IS DISTINCT FROM EXCLUDED."{name}"' for name in data_columns)
+        on_conflict = f'DO UPDATE SET {assignments} WHERE {distinct}'
+    else:
+        on_conflict = 'DO NOTHING'
+
+    session.execute(text(
+        f'CREATE TEMP TABLE toilet_import (LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DROP'
+    ))
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY toilet_import ({column_list}) FROM STDIN WITH (FORMAT csv)', buf)
+    finally:
+        cursor.close()
+    result = session.execute(text(
+        f'INSERT INTO {table.name} AS t ({column_list}) '
+        f'SELECT {column_list} FROM toilet_import '
+        f'ON CONFLICT (toilet_id) {on_conflict} '
+        f'RETURNING t.toilet_id'
+    ))
+    changed = len(result.all())
+    # 同一批可能分好幾組欄位各跑一次，暫存表用完就丟
+    session.execute(text('DROP TABLE toilet_import'))
+    return changed